@@ -2,6 +2,7 @@ __version__ = "0.4.0"
 from itertools import chain
 import logging
 from pymonitor.builtins import sysinfo
+from pymonitor import telemetry
 
 
 class Backend(object):
@@ -12,8 +13,25 @@ class Backend(object):
         self.master = master
         self.conf = conf
         self.sysinfo = {}
-        self.logger = logging.getLogger("monitordaemon.backend")
+        self.name = self.conf.get("name", self.conf.get("type", "backend"))
+        self.logger = logging.getLogger("monitordaemon.backend.%s" % self.name)
         self.update_sys_info()
+        self.healthy = True
+        self.spool = None
+        if "spool" in self.conf:
+            from pymonitor.spool import Spool
+            self.spool = Spool.from_config(self.conf["spool"])
+
+        name = self.name
+        self.send_seconds = telemetry.histogram("send_seconds", backend=name)
+        self.batch_size = telemetry.histogram("batch_size", telemetry.SIZE_BUCKETS, backend=name)
+        self.delivered = telemetry.counter("delivered", backend=name)
+        self.spooled = telemetry.counter("undelivered", backend=name, outcome="spooled")
+        self.dropped = telemetry.counter("undelivered", backend=name, outcome="dropped")
+        self.discarded = telemetry.counter("undelivered", backend=name, outcome="rejected")
+        if self.spool:
+            telemetry.gauge("spool", lambda: {"pending_bytes": self.spool.pending(), "evicted": self.spool.evicted},
+                            backend=name)
 
     def update_sys_info(self):
         """
@@ -34,18 +52,66 @@ class Backend(object):
         """
         raise NotImplementedError()
 
+    def succeeded(self, count=0):
+        """
+        Called by backends after data was delivered
+        :param count: number of metrics delivered
+        """
+        self.healthy = True
+        self.delivered.inc(count)
+
+    def refused(self, count):
+        """
+        Called by backends with the number of metrics the server rejected as invalid. They are dropped rather than
+        spooled, as sending them again would fail the same way.
+        """
+        self.healthy = True
+        self.discarded.inc(count)
+
+    def stats(self):
+        """
+        Return counts of metrics delivered and not delivered
+        """
+        return {"delivered": self.delivered.value, "spooled": self.spooled.value, "dropped": self.dropped.value,
+                "rejected": self.discarded.value}
+
+    def failed(self, metrics):
+        """
+        Called by backends with Metric objects that could not be delivered. They are written to the spool for later
+        replay if one is configured, and dropped otherwise.
+        """
+        self.healthy = False
+        if self.spool:
+            self.logger.warning("spooling %s undelivered metrics", len(metrics))
+            self.spool.write(metrics)
+            self.spooled.inc(len(metrics))
+        else:
+            self.logger.error("dropping %s undelivered metrics", len(metrics))
+            self.dropped.inc(len(metrics))
+
+    def close(self):
+        """
+        Send any buffered data and release resources. Called once all monitors have stopped.
+        """
+        if self.spool:
+            self.spool.close()
+
 
 class Metric(object):
     """
     Wrapper for holding metrics gathered from the system. All monitor modules yield multiple of these objects.
     """
-    def __init__(self, values, tags=None):
+    __slots__ = ("values", "tags", "timestamp")
+
+    def __init__(self, values, tags=None, timestamp=None):
         """
         :param values: dict of name->value metric data
         :param tags: dict of key->value tags associated with the metric data
+        :param timestamp: integer epoch time in nanoseconds the data was sampled at. Set by the daemon when left empty.
         """
         self.values = values
         self.tags = tags or {}
+        self.timestamp = timestamp
 
     def __repr__(self):
         fields = []
@@ -0,0 +1,187 @@
+from pymonitor import Metric
+from array import array
+import logging
+import math
+
+
+STATS = ("min", "max", "mean", "last", "count")
+
+# Offsets of each running statistic in a Window's `running` array, which holds one group of these per field
+MIN, MAX, SUM, LAST = range(4)
+SLOTS = 4
+
+
+def percentile(samples, pct):
+    """
+    Return the nearest-rank percentile of a sorted sequence
+    """
+    return samples[max(0, math.ceil(pct / 100 * len(samples)) - 1)]
+
+
+class Window(object):
+    """
+    The samples of one series within the current window. Numeric fields are summarized in a flat array of running
+    min/max/sum/last values, and only when percentiles are needed are the samples themselves kept, one array per field.
+    """
+    __slots__ = ("names", "integral", "size", "running", "count", "samples", "other", "tags")
+
+    def __init__(self, values, tags, keep_samples):
+        self.names = tuple(name for name, value in values.items()
+                           if isinstance(value, (int, float)) and not isinstance(value, bool))
+        self.integral = tuple(isinstance(values[name], int) for name in self.names)
+        self.size = len(values)
+        self.running = array("d", [0.0]) * (SLOTS * len(self.names))
+        self.count = 0
+        self.samples = [array("d") for _ in self.names] if keep_samples else None
+        self.other = {}
+        self.tags = tags
+
+    def add(self, values):
+        """
+        Fold one sample into the window
+        """
+        running = self.running
+        first = self.count == 0
+        for i, name in enumerate(self.names):
+            value = values[name]
+            base = i * SLOTS
+            if first:
+                running[base + MIN] = running[base + MAX] = value
+            elif value < running[base + MIN]:
+                running[base + MIN] = value
+            elif value > running[base + MAX]:
+                running[base + MAX] = value
+            running[base + SUM] += value
+            running[base + LAST] = value
+            if self.samples is not None:
+                self.samples[i].append(value)
+        if len(self.names) < self.size:
+            for name, value in values.items():
+                if name not in self.names:
+                    self.other[name] = value
+        self.count += 1
+
+    def matches(self, values):
+        """
+        Return True if a sample has the same fields as the window, with numbers in the numeric ones
+        """
+        if len(values) != self.size:
+            return False
+        for name in self.names:
+            value = values.get(name)
+            if value is None or isinstance(value, (str, bool)):
+                return False
+        return True
+
+
+class Aggregator(object):
+    """
+    Downsamples a monitor's output. Metrics are grouped into series by their tags, and for each window of `window`
+    seconds one metric per series is emitted holding the chosen statistics of each numeric field. The last value keeps
+    the field's name, other statistics are suffixed with theirs, e.g. `load_1m_max` or `load_1m_p95`. Non-numeric fields
+    keep their last value.
+
+    Windows are aligned to multiples of `window` in sample time, and a window is emitted when the first sample of the
+    next one arrives, with the window's start as its timestamp.
+    """
+    def __init__(self, window=60, stats=("min", "max", "mean", "last"), percentiles=(), name="aggregate"):
+        """
+        :param window: window length in seconds
+        :param stats: statistics to emit, from min, max, mean, last and count
+        :param percentiles: percentiles to emit, such as [50, 95, 99]
+        """
+        for stat in stats:
+            if stat not in STATS:
+                raise Exception("Invalid aggregate statistic: %s" % stat)
+        self.window = int(window * 10 ** 9)
+        self.stats = tuple(stats)
+        self.percentiles = tuple(float(pct) for pct in percentiles)
+        self.logger = logging.getLogger("monitordaemon.aggregate.%s" % name)
+        self.series = {}  # tags key -> Window
+        self.current = None  # index of the window being filled, timestamp // self.window
+
+    @classmethod
+    def from_config(cls, conf, name="aggregate"):
+        """
+        Create an aggregator from the `aggregate` section of a monitor's config
+        """
+        return cls(window=float(conf.get("window", 60)),
+                   stats=conf.get("stats", ("min", "max", "mean", "last")),
+                   percentiles=conf.get("percentiles", ()),
+                   name=name)
+
+    def extend_mapping(self, mapping):
+        """
+        Return an elasticsearch mapping covering the fields emitted for a monitor with the passed mapping
+        """
+        result = dict(mapping)
+        for name, field in mapping.items():
+            if field.get("type") not in ("long", "integer", "short", "byte", "double", "float"):
+                continue
+            for stat in self.stats:
+                if stat == "mean":
+                    result[name + "_mean"] = {"type": "double"}
+                elif stat == "count":
+                    result[name + "_count"] = {"type": "long"}
+                elif stat != "last":
+                    result["%s_%s" % (name, stat)] = field
+            for pct in self.percentiles:
+                result["%s_p%g" % (name, pct)] = {"type": "double"}
+        return result
+
+    def process(self, metric):
+        """
+        Add a metric to its series' window
+        :return: list of aggregated metrics, which is empty unless this metric started a new window
+        """
+        index = metric.timestamp // self.window
+        result = []
+        if index != self.current:
+            result = self.flush()
+            self.current = index
+        key = tuple(sorted(metric.tags.items()))
+        window = self.series.get(key)
+        if window is None:
+            window = self.series[key] = Window(metric.values, metric.tags, bool(self.percentiles))
+        elif not window.matches(metric.values):
+            # the series' fields changed, so close its window early rather than mixing them
+            result.append(self.summarize(window))
+            window = self.series[key] = Window(metric.values, metric.tags, bool(self.percentiles))
+        window.add(metric.values)
+        return result
+
+    def flush(self):
+        """
+        Emit and reset every series' window
+        """
+        result = [self.summarize(window) for window in self.series.values() if window.count]
+        self.series = {}
+        if result:
+            self.logger.debug("emitting %s aggregated series", len(result))
+        return result
+
+    def summarize(self, window):
+        """
+        Return the Metric for a filled window
+        """
+        values = dict(window.other)
+        running = window.running
+        for i, name in enumerate(window.names):
+            base = i * SLOTS
+            convert = int if window.integral[i] else float
+            for stat in self.stats:
+                if stat == "last":
+                    values[name] = convert(running[base + LAST])
+                elif stat == "min":
+                    values[name + "_min"] = convert(running[base + MIN])
+                elif stat == "max":
+                    values[name + "_max"] = convert(running[base + MAX])
+                elif stat == "mean":
+                    values[name + "_mean"] = running[base + SUM] / window.count
+                elif stat == "count":
+                    values[name + "_count"] = window.count
+            if self.percentiles:
+                samples = sorted(window.samples[i])
+                for pct in self.percentiles:
+                    values["%s_p%g" % (name, pct)] = percentile(samples, pct)
+        return Metric(values, dict(window.tags), self.current * self.window)
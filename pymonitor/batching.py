@@ -0,0 +1,123 @@
+from threading import Thread, Condition
+from collections import deque
+from time import monotonic
+import traceback
+import logging
+import random
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    """
+    Return how many seconds to wait before retry number `attempt` (counting from 1) of a failed request. The delay
+    grows exponentially from `base` up to `cap`, with full jitter so many hosts retrying at once spread out.
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class Batcher(object):
+    """
+    Accumulates items destined for a backend and hands them to a flush function in batches. A batch is sealed when it
+    holds `max_items` items or `max_bytes` bytes, or when its oldest item is `max_age` seconds old. Sealed batches are
+    flushed by `workers` background threads.
+    """
+    def __init__(self, flush_func, max_items=500, max_bytes=5 * 1024 * 1024, max_age=5.0, workers=1,
+                 max_pending=None, name="batcher"):
+        """
+        :param flush_func: callable accepting a list of items
+        :param max_items: item count at which a batch is sealed
+        :param max_bytes: total item size at which a batch is sealed
+        :param max_age: seconds after the first item is added at which a batch is sealed
+        :param workers: number of threads concurrently calling flush_func
+        :param max_pending: number of sealed batches that may wait for a worker before add() blocks
+        """
+        self.flush_func = flush_func
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_pending = max_pending or workers * 2
+        self.logger = logging.getLogger("monitordaemon.batcher.%s" % name)
+
+        self.lock = Condition()
+        self.current = []
+        self.current_bytes = 0
+        self.current_started = None
+        self.ready = deque()
+        self.inflight = 0
+        self.alive = True
+
+        self.workers = [Thread(target=self.worker, name="%s-%s" % (name, i), daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def add(self, item, size=0):
+        """
+        Append an item to the current batch, blocking while too many sealed batches are waiting to be flushed
+        :param item: object passed through to flush_func
+        :param size: size in bytes of the item, used for the byte-based flush trigger
+        """
+        with self.lock:
+            while len(self.ready) >= self.max_pending and self.alive:
+                self.lock.wait()
+            if not self.current:
+                self.current_started = monotonic()
+                self.lock.notify_all()  # wake workers so they start timing this batch
+            self.current.append(item)
+            self.current_bytes += size
+            if len(self.current) >= self.max_items or self.current_bytes >= self.max_bytes:
+                self._seal()
+
+    def _seal(self):
+        """
+        Move the current batch to the ready queue. Must be called with the lock held.
+        """
+        if self.current:
+            self.ready.append(self.current)
+            self.current = []
+            self.current_bytes = 0
+            self.current_started = None
+            self.lock.notify_all()
+
+    def worker(self):
+        """
+        Wait for sealed (or expired) batches and pass them to the flush function
+        """
+        while True:
+            with self.lock:
+                while not self.ready:
+                    if self.current and monotonic() - self.current_started >= self.max_age:
+                        self._seal()
+                        break
+                    if not self.alive:
+                        return
+                    self.lock.wait(self.current_started + self.max_age - monotonic() if self.current else None)
+                batch = self.ready.popleft()
+                self.inflight += 1
+                self.lock.notify_all()
+            try:
+                self.flush_func(batch)
+            except Exception:
+                self.logger.error("flushing batch of %s failed: %s", len(batch), traceback.format_exc())
+            finally:
+                with self.lock:
+                    self.inflight -= 1
+                    self.lock.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Seal the current batch and wait until every pending batch has been flushed
+        :return: True if all batches were flushed before the timeout
+        """
+        with self.lock:
+            self._seal()
+            return self.lock.wait_for(lambda: not self.ready and not self.inflight, timeout)
+
+    def close(self, timeout=None):
+        """
+        Flush all pending data and stop the worker threads
+        """
+        self.flush(timeout)
+        with self.lock:
+            self.alive = False
+            self.lock.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
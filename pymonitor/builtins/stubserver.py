@@ -0,0 +1,133 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from pymonitor.remotewrite import snappy, snappy_decompress, decode_write_request
+import json
+import gzip
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Accepts elasticsearch, influxdb and prometheus remote write requests, counts them and answers as the real server
+    would on success
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        wire = len(self.requestline) + 2 + len(str(self.headers)) + len(body)
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        elif encoding == "snappy":
+            body = snappy.decompress(body) if snappy else snappy_decompress(body)
+        self.server.record(wire, len(body))
+
+        path = self.path.partition("?")[0]
+        if path == "/api/v1/write":
+            self.server.received(decode_write_request(body))
+            self.reply(204)
+        elif path == "/write":
+            self.reply(204)
+        elif path == "/query":
+            self.reply(200, b'{"results":[{"statement_id":0}]}')
+        elif path.endswith("/_bulk"):
+            count = body.count(b"\n") // 2
+            self.reply(200, json.dumps({"took": 1, "errors": False,
+                                        "items": [{"index": {"status": 201}}] * count}).encode())
+        else:
+            self.reply(200, b"{}")
+
+    do_GET = do_POST = do_PUT = do_HEAD = do_request
+
+    def reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local http server standing in for a metrics backend, for testing and benchmarking the backends' transport without a
+    real database. Tracks the number of requests, the bytes received on the wire and the bytes after decompression.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, StubHandler)
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.samples = 0
+        self.series = {}  # labels -> samples, of remote writes
+
+    def record(self, wire, body):
+        with self.lock:
+            self.requests += 1
+            self.wire_bytes += wire
+            self.body_bytes += body
+
+    def received(self, series):
+        with self.lock:
+            for labels, samples in series:
+                self.series.setdefault(tuple(sorted(labels.items())), []).extend(samples)
+                self.samples += len(samples)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        Thread(target=self.serve_forever, name="stubserver", daemon=True).start()
+
+
+if __name__ == '__main__':
+    # Benchmark: bytes on the wire and throughput of each backend's http transport, with and without compression
+    from pymonitor import Metric
+    from pymonitor.elasticsearch import ESBackend
+    from pymonitor.influxdb import InfluxBackend
+    from pymonitor.remotewrite import RemoteWriteBackend
+    from types import SimpleNamespace
+    from time import monotonic, time_ns
+    import sys
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    server = StubServer()
+    server.start()
+    master = SimpleNamespace(monitors=[])
+
+    def metrics():
+        now = time_ns()
+        for i in range(count):
+            yield Metric({"reads": 1000 + i, "writes": 2000 + i, "read_ps": 12.5, "write_ps": 80.25, "util": 3.1,
+                          "await": 0.42, "inflight": 0}, {"type": "diskio", "device": "sd%s" % chr(97 + i % 8)},
+                         now + i * 10 ** 6)
+
+    # remote write requests are always snappy compressed
+    for name, backend_class, conf, modes in [
+            ("elasticsearch", ESBackend, {"url": "http://127.0.0.1:%s" % server.port}, (False, True)),
+            ("influxdb", InfluxBackend, {"host": "127.0.0.1", "port": server.port, "user": "", "password": ""},
+             (False, True)),
+            ("remotewrite", RemoteWriteBackend, {"url": "http://127.0.0.1:%s/api/v1/write" % server.port}, (True,))]:
+        for compress in modes:
+            backend = backend_class(master, dict(conf, compress=compress))
+            backend.connect()
+            server.reset()
+            start = monotonic()
+            for metric in metrics():
+                backend.add_data(metric)
+            backend.close()
+            elapsed = monotonic() - start
+            print("%-13s compress=%-5s  %4d requests  %8.1f KB on wire (%6.1f B/metric, %8.1f KB raw)  %8.0f metrics/s"
+                  % (name, compress, server.requests, server.wire_bytes / 1024, server.wire_bytes / count,
+                     server.body_bytes / 1024, count / elapsed))
+    server.shutdown()
@@ -1,3 +1,4 @@
+import os
 from subprocess import Popen, PIPE
 
 
@@ -13,3 +14,39 @@ def hostname():
     Return system hostname from hostname -f
     """
     return Popen(["hostname", "-f"], stdout=PIPE).communicate()[0].decode().strip()
+
+
+_id_maps = {}
+
+
+def id_map(path):
+    """
+    Return a dict of id -> name parsed from a passwd(5) or group(5) style file. The result is cached until the file's
+    mtime changes.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _id_maps.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    names = {}
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split(":")
+            if len(fields) > 2 and fields[2].isdigit():
+                names[int(fields[2])] = fields[0]
+    _id_maps[path] = (mtime, names)
+    return names
+
+
+def users():
+    """
+    Return a dict of uid -> username
+    """
+    return id_map("/etc/passwd")
+
+
+def groups():
+    """
+    Return a dict of gid -> group name
+    """
+    return id_map("/etc/group")
@@ -0,0 +1,142 @@
+from pymonitor import Metric
+from pymonitor import telemetry
+from collections import OrderedDict
+import logging
+
+
+OTHER = "other"
+
+
+class Tracker(object):
+    """
+    The distinct keys seen within the last `ttl` nanoseconds, at most `limit` of them, ordered from least to most
+    recently seen. Checking a key is a dict lookup and a move to the end; keys are expired from the front, each at most
+    once, so expiry is O(1) per key over time.
+    """
+    __slots__ = ("limit", "ttl", "seen")
+
+    def __init__(self, limit, ttl):
+        self.limit = limit
+        self.ttl = ttl
+        self.seen = OrderedDict()  # key -> timestamp last seen
+
+    def admit(self, key, now):
+        """
+        Record a sighting of a key
+        :return: False if the key is new and the tracker is full of keys seen within the ttl
+        """
+        seen = self.seen
+        if key in seen:
+            seen[key] = now
+            seen.move_to_end(key)
+            return True
+        cutoff = now - self.ttl
+        while seen and next(iter(seen.values())) < cutoff:
+            seen.popitem(last=False)
+        if len(seen) >= self.limit:
+            return False
+        seen[key] = now
+        return True
+
+
+class Limiter(object):
+    """
+    Caps the number of distinct series a monitor emits, so hosts with thousands of short lived interfaces or mounts
+    don't flood the backend with series. At most `max_series` tag combinations are let through, and optionally at most
+    a given number of distinct values for particular tag keys. Series not seen for `ttl` seconds stop counting towards
+    the limits.
+
+    Metrics over a limit are dropped, or with the `other` overflow action have the offending tags replaced by "other"
+    and their numeric fields summed into one metric per resulting series and run. That metric is emitted when the next
+    run's first metric arrives, with the timestamp of the run it sums.
+    """
+    OVERFLOWS = ("other", "drop")
+
+    def __init__(self, max_series=1000, keys=None, ttl=3600, overflow="other", name="cardinality"):
+        """
+        :param max_series: most distinct tag combinations let through, or 0 for no limit
+        :param keys: dict of tag key -> most distinct values of that tag let through
+        :param ttl: seconds after which a series or tag value not seen since is forgotten
+        :param overflow: `other` to roll metrics over a limit up into "other" series, `drop` to discard them
+        """
+        if overflow not in self.OVERFLOWS:
+            raise Exception("Invalid cardinality overflow action: %s" % overflow)
+        self.ttl = int(ttl * 10 ** 9)
+        self.series = Tracker(max_series, self.ttl) if max_series else None
+        self.keys = {key: Tracker(int(limit), self.ttl) for key, limit in (keys or {}).items()}
+        self.overflow = overflow
+        self.logger = logging.getLogger("monitordaemon.cardinality.%s" % name)
+        self.rollups = {}  # tags key -> Metric summing this run's overflow
+        self.rollup_time = None
+        self.warned = False
+        self.rolled_up = telemetry.counter("cardinality_overflow", monitor=name, outcome="other")
+        self.dropped = telemetry.counter("cardinality_overflow", monitor=name, outcome="dropped")
+
+    @classmethod
+    def from_config(cls, conf, name="cardinality"):
+        """
+        Create a limiter from the `cardinality` section of a monitor's config
+        """
+        return cls(max_series=int(conf.get("max_series", 1000)),
+                   keys=conf.get("keys"),
+                   ttl=float(conf.get("ttl", 3600)),
+                   overflow=conf.get("overflow", "other"),
+                   name=name)
+
+    def process(self, metric):
+        """
+        :return: a list holding the metric if it is within the limits, preceded by the previous run's rollups if this
+                 metric starts a new run
+        """
+        result = self.flush() if self.rollups and metric.timestamp != self.rollup_time else []
+        tags = metric.tags
+        now = metric.timestamp
+        over = []
+        for key, tracker in self.keys.items():
+            value = tags.get(key)
+            if value is not None and value != OTHER and not tracker.admit(value, now):
+                over.append(key)
+        if not over and self.series is not None and not self.series.admit(tuple(sorted(tags.items())), now):
+            over = [key for key in tags if key != "type"]
+        if not over:
+            result.append(metric)
+            return result
+
+        if not self.warned:
+            self.warned = True
+            self.logger.warning("cardinality limit reached by %s, %s series over it", metric,
+                                "rolling up" if self.overflow == "other" else "dropping")
+        if self.overflow == "drop":
+            self.dropped.inc()
+        else:
+            self.rolled_up.inc()
+            self.roll_up(metric, over)
+        return result
+
+    def roll_up(self, metric, keys):
+        """
+        Add a metric's numeric fields to the rollup of the series it becomes once `keys` are set to "other"
+        """
+        tags = dict(metric.tags)
+        for key in keys:
+            tags[key] = OTHER
+        key = tuple(sorted(tags.items()))
+        rollup = self.rollups.get(key)
+        if rollup is None:
+            values = {name: value for name, value in metric.values.items()
+                      if isinstance(value, (int, float)) and not isinstance(value, bool)}
+            self.rollups[key] = Metric(values, tags, metric.timestamp)
+            self.rollup_time = metric.timestamp
+            return
+        values = rollup.values
+        for name, value in metric.values.items():
+            if name in values and isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[name] += value
+
+    def flush(self):
+        """
+        Return the rollups being summed
+        """
+        rollups = list(self.rollups.values())
+        self.rollups = {}
+        return rollups
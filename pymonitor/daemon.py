@@ -1,27 +1,90 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from threading import Thread
-from time import time, sleep
-import traceback
+from queue import SimpleQueue
+from time import time, time_ns, monotonic
 import logging
 import json
 import sys
 import os
 from pymonitor.elasticsearch import ESBackend
 from pymonitor.influxdb import InfluxBackend
+from pymonitor.prometheus import PrometheusBackend
+from pymonitor.remotewrite import RemoteWriteBackend
+from pymonitor.outbound import OutboundQueue
+from pymonitor.scheduler import Scheduler, Job, host_offset
+from pymonitor.spool import Replayer
+from pymonitor.cardinality import Limiter
+from pymonitor.aggregate import Aggregator
+from pymonitor.dedup import Deduplicator
+from pymonitor.workers import ProcessWorker, WorkerError
+from pymonitor import rates
+from pymonitor import telemetry
+from pymonitor import profiling
+
+
+BACKENDS = {"elasticsearch": ESBackend,
+            "influxdb": InfluxBackend,
+            "prometheus": PrometheusBackend,
+            "remotewrite": RemoteWriteBackend}
+
+
+class Destination(object):
+    """
+    A backend with an outbound queue, and a replayer if it spools, of its own. Every destination receives all metrics
+    and delivers them independently, so a slow or failing backend doesn't hold up the others.
+    """
+    def __init__(self, master, conf):
+        self.name = conf.get("name", conf["type"])
+        self.backend = BACKENDS[conf["type"]](master, conf)
+        self.queue = OutboundQueue.from_config(self.backend, conf.get("queue", {}), name=self.name)
+        self.replayer = None
+        if self.backend.spool:
+            spool_conf = conf["spool"]
+            self.replayer = Replayer(self.backend, self.queue, rate=float(spool_conf.get("replay_rate", 1000)),
+                                     batch=int(spool_conf.get("replay_batch", 500)), name="replayer-%s" % self.name)
+
+    def start(self):
+        self.backend.connect()
+        self.queue.start()
+        if self.replayer:
+            self.replayer.start()
+
+    def close(self):
+        """
+        Deliver everything queued and release the backend
+        """
+        if self.replayer:
+            self.replayer.stop()
+        self.queue.close()
+        self.backend.close()
 
 
 class MonitorDaemon(Thread):
     def __init__(self, config):
         Thread.__init__(self)
         self.config = config
-        self.threads = []
-        self.backend = {"elasticsearch": ESBackend,
-                        "influxdb": InfluxBackend}[self.config["backend"]["type"]](self, self.config["backend"])
+        self.monitors = []
+        # `backends` lists several backends to write to, `backend` a single one
+        self.destinations = []
+        for conf in self.config["backends"] if "backends" in self.config else [self.config["backend"]]:
+            if conf["type"] not in BACKENDS:
+                raise Exception("Invalid backend type: %s" % conf["type"])
+            destination = Destination(self, conf)
+            if any(other.name == destination.name for other in self.destinations):
+                raise Exception("Duplicate backend name %s, set a unique `name` for each" % destination.name)
+            self.destinations.append(destination)
+        scheduler_conf = self.config.get("scheduler", {})
+        self.scheduler = Scheduler(workers=int(scheduler_conf.get("workers", 4)))
+        self.jitter = float(scheduler_conf.get("jitter", 0))
+        if "state_dir" in self.config:
+            rates.configure(self.config["state_dir"])
+        self.profiler = profiling.Profiler.from_config(self.config.get("profiling", {}))
 
     def run(self):
         """
-        Start all monitoring threads and block until they exit
+        Schedule all monitors and block until the scheduler exits
         """
         logger = logging.getLogger("monitordaemon")
 
@@ -29,88 +92,257 @@ class MonitorDaemon(Thread):
         sys.path.append(checkerPath)
         logger.debug("path %s" % checkerPath)
 
-        # Create all monitoring threads
-        logger.debug("creating monitor threads")
+        # Load all monitors
+        logger.debug("loading monitors")
         for instance in self.config["monitors"]:
-            monitor_thread = MonitorThread(instance, self.backend)
-            self.threads.append(monitor_thread)
+            self.monitors.append(Monitor(instance, [destination.queue for destination in self.destinations]))
 
-        # Setup backend
-        self.backend.connect()
+        # Setup backends
+        for destination in self.destinations:
+            destination.start()
 
-        logger.debug("starting monitor threads")
-        for monitor_thread in self.threads:
-            monitor_thread.start()
+        logger.debug("scheduling monitors")
+        for i, monitor in enumerate(self.monitors):
+            interval = float(monitor.config["freq"])
+            offset = float(monitor.config["offset"]) if "offset" in monitor.config else \
+                host_offset("%s-%s" % (monitor.config["type"], i), interval, self.jitter)
+            monitor.job = Job(monitor.config["type"], monitor.run, interval, offset)
+            self.scheduler.add(monitor.job)
 
-        # Tear down all threads
-        logger.debug("joining monitor threads")
-        for monitor_thread in self.threads:
-            monitor_thread.join()
+        self.scheduler.run()
 
-        logger.debug("joined monitor threads")
+        logger.debug("scheduler exited")
+        self.profiler.stop()
+        for monitor in self.monitors:
+            monitor.close()
+            monitor.flush()
+            logger.info("%s stats: %s", monitor.config["type"], monitor.stats())
+        rates.save_all()
+        # close the destinations side by side, so a slow backend doesn't delay delivering the others' last metrics
+        closers = [Thread(target=destination.close, name="close-%s" % destination.name)
+                   for destination in self.destinations]
+        for closer in closers:
+            closer.start()
+        for closer, destination in zip(closers, self.destinations):
+            closer.join()
+            logger.info("%s backend stats: %s", destination.name, destination.backend.stats())
 
     def shutdown(self):
         """
-        Signal all monitoring threads to stop
+        Stop scheduling monitors
         """
-        for monitor_thread in self.threads:
-            monitor_thread.shutdown()
+        self.scheduler.shutdown()
 
 
-class MonitorThread(Thread):
-    def __init__(self, config, backend):
+class Monitor(object):
+    MODES = ("inline", "thread", "process")
+
+    def __init__(self, config, queues):
         """
-        Load checker function and prepare scheduler
+        Load checker function
+        :param queues: the outbound queue of each backend
         """
-        Thread.__init__(self)
         self.config = config
-        self.backend = backend
-        self.logger = logging.getLogger("monitordaemon.monitorthread.%s" % self.config["type"])
-        self.logger.debug("initing worker thread with config %s" % self.config)
+        self.queues = queues
+        self.logger = logging.getLogger("monitordaemon.monitor.%s" % self.config["type"])
+        self.logger.debug("initing monitor with config %s" % self.config)
 
         self.logger.debug("importing %s" % self.config["type"])
         self.imported = __import__(self.config["type"])
         self.checker_func = getattr(self.imported, self.config["type"])
         self.logger.debug("checker func %s" % self.checker_func)
+        self.mapping = dict(getattr(self.imported, "mapping", {}))
 
-        self.alive = True
-        self.delay = int(self.config["freq"])
-        self.lastRun = 0
+        # Stages each metric passes through, in order, between the checker function and the queue. Each has a
+        # process(metric) method and a flush() method, both returning the metrics to pass on.
+        self.stages = []
+        if "cardinality" in self.config:
+            self.stages.append(Limiter.from_config(self.config["cardinality"], name=self.config["type"]))
+        if "aggregate" in self.config:
+            aggregator = Aggregator.from_config(self.config["aggregate"], name=self.config["type"])
+            self.mapping = aggregator.extend_mapping(self.mapping)
+            self.stages.append(aggregator)
+        if "dedup" in self.config:
+            self.stages.append(Deduplicator.from_config(self.config["dedup"], float(self.config["freq"]),
+                                                        name=self.config["type"]))
+
+        # How runs are executed: `inline` on the scheduler's worker thread, `thread` on a thread of the monitor's own,
+        # or `process` in a worker process of its own. Runs are stopped after `timeout` seconds. Inline runs have no
+        # timeout unless one is configured: a checker that yields everything at the end would otherwise lose whole
+        # runs that take longer than `freq`, which the scheduler already counts as overruns.
+        self.mode = self.config.get("mode", "inline")
+        if self.mode not in self.MODES:
+            raise Exception("Invalid monitor mode: %s" % self.mode)
+        if "timeout" in self.config:
+            self.timeout = float(self.config["timeout"])
+        else:
+            self.timeout = None if self.mode == "inline" else float(self.config["freq"])
+        self.job = None  # set by the daemon when scheduled
+        self.requests = None
+        self.pending = None
+        self.worker = None
+        if self.mode == "thread":
+            # a daemon thread, so one stuck in a checker function can't hold up exit
+            self.requests = SimpleQueue()
+            Thread(target=self.thread_main, name="monitor-%s" % self.config["type"], daemon=True).start()
+        elif self.mode == "process":
+            self.worker = ProcessWorker(self.config["type"], [os.path.dirname(self.imported.__file__)],
+                                        rates.state_dir, name=self.config["type"])
+            self.worker.start()
+        self.timeouts = 0
+        self.errors = 0
+        self.skipped = 0
+        self.runtime = 0.0
+        name = self.config["type"]
+        self.collect_seconds = telemetry.histogram("collect_seconds", monitor=name)
+        self.metrics_per_run = telemetry.histogram("metrics_per_run", telemetry.SIZE_BUCKETS, monitor=name)
+        telemetry.gauge("monitor", self.stats, monitor=name)
 
     def run(self):
         """
-        Call execute method every x seconds forever
+        Called by the scheduler each interval
         """
-        self.logger.debug("starting scheduler")
-        while self.alive:
-            if time() - self.lastRun > self.delay:
-                self.lastRun = time()
+        args = self.config["args"]
+        deadline = monotonic() + self.timeout if self.timeout else None
+        try:
+            if self.mode == "inline":
+                completed = self.execute(args, deadline)
+            elif self.mode == "thread":
+                if self.pending and not self.pending.done():
+                    self.skipped += 1
+                    self.logger.warning("previous run is still stuck, skipping this run")
+                    return
+                self.pending = Future()
+                self.requests.put((self.pending, args, deadline))
                 try:
-                    self.execute(self.config["args"])
-                except:
-                    tb = traceback.format_exc()
-                    self.logger.warning(tb)
-            sleep(0.5)
-        self.logger.debug("scheduler exited")
+                    completed = self.pending.result(self.timeout)
+                except FutureTimeoutError:
+                    completed = False
+            else:
+                completed = self.execute_process(args)
+        except Exception:
+            self.errors += 1
+            raise
+        if not completed:
+            self.timeouts += 1
+            self.logger.warning("run stopped after reaching its %ss timeout", self.timeout)
 
-    def execute(self, args):
+    def thread_main(self):
+        """
+        Execute runs requested by run() in `thread` mode
         """
-        Run the loaded checker function. Pass each Metric object yielded to the backend.
+        while True:
+            future, args, deadline = self.requests.get()
+            if future is None:
+                return
+            try:
+                future.set_result(self.execute(args, deadline))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def execute(self, args, deadline=None):
+        """
+        Run the checker function through collect(), under cProfile while a profile of monitor runs is being recorded
+        """
+        if profiling.recorder:
+            return profiling.recorder.runcall(self.collect, args, deadline)
+        return self.collect(args, deadline)
+
+    def collect(self, args, deadline=None):
+        """
+        Run the loaded checker function. Queue each Metric object yielded for the backend. Everything yielded in one
+        run shares a timestamp, taken when the run starts. If the deadline (on the monotonic clock) passes, the checker
+        function is stopped at the next metric it yields.
+        :return: False if the run was stopped by the deadline
         """
         before = time()
-        for result in self.checker_func(**args):
-            result.tags.update(type=self.config["type"])
-            self.logger.debug("result: %s" % (result,))
-            self.backend.add_data(result)
-        duration = time() - before
-        self.logger.info("runtime: %.3f" % duration)
+        timestamp = time_ns()
+        count = 0
+        results = iter(self.checker_func(**args))
+        for result in results:
+            if deadline and monotonic() > deadline:
+                if hasattr(results, "close"):
+                    results.close()
+                return False
+            result.tags["type"] = self.config["type"]
+            if result.timestamp is None:
+                result.timestamp = timestamp
+            self.logger.debug("result: %s", result)
+            self.emit([result])
+            count += 1
+        self.finished(time() - before, count)
+        return True
 
-    def shutdown(self):
+    def execute_process(self, args):
+        """
+        Run the checker function in the monitor's worker process and queue the metrics it returns
+        :return: False if the run was stopped by the timeout
+        """
+        before = time()
+        timestamp = time_ns()
+        try:
+            results = self.worker.call(args, self.timeout)
+        except TimeoutError:
+            return False
+        except WorkerError as e:
+            raise Exception("worker failed: %s" % e)
+        for result in results:
+            result.tags["type"] = self.config["type"]
+            if result.timestamp is None:
+                result.timestamp = timestamp
+            self.emit([result])
+        self.finished(time() - before, len(results))
+        return True
+
+    def finished(self, runtime, count):
+        """
+        Record a completed run
+        """
+        self.runtime = runtime
+        self.collect_seconds.observe(runtime)
+        self.metrics_per_run.observe(count)
+        self.logger.debug("runtime: %.3f, %s metrics", runtime, count)
+
+    def stats(self):
+        """
+        Return counters describing the monitor's runs
+        """
+        stats = {"timeouts": self.timeouts, "errors": self.errors, "skipped": self.skipped,
+                 "runtime": round(self.runtime, 6)}
+        if self.job:
+            stats.update(runs=self.job.runs, overruns=self.job.overruns, skipped=self.skipped + self.job.skipped)
+        if self.worker:
+            stats["restarts"] = self.worker.restarts
+        return stats
+
+    def close(self):
+        """
+        Release the monitor's thread or worker process
+        """
+        if self.requests:
+            self.requests.put((None, None, None))
+        if self.worker:
+            self.worker.stop()
+
+    def emit(self, metrics, stage=0):
+        """
+        Pass metrics through the stages from `stage` onwards, then queue what comes out for every backend. Backends
+        share the same Metric objects, and each serializes them once in its own format.
+        """
+        if stage == len(self.stages):
+            for metric in metrics:
+                for queue in self.queues:
+                    queue.put(metric)
+            return
+        for metric in metrics:
+            self.emit(self.stages[stage].process(metric), stage + 1)
+
+    def flush(self):
         """
-        Tell thread to exit
+        Push any data held by the stages through to the queue, for use at shutdown
         """
-        self.logger.debug("canceling scheduler")
-        self.alive = False
+        for stage, instance in enumerate(self.stages):
+            self.emit(instance.flush(), stage + 1)
 
 
 def main():
@@ -145,6 +377,7 @@ def main():
     logger.debug("starting daemon with conf: %s" % conf)
 
     daemon = MonitorDaemon(conf)
+    daemon.profiler.install()
     try:
         daemon.start()
         daemon.join()
@@ -0,0 +1,103 @@
+import logging
+
+
+class Series(object):
+    """
+    The last values sent for a series and how many samples have been suppressed since
+    """
+    __slots__ = ("values", "suppressed", "seen")
+
+    def __init__(self, values, seen):
+        self.values = values
+        self.suppressed = 0
+        self.seen = seen
+
+
+class Deduplicator(object):
+    """
+    Suppresses metrics whose values have not changed since they were last sent. Metrics are grouped into series by their
+    tags, and a metric is suppressed when every field equals the series' last sent value, or for numbers is within
+    `abs_tolerance` or `rel_tolerance` (a fraction of the last sent value) of it. Comparing against the last sent rather
+    than the last seen value keeps slow drifts from going unreported. At least one in `heartbeat` samples of a series is
+    always sent, so its latest value is never older than that many intervals.
+    """
+    def __init__(self, interval, heartbeat=10, abs_tolerance=0, rel_tolerance=0, name="dedup"):
+        """
+        :param interval: the monitor's interval in seconds, used to forget series that stop reporting
+        :param heartbeat: send a series' sample after at most this many samples
+        :param abs_tolerance: largest absolute change in a number considered unchanged
+        :param rel_tolerance: largest change in a number, relative to the last sent value, considered unchanged
+        """
+        self.heartbeat = max(1, int(heartbeat))
+        self.abs_tolerance = abs_tolerance
+        self.rel_tolerance = rel_tolerance
+        self.expiry = int(interval * self.heartbeat * 2 * 10 ** 9)
+        self.logger = logging.getLogger("monitordaemon.dedup.%s" % name)
+        self.series = {}  # tags key -> Series
+        self.next_expire = 0
+        self.sent = 0
+        self.suppressed = 0
+
+    @classmethod
+    def from_config(cls, conf, interval, name="dedup"):
+        """
+        Create a deduplicator from the `dedup` section of a monitor's config
+        """
+        return cls(interval,
+                   heartbeat=int(conf.get("heartbeat", 10)),
+                   abs_tolerance=float(conf.get("abs_tolerance", 0)),
+                   rel_tolerance=float(conf.get("rel_tolerance", 0)),
+                   name=name)
+
+    def unchanged(self, values, last):
+        """
+        Return True if every field of a sample is equal to, or within tolerance of, the last sent one
+        """
+        if len(values) != len(last):
+            return False
+        for name, value in values.items():
+            previous = last.get(name)
+            if value == previous:
+                continue
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or \
+                    isinstance(value, bool) or isinstance(previous, bool):
+                return False
+            change = abs(value - previous)
+            if change > self.abs_tolerance and change > self.rel_tolerance * abs(previous):
+                return False
+        return True
+
+    def process(self, metric):
+        """
+        :return: a list holding the metric if it should be sent, or an empty list
+        """
+        if metric.timestamp >= self.next_expire:
+            self.expire(metric.timestamp)
+        key = tuple(sorted(metric.tags.items()))
+        series = self.series.get(key)
+        if series is None:
+            self.series[key] = Series(metric.values, metric.timestamp)
+        else:
+            series.seen = metric.timestamp
+            if series.suppressed + 1 < self.heartbeat and self.unchanged(metric.values, series.values):
+                series.suppressed += 1
+                self.suppressed += 1
+                return []
+            series.values = metric.values
+            series.suppressed = 0
+        self.sent += 1
+        return [metric]
+
+    def expire(self, now):
+        """
+        Forget series that have not reported for two heartbeats
+        """
+        self.next_expire = now + self.expiry // 2
+        for key in [key for key, series in self.series.items() if now - series.seen > self.expiry]:
+            del self.series[key]
+
+    def flush(self):
+        """
+        Nothing is held back for later, so there is nothing to flush
+        """
+        return []
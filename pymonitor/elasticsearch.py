@@ -1,84 +1,223 @@
 from pymonitor import Backend
+from pymonitor.batching import Batcher, backoff
+from time import sleep, monotonic
 import datetime
 import json
 
 
+COMPACT = (",", ":")
+NS_PER_DAY = 86400 * 10 ** 9
+
+
 class ESBackend(Backend):
+    INDEX_MODES = ("daily", "rollover", "datastream")
+
     def __init__(self, master, conf):
         """
         Init elasticsearch client
         """
         super().__init__(master, conf)
         self.mapping = {}
-        self.current_index = None
+        self.batcher = None
+        self.retries = int(self.conf.get("retries", 3))
+        self.retry_backoff = float(self.conf.get("retry_backoff", 0.5))
+        self.sysinfo_fields = json.dumps(self.sysinfo, separators=COMPACT)[1:-1]
+
+        self.index_mode = self.conf.get("index_mode", "daily")
+        if self.index_mode not in self.INDEX_MODES:
+            raise Exception("Invalid elasticsearch index mode: %s" % self.index_mode)
+        self.rollover_alias = self.conf.get("rollover_alias", "monitor-write")
+        self.rollover_conditions = self.conf.get("rollover_conditions", {"max_age": "1d", "max_size": "50gb"})
+        self.rollover_interval = float(self.conf.get("rollover_interval", 300))
+        self.next_rollover = 0
+        self.data_stream = self.conf.get("data_stream", "metrics-pymonitor-default")
+
+        # (start, end, action): documents with timestamps in [start, end) use this bulk action line
+        if self.index_mode == "rollover":
+            self.route = (0, 2 ** 63, self.make_action("index", self.rollover_alias))
+        elif self.index_mode == "datastream":
+            self.route = (0, 2 ** 63, self.make_action("create", self.data_stream))
+        else:
+            self.route = (0, 0, None)
 
     def connect(self):
         self.logger.debug("connecting to elasticsearch at %s" % self.conf["url"])
         from elasticsearch import Elasticsearch
-        self.es = Elasticsearch([self.conf["url"]])
+        # Retries are handled in send_bulk, with backoff
+        self.es = Elasticsearch([self.conf["url"]],
+                                http_compress=bool(self.conf.get("compress", False)),
+                                maxsize=int(self.conf.get("pool_size", 10)),
+                                timeout=float(self.conf.get("timeout", 10)),
+                                max_retries=0)
         self.logger.debug("connected to backend")
 
-        for monitor_thread in self.master.threads:
-            self.mapping.update(monitor_thread.imported.mapping)
+        for monitor in self.master.monitors:
+            self.mapping.update(monitor.mapping)
         self.logger.debug("final mapping: ", self.mapping)
-        self.create_mapping_template()
+        if self.index_mode == "datastream":
+            self.create_index_template()
+        else:
+            self.create_mapping_template()
+        if self.index_mode == "rollover":
+            self.bootstrap_rollover()
 
-        self.check_index()
+        self.batcher = Batcher(self.send_bulk,
+                               max_items=int(self.conf.get("bulk_size", 500)),
+                               max_bytes=int(self.conf.get("bulk_bytes", 5 * 1024 * 1024)),
+                               max_age=float(self.conf.get("bulk_age", 5)),
+                               workers=int(self.conf.get("bulk_workers", 1)),
+                               name="elasticsearch")
 
-    def get_index_name(self):
+    def make_action(self, op, index):
         """
-        Return name of current index such as 'monitor-2015.12.05'
+        Return a bulk action line such as '{"index":{"_index":"monitor-2015.12.05","_type":"monitor_data"}}'
         """
-        return "monitor-%s" % datetime.datetime.now().strftime("%Y.%m.%d")
+        meta = {"_index": index}
+        if self.index_mode != "datastream":
+            meta["_type"] = "monitor_data"
+        return json.dumps({op: meta}, separators=COMPACT) + "\n"
 
-    def check_index(self):
+    def index_action(self, timestamp):
         """
-        Called before adding any data to ES. Checks if a new index should be created due to date change
+        Return the bulk action line for a document sampled at the passed epoch time in nanoseconds. In daily mode,
+        documents go to the index for their UTC day, such as 'monitor-2015.12.05'. The current day's bounds are kept so
+        most documents cost a comparison.
         """
-        indexName = self.get_index_name()
-        if indexName != self.current_index:
-            self.create_index(indexName)
+        start, end, action = self.route
+        if start <= timestamp < end:
+            return action
+        day = timestamp // NS_PER_DAY
+        name = "monitor-%s" % datetime.datetime.utcfromtimestamp(day * 86400).strftime("%Y.%m.%d")
+        action = self.make_action("index", name)
+        self.route = (day * NS_PER_DAY, (day + 1) * NS_PER_DAY, action)
+        return action
 
-    def create_index(self, indexName):
+    def bootstrap_rollover(self):
         """
-        Check if current index exists, and if not, create it
+        Create the first index behind the rollover alias, if the alias doesn't exist yet
         """
-        if not self.es.indices.exists(index=indexName):
-            self.es.indices.create(index=indexName, ignore=400)  # ignore already exists error
-        self.current_index = indexName
+        if not self.es.indices.exists_alias(name=self.rollover_alias):
+            self.es.indices.create(index="monitor-000001", body={"aliases": {self.rollover_alias: {}}},
+                                   ignore=400)  # ignore already exists error
 
-    def create_mapping_template(self):
+    def rollover(self):
+        """
+        Ask elasticsearch to start a new index behind the rollover alias if the current one meets the rollover
+        conditions. Called after bulk requests, at most every rollover_interval seconds.
+        """
+        self.next_rollover = monotonic() + self.rollover_interval
+        try:
+            res = self.es.indices.rollover(alias=self.rollover_alias, body={"conditions": self.rollover_conditions})
+        except Exception as e:
+            self.logger.warning("rollover check failed: %s", e)
+            return
+        if res.get("rolled_over"):
+            self.logger.info("rolled over %s to %s", self.rollover_alias, res.get("new_index"))
+
+    def template_mapping(self):
+        """
+        Return the mapping for our documents: the monitors' mappings plus the fields added to every document
+        """
         default_fields = {"ipaddr": {"type": "ip"},  # TODO i dont like how these default fields are handled in general
-                          "hostname": {"type": "text"},
-                          "hostname_raw": {"type": "keyword"},
+                          "hostname": {"type": "keyword"},
+                          "type": {"type": "keyword"},
                           "@timestamp": {"type": "date"}}  #"field": "@timestamp"
 
         fields = dict(**self.mapping)
         fields.update(**default_fields)
+        # We'll likely group by tags on the eventual frontend, and under elasticsearch this works best if the entire
+        # field is handled as a single keyword. Map any string field not in the mapping, such as tags, as a keyword.
+        strings_as_keywords = {"strings": {"match_mapping_type": "string", "mapping": {"type": "keyword"}}}
+        return {"dynamic_templates": [strings_as_keywords], "properties": fields}
+
+    def create_mapping_template(self):
         template = {"index_patterns": ["monitor-*"],
                     "settings": {"number_of_shards": 1},  # TODO shard info from config file
-                    "mappings": {"_default_": {"properties": fields}}}
+                    "mappings": {"_default_": self.template_mapping()}}
         self.logger.debug("creating template with body %s", json.dumps(template, indent=4))
         self.es.indices.put_template(name="monitor", body=template)
 
-    def add_data(self, metric):
+    def create_index_template(self):
         """
-        Submit a piece of monitoring data
+        Create the composable index template a data stream needs (elasticsearch 7.9+)
         """
-        self.check_index()
+        template = {"index_patterns": [self.data_stream],
+                    "data_stream": {},
+                    "priority": 200,  # above the built in metrics-*-* template
+                    "template": {"settings": {"number_of_shards": 1},
+                                 "mappings": self.template_mapping()}}
+        self.logger.debug("creating index template with body %s", json.dumps(template, indent=4))
+        self.es.transport.perform_request("PUT", "/_index_template/pymonitor", body=template)
 
-        metric.tags.update(**self.sysinfo)
-        metric.values["@timestamp"] = datetime.datetime.utcnow().isoformat()
+    def add_data(self, metric):
+        """
+        Queue a piece of monitoring data for the next bulk request
+        """
+        # Write the document's json straight from the metric's dicts rather than merging them into a new one. Fields
+        # must be unique, so tags that repeat a value's name are left out.
+        tags = metric.tags
+        if any(k in metric.values for k in tags):
+            tags = {k: v for k, v in tags.items() if k not in metric.values}
+        fields = [json.dumps(metric.values, separators=COMPACT)[1:-1],
+                  json.dumps(tags, separators=COMPACT)[1:-1],
+                  self.sysinfo_fields,
+                  '"@timestamp":%d' % (metric.timestamp // 10 ** 6)]  # epoch_millis
 
-        metric_dict = {}
-        metric_dict.update(metric.values)
-        metric_dict.update(metric.tags)
+        self.logger.debug("logging type %s: %s", metric.tags["type"], metric)
+        line = "%s{%s}\n" % (self.index_action(metric.timestamp), ",".join(field for field in fields if field))
+        self.batcher.add((metric, line), len(line))
 
-        # We'll likely group by tags on the eventual frontend, and under elasticsearch this works best if the entire
-        # field is handled as a single keyword. Duplicate all tags into ${NAME}_raw fields, expected to be not analyzed
-        for k, v in metric.tags.items():
-            metric_dict["{}_raw".format(k)] = v
+    def send_bulk(self, batch):
+        """
+        Send a batch of (metric, action/document lines) pairs through the _bulk api. Requests that fail with a
+        connection error, 429 or 5xx, and documents rejected with a retryable status, are resent with backoff. Other
+        rejections are logged and dropped. Documents that could not be delivered are passed to failed().
+        """
+        self.batch_size.observe(len(batch))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(backoff(attempt, self.retry_backoff))
+            start = monotonic()
+            try:
+                res = self.es.bulk(body="".join(line for _, line in batch))
+            except Exception as e:
+                self.send_seconds.observe(monotonic() - start)
+                status = getattr(e, "status_code", None)  # "N/A" for connection errors and timeouts
+                if isinstance(status, int) and 400 <= status < 500 and status != 429:
+                    self.logger.warning("bulk request of %s documents rejected: %s", len(batch), e)
+                    self.refused(len(batch))
+                    return
+                self.logger.warning("bulk request failed (attempt %s): %s", attempt + 1, e)
+                continue
+            self.send_seconds.observe(monotonic() - start)
+            if self.index_mode == "rollover" and monotonic() >= self.next_rollover:
+                self.rollover()
+            if not res["errors"]:
+                self.succeeded(len(batch))
+                self.logger.debug("bulk indexed %s documents", len(batch))
+                return
+            retry = []
+            rejected = 0
+            for item, result in zip(batch, res["items"]):
+                result = next(iter(result.values()))  # keyed by the action, "index" or "create"
+                status = result["status"]
+                if status < 300:
+                    continue
+                if status == 429 or status >= 500:
+                    retry.append(item)
+                else:
+                    self.logger.warning("document rejected (%s): %s", status, result.get("error"))
+                    rejected += 1
+            self.succeeded(len(batch) - len(retry) - rejected)
+            if rejected:
+                self.refused(rejected)
+            self.logger.debug("bulk indexed %s documents, %s to retry", len(batch) - len(retry), len(retry))
+            if not retry:
+                return
+            batch = retry
+        self.failed([metric for metric, _ in batch])
 
-        self.logger.debug("logging type %s: %s" % (metric.tags["type"], metric))
-        res = self.es.index(index=self.current_index, doc_type="monitor_data", body=metric_dict)
-        self.logger.debug("%s created %s" % (metric.tags["type"], res["_id"]))
+    def close(self):
+        if self.batcher:
+            self.batcher.close()
+        super().close()
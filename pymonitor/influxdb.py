@@ -1,33 +1,178 @@
 from pymonitor import Backend
+from pymonitor.batching import Batcher, backoff
 from influxdb import InfluxDBClient
-import datetime
+from influxdb.exceptions import InfluxDBClientError
+from time import sleep, monotonic
+import socket
+import math
+import gzip
+
+
+# Nanoseconds per unit of each timestamp precision influxdb accepts
+PRECISIONS = {"n": 1, "u": 10 ** 3, "ms": 10 ** 6, "s": 10 ** 9, "m": 60 * 10 ** 9, "h": 3600 * 10 ** 9}
+
+MEASUREMENT_ESCAPES = str.maketrans({",": r"\,", " ": r"\ "})
+KEY_ESCAPES = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ "})
+STRING_ESCAPES = str.maketrans({'"': r'\"', "\\": r"\\"})
+
+
+def format_value(value):
+    """
+    Format a field value in line protocol. Integers are suffixed with `i` so they are not stored as floats. Line
+    protocol has no representation of NaN or infinity, so callers must leave such floats out.
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "%di" % value
+    if isinstance(value, float):
+        return repr(value)
+    return '"%s"' % str(value).translate(STRING_ESCAPES)
+
+
+def make_line(measurement, tags, fields, timestamp):
+    """
+    Serialize one point to influxdb line protocol
+    :param measurement: measurement name
+    :param tags: dict of tag key->value. Tags are sorted by key, as recommended by influxdb, and empty tags skipped
+    :param fields: dict of field key->value. None values, and NaN and infinite floats, which influxdb would reject
+                   along with the rest of the write, are skipped
+    :param timestamp: integer timestamp in the write's precision
+    :return: the line, or None if no fields are left
+    """
+    fields = ",".join("%s=%s" % (key.translate(KEY_ESCAPES), format_value(value))
+                      for key, value in fields.items()
+                      if value is not None and not (isinstance(value, float) and not math.isfinite(value)))
+    if not fields:
+        return None
+    line = [measurement.translate(MEASUREMENT_ESCAPES)]
+    for key in sorted(tags):
+        value = tags[key]
+        if value is None or value == "":
+            continue
+        line.append(",%s=%s" % (key.translate(KEY_ESCAPES), str(value).translate(KEY_ESCAPES)))
+    line.append(" ")
+    line.append(fields)
+    line.append(" %d" % timestamp)
+    return "".join(line)
 
 
 class InfluxBackend(Backend):
     def __init__(self, master, conf):
         super().__init__(master, conf)
         self.client = None
+        self.sock = None
+        self.batcher = None
+        self.precision = self.conf.get("precision", "ms")
+        if self.precision not in PRECISIONS:
+            raise Exception("Invalid influxdb precision: %s" % self.precision)
+        self.divisor = PRECISIONS[self.precision]
+        self.use_udp = self.conf.get("udp", False)
+        self.udp_payload = int(self.conf.get("udp_payload", 1400))
+        self.compress = bool(self.conf.get("compress", False))
+        self.retries = int(self.conf.get("retries", 3))
+        self.retry_backoff = float(self.conf.get("retry_backoff", 0.5))
+        self.dbname = self.conf.get("database", "monitoring")
 
     def connect(self):
         """
         Connect to the backend and do any prep work
         """
-        self.client = InfluxDBClient(self.conf["host"], self.conf["port"], self.conf["user"], self.conf["password"])  # DBNAME
-        dbname = self.conf.get("database", "monitoring")
-        self.client.create_database(dbname)
-        self.client.switch_database(dbname)
+        if self.use_udp:
+            self.udp_addr = (self.conf["host"], int(self.conf.get("udp_port", 8089)))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            flush = self.send_udp
+        else:
+            # retries=1 makes the client try each request once; send_http retries with backoff instead
+            self.client = InfluxDBClient(self.conf["host"], self.conf["port"], self.conf["user"], self.conf["password"],
+                                         timeout=float(self.conf.get("timeout", 10)), retries=1,
+                                         pool_size=int(self.conf.get("pool_size", 10)))
+            self.client.create_database(self.dbname)
+            self.client.switch_database(self.dbname)
+            flush = self.send_http
 
+        self.batcher = Batcher(flush,
+                               max_items=int(self.conf.get("batch_size", 5000)),
+                               max_bytes=int(self.conf.get("batch_bytes", 5 * 1024 * 1024)),
+                               max_age=float(self.conf.get("batch_age", 5)),
+                               workers=int(self.conf.get("batch_workers", 1)),
+                               name="influxdb")
 
     def add_data(self, metric):
         """
-        Accept a Metric() object and send it off to the backend
-        """
-        metric.tags.update(**self.sysinfo)
-        body = [{
-                "measurement": metric.tags["type"],
-                "tags": metric.tags,
-                "time": datetime.datetime.utcnow().isoformat(),
-                "fields": metric.values
-            }
-        ]
-        self.client.write_points(body)
+        Accept a Metric() object and queue it for the next write
+        """
+        tags = dict(self.sysinfo)
+        tags.update(metric.tags)
+        line = make_line(metric.tags["type"], tags, metric.values, metric.timestamp // self.divisor)
+        if line is None:
+            self.logger.debug("dropping %s, no field can be written", metric)
+            self.dropped.inc()
+            return
+        self.batcher.add((metric, line), len(line) + 1)
+
+    def send_http(self, batch):
+        """
+        Write a batch of (metric, line) pairs through the http api, gzipped if `compress` is set. Writes that fail with
+        a connection error, 429 or 5xx are retried with backoff and passed to failed() once retries run out. Other
+        errors (such as a 400 for unparseable points) would fail again on retry, so the batch is logged and dropped.
+        """
+        body = "\n".join(line for _, line in batch).encode("utf-8")
+        headers = {"Content-Type": "application/octet-stream", "Accept": "text/plain"}
+        if self.compress:
+            body = gzip.compress(body, 5)
+            headers["Content-Encoding"] = "gzip"
+        params = {"db": self.dbname, "precision": self.precision}
+
+        self.batch_size.observe(len(batch))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(backoff(attempt, self.retry_backoff))
+            start = monotonic()
+            try:
+                self.client.request("write", "POST", params=params, data=body, expected_response_code=204,
+                                    headers=headers)
+            except InfluxDBClientError as e:
+                self.send_seconds.observe(monotonic() - start)
+                if e.code != 429:
+                    self.logger.warning("write of %s points rejected: %s", len(batch), e)
+                    self.refused(len(batch))
+                    return
+                self.logger.warning("write throttled (attempt %s): %s", attempt + 1, e)
+            except Exception as e:
+                self.send_seconds.observe(monotonic() - start)
+                self.logger.warning("write failed (attempt %s): %s", attempt + 1, e)
+            else:
+                self.send_seconds.observe(monotonic() - start)
+                self.succeeded(len(batch))
+                self.logger.debug("wrote %s points", len(batch))
+                return
+        self.failed([metric for metric, _ in batch])
+
+    def send_udp(self, batch):
+        """
+        Write a batch of (metric, line) pairs as datagrams of at most udp_payload bytes. Delivery is not confirmed.
+        """
+        self.batch_size.observe(len(batch))
+        start = monotonic()
+        packet = []
+        size = 0
+        for _, line in batch:
+            line = line.encode("utf-8") + b"\n"
+            if packet and size + len(line) > self.udp_payload:
+                self.sock.sendto(b"".join(packet), self.udp_addr)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line)
+        if packet:
+            self.sock.sendto(b"".join(packet), self.udp_addr)
+        self.send_seconds.observe(monotonic() - start)
+        self.logger.debug("sent %s points over udp", len(batch))
+
+    def close(self):
+        if self.batcher:
+            self.batcher.close()
+        if self.sock:
+            self.sock.close()
+        super().close()
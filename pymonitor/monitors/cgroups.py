@@ -0,0 +1,501 @@
+from pymonitor import Metric
+from pymonitor import procfs
+from fnmatch import fnmatchcase
+from time import monotonic
+import resource
+import logging
+import errno
+import os
+import re
+
+
+# Stat files read for each cgroup, hottest first: when the fd budget can't keep every file of every cgroup open, the
+# files at the front of the list are the ones kept open
+FILES = ("cpu.stat", "memory.current", "io.stat", "memory.pressure", "io.pressure", "cpu.pressure", "memory.peak")
+CPU, MEMORY, IO, MEMORY_PRESSURE, IO_PRESSURE, CPU_PRESSURE, PEAK = range(len(FILES))
+# Files a cgroup may have but not be able to read: pressure files fail with EOPNOTSUPP while pressure accounting is
+# off for the cgroup (cgroup.pressure set to 0) or the kernel (psi=0)
+OPTIONAL = frozenset((MEMORY_PRESSURE, IO_PRESSURE, CPU_PRESSURE, PEAK))
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.EINVAL)
+
+FD_RESERVE = 512  # descriptors left for the rest of the daemon when sizing the budget
+
+CPU_KEYS = (b"usage_usec", b"user_usec", b"system_usec", b"throttled_usec")
+IO_STAT = re.compile(rb"rbytes=(\d+) wbytes=(\d+) rios=(\d+) wios=(\d+)")
+TOTAL_RATES = ("io_read_ps", "io_write_ps", "io_reads_ps", "io_writes_ps", "cpu_pressure_some", "cpu_pressure_full",
+               "memory_pressure_some", "memory_pressure_full", "io_pressure_some", "io_pressure_full")
+UNCHANGED = dict.fromkeys(TOTAL_RATES, 0.0)
+
+
+class Cgroup(object):
+    """
+    A cgroup being reported on. `files` holds, per entry of FILES, an open fd, the file's path if it isn't kept open,
+    or None if the kernel doesn't provide it. `inode` identifies the cgroup's directory, so a cgroup removed and
+    created again under the same path between walks gets its files reopened. The counters read on the previous run are
+    kept here rather than in a RateTracker: they live exactly as long as the cgroup does, and skipping the tracker's
+    bookkeeping matters with thousands of cgroups.
+    """
+    __slots__ = ("name", "path", "inode", "files", "layout", "idle", "totals", "counters", "sampled")
+
+    def __init__(self, name, path, inode):
+        self.name = name
+        self.path = path
+        self.inode = inode
+        self.files = [None] * len(FILES)
+        self.layout = None  # (field count, positions of CPU_KEYS' values) of this cgroup's cpu.stat
+        self.idle = None  # contents of the io and pressure files last read,
+        self.totals = None  # and the io and pressure counters parsed from them
+        self.counters = None  # cpu counters of the previous run
+        self.sampled = None
+
+
+def cpu_layout(fields):
+    """
+    Find the values of CPU_KEYS in a split cpu.stat. Which fields the file has depends on the kernel's config and on
+    whether the cgroup has the cpu controller, so they are looked up by name; the positions only change along with the
+    number of fields, so they are kept for later runs.
+    :return: (number of fields, positions of the values, or None for keys the file lacks)
+    """
+    positions = []
+    for key in CPU_KEYS:
+        try:
+            positions.append(fields.index(key, 0, len(fields) - 1) + 1)
+        except ValueError:
+            positions.append(None)
+    return (len(fields),) + tuple(positions)
+
+
+class Hierarchy(object):
+    """
+    The cgroups under a cgroup2 mount that pass the depth and glob filters. Walking thousands of directories every run
+    would cost more than reading them, so the walk is cached and only repeated when the number of cgroups in the
+    root's cgroup.stat changes, when a cgroup disappears, or every `rescan` seconds. Stat files stay open between runs
+    within a budget of `max_fds` descriptors, so most reads are a single pread.
+    """
+    def __init__(self, root, min_depth, max_depth, include, exclude, max_fds, rescan):
+        self.root = root.rstrip("/") or "/"
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.include = include
+        self.exclude = exclude
+        self.rescan = rescan
+        self.logger = logging.getLogger("monitordaemon.cgroups")
+        self.cgroups = {}  # name -> Cgroup, in walk order
+        self.descendants = None
+        self.scanned = 0
+        self.stale = True
+        self.open_files = 0  # number of FILES kept open for every cgroup
+        try:
+            self.stat = procfs.ProcFile(os.path.join(self.root, "cgroup.stat"))
+        except OSError:
+            self.stat = None
+        self.max_fds = self.raise_limit(max_fds)
+
+    @staticmethod
+    def raise_limit(wanted):
+        """
+        Raise the soft open file limit, if needed and allowed, to fit `wanted` descriptors
+        :return: how many descriptors may be used
+        """
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < wanted + FD_RESERVE:
+            target = wanted + FD_RESERVE if hard == resource.RLIM_INFINITY else min(hard, wanted + FD_RESERVE)
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+                soft = target
+            except (ValueError, OSError):
+                pass
+        return wanted if soft == resource.RLIM_INFINITY else max(0, min(wanted, soft - FD_RESERVE))
+
+    def count(self):
+        """
+        Return the number of cgroups below the root according to the kernel, or None if unknown
+        """
+        if self.stat is None:
+            return None
+        for line in self.stat.read().splitlines():
+            if line.startswith(b"nr_descendants "):
+                return int(line[15:])
+        return None
+
+    def get(self):
+        """
+        Return the cgroups to report on, walking the hierarchy again first if it changed
+        """
+        descendants = self.count()
+        if self.stale or descendants != self.descendants or monotonic() - self.scanned >= self.rescan:
+            self.descendants = descendants
+            self.scan()
+        return self.cgroups.values()
+
+    def matches(self, name):
+        if self.include and not any(fnmatchcase(name, pattern) for pattern in self.include):
+            return False
+        return True
+
+    def scan(self):
+        """
+        Walk the hierarchy, keeping the open files of cgroups seen before and opening those of new ones
+        """
+        start = monotonic()
+        found = []
+        try:
+            pending = [(self.root, "/", 0, os.stat(self.root).st_ino)]
+        except OSError:
+            pending = []
+        while pending:
+            path, name, depth, inode = pending.pop()
+            if depth >= self.min_depth and self.matches(name):
+                found.append((name, path, inode))
+            if depth >= self.max_depth:
+                continue
+            try:
+                with os.scandir(path) as entries:
+                    children = sorted((entry.name, entry.inode()) for entry in entries
+                                      if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+            for child, child_inode in reversed(children):
+                child_name = name + child if name == "/" else name + "/" + child
+                if any(fnmatchcase(child_name, pattern) for pattern in self.exclude):
+                    continue
+                pending.append((os.path.join(path, child), child_name, depth + 1, child_inode))
+
+        open_files = min(len(FILES), self.max_fds // len(found)) if found else 0
+        previous = self.cgroups
+        self.cgroups = {}
+        for name, path, inode in found:
+            cgroup = previous.pop(name, None)
+            if cgroup is None or cgroup.inode != inode:
+                if cgroup is not None:
+                    self.close(cgroup)
+                cgroup = Cgroup(name, path, inode)
+                self.open(cgroup, open_files)
+            elif open_files != self.open_files:
+                self.close(cgroup)
+                self.open(cgroup, open_files)
+            self.cgroups[name] = cgroup
+        for cgroup in previous.values():
+            self.close(cgroup)
+        self.open_files = open_files
+        self.scanned = monotonic()
+        self.stale = False
+        self.logger.debug("found %s cgroups in %.1fms, keeping %s files each open", len(self.cgroups),
+                          (self.scanned - start) * 1000, open_files)
+
+    @staticmethod
+    def open(cgroup, open_files):
+        for index, filename in enumerate(FILES):
+            path = os.path.join(cgroup.path, filename)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                cgroup.files[index] = None
+                continue
+            if index < open_files:
+                cgroup.files[index] = fd
+            else:
+                os.close(fd)
+                cgroup.files[index] = path
+
+    @staticmethod
+    def close(cgroup):
+        for index, file in enumerate(cgroup.files):
+            if isinstance(file, int):
+                os.close(file)
+                cgroup.files[index] = None
+
+    def forget(self, cgroup):
+        """
+        Drop a cgroup whose files can no longer be read, so the next walk opens them again if it still exists
+        """
+        self.close(cgroup)
+        cgroup.inode = None
+        self.stale = True
+
+    @staticmethod
+    def read(cgroup):
+        """
+        Return the contents of each of a cgroup's stat files, in the order of FILES, with None for those it lacks
+        """
+        pread = os.pread
+        try:
+            contents = [pread(file, 4096, 0) if file.__class__ is int else file and procfs.read_once(file, 4096)
+                        for file in cgroup.files]
+        except OSError:
+            contents = Hierarchy.read_each(cgroup)
+        io = contents[IO]
+        if io is not None and len(io) == 4096:  # io.stat on a host with many devices
+            contents[IO] = procfs.read_once(os.path.join(cgroup.path, FILES[IO]), 1 << 20)
+        return contents
+
+    @staticmethod
+    def read_each(cgroup):
+        """
+        Read a cgroup's files one at a time, after reading them all at once failed. An optional file the kernel
+        refuses to read is closed and left out from then on; any other failure means the cgroup is gone, and is raised.
+        """
+        contents = []
+        for index, file in enumerate(cgroup.files):
+            try:
+                data = os.pread(file, 4096, 0) if file.__class__ is int else file and procfs.read_once(file, 4096)
+            except OSError as e:
+                if index not in OPTIONAL or e.errno not in UNSUPPORTED:
+                    raise
+                if file.__class__ is int:
+                    os.close(file)
+                cgroup.files[index] = data = None
+            contents.append(data)
+        return contents
+
+
+def pressure_totals(data):
+    """
+    Return the `total` stall microseconds of the some and full lines of a pressure file. The full line is missing for
+    cpu before linux 5.13.
+    """
+    if data is None:
+        return 0, 0
+    parts = data.split(b"total=")  # [b"some avg10=...", b"<some total>\nfull avg10=...", b"<full total>\n"]
+    return int(parts[1].split(b"\n", 1)[0]), int(parts[2]) if len(parts) > 2 else 0
+
+
+hierarchies = {}  # filter settings -> Hierarchy
+
+
+def cgroups(root="/sys/fs/cgroup", min_depth=1, max_depth=3, include=[], exclude=[], max_fds=4096, rescan=300):
+    """
+    Emit cpu, memory, io and pressure statistics for each cgroup in a cgroup v2 hierarchy. Cpu, io and pressure rates
+    cover the time since the previous run, so the first run only reports memory use and io totals.
+    :param root: where the cgroup2 filesystem is mounted
+    :param min_depth: depth of the shallowest cgroups reported, 0 being the root
+    :param max_depth: depth of the deepest cgroups reported and walked into
+    :param include: glob patterns, such as `/kubepods.slice/*`, for the cgroups to report. By default, all of them.
+    :param exclude: glob patterns for cgroups to skip, along with the cgroups below them
+    :param max_fds: most file descriptors kept open for stat files between runs
+    :param rescan: seconds after which the hierarchy is walked again even if it seems unchanged
+    """
+    key = (root, min_depth, max_depth, tuple(include), tuple(exclude), max_fds, rescan)
+    hierarchy = hierarchies.get(key)
+    if hierarchy is None:
+        hierarchy = hierarchies[key] = Hierarchy(root, min_depth, max_depth, tuple(include), tuple(exclude), max_fds,
+                                                 rescan)
+
+    read = hierarchy.read
+    for cgroup in hierarchy.get():
+        try:
+            cpu, memory, io, memory_pressure, io_pressure, cpu_pressure, peak = read(cgroup)
+        except OSError:
+            # the cgroup was removed, and maybe created again, since the last walk
+            hierarchy.forget(cgroup)
+            continue
+        now = monotonic()
+
+        usage = user = system = throttled = 0
+        if cpu is not None:
+            fields = cpu.split()
+            layout = cgroup.layout
+            if layout is None or layout[0] != len(fields):
+                layout = cgroup.layout = cpu_layout(fields)
+            _, usage_at, user_at, system_at, throttled_at = layout
+            if usage_at:
+                usage = int(fields[usage_at])
+            if user_at:
+                user = int(fields[user_at])
+            if system_at:
+                system = int(fields[system_at])
+            if throttled_at:
+                throttled = int(fields[throttled_at])
+        # Most cgroups on a busy host are idle ones whose io and pressure files read the same as last time, so their
+        # counters needn't be parsed again and their rates are zero
+        idle = (io, cpu_pressure, memory_pressure, io_pressure)
+        previous = cgroup.totals
+        changed = idle != cgroup.idle
+        if changed:
+            rbytes = wbytes = rios = wios = 0
+            if io is not None:
+                for device_rbytes, device_wbytes, device_rios, device_wios in IO_STAT.findall(io):
+                    rbytes += int(device_rbytes)
+                    wbytes += int(device_wbytes)
+                    rios += int(device_rios)
+                    wios += int(device_wios)
+            totals = (rbytes, wbytes, rios, wios) + pressure_totals(cpu_pressure) + \
+                pressure_totals(memory_pressure) + pressure_totals(io_pressure)
+            cgroup.idle, cgroup.totals = idle, totals
+        else:
+            totals = previous
+
+        record = {"io_read": totals[0], "io_written": totals[1]}
+        if memory is not None:
+            record["memory_current"] = int(memory)
+        if peak is not None:
+            record["memory_peak"] = int(peak)
+
+        # Rates are left unrounded: with thousands of cgroups, rounding them costs more than reading the files
+        last, sampled = cgroup.counters, cgroup.sampled
+        cgroup.counters, cgroup.sampled = (usage, user, system, throttled), now
+        if last is not None and now > sampled:
+            per_second = 1 / (now - sampled)
+            cpus = per_second / 10 ** 6
+            if usage >= last[0] and user >= last[1] and system >= last[2] and throttled >= last[3]:
+                record["cpu_usage"] = (usage - last[0]) * cpus
+                record["cpu_user"] = (user - last[1]) * cpus
+                record["cpu_system"] = (system - last[2]) * cpus
+                record["cpu_throttled"] = (throttled - last[3]) * cpus
+            if not changed:
+                record.update(UNCHANGED)
+            else:
+                deltas = [current - before for current, before in zip(totals, previous)]
+                if min(deltas) >= 0:  # io.stat totals drop when a device goes away
+                    percent = cpus * 100
+                    record.update(zip(TOTAL_RATES, (deltas[0] * per_second, deltas[1] * per_second,
+                                                    deltas[2] * per_second, deltas[3] * per_second,
+                                                    deltas[4] * percent, deltas[5] * percent, deltas[6] * percent,
+                                                    deltas[7] * percent, deltas[8] * percent, deltas[9] * percent)))
+
+        yield Metric(record, {"cgroup": cgroup.name})
+
+
+mapping = {
+    "cgroup": {
+        "type": "keyword"
+    },
+    "memory_current": {
+        "type": "long"
+    },
+    "memory_peak": {
+        "type": "long"
+    },
+    "io_read": {
+        "type": "long"
+    },
+    "io_written": {
+        "type": "long"
+    },
+    "cpu_usage": {
+        "type": "double"
+    },
+    "cpu_user": {
+        "type": "double"
+    },
+    "cpu_system": {
+        "type": "double"
+    },
+    "cpu_throttled": {
+        "type": "double"
+    },
+    "io_read_ps": {
+        "type": "double"
+    },
+    "io_write_ps": {
+        "type": "double"
+    },
+    "io_reads_ps": {
+        "type": "double"
+    },
+    "io_writes_ps": {
+        "type": "double"
+    },
+    "cpu_pressure_some": {
+        "type": "double"
+    },
+    "cpu_pressure_full": {
+        "type": "double"
+    },
+    "memory_pressure_some": {
+        "type": "double"
+    },
+    "memory_pressure_full": {
+        "type": "double"
+    },
+    "io_pressure_some": {
+        "type": "double"
+    },
+    "io_pressure_full": {
+        "type": "double"
+    }
+}
+
+
+def make_fixture(root, count, seed=0):
+    """
+    Write a synthetic cgroup2 hierarchy of `count` cgroups under root, shaped like a kubernetes node: system services,
+    and pods of a few containers each under the kubepods slice. For benchmarks and tests.
+    """
+    import random
+    rand = random.Random(seed)
+    paths = ["system.slice", "user.slice", "kubepods.slice"]
+    services = count // 10
+    paths.extend("system.slice/service-%d.service" % i for i in range(services))
+    pod = 0
+    while len(paths) < count:
+        pod_path = "kubepods.slice/kubepods-pod%d.slice" % pod
+        paths.append(pod_path)
+        paths.extend("%s/cri-container-%d.scope" % (pod_path, i) for i in range(min(3, count - len(paths))))
+        pod += 1
+    for path in [""] + paths:
+        directory = os.path.join(root, path)
+        os.makedirs(directory, exist_ok=True)
+        usage = rand.randrange(10 ** 9)
+        files = {
+            "cpu.stat": "usage_usec %d\nuser_usec %d\nsystem_usec %d\nnr_periods 0\nnr_throttled 0\nthrottled_usec 0\n"
+                        "nr_bursts 0\nburst_usec 0\n" % (usage, usage * 2 // 3, usage // 3),
+            "memory.current": "%d\n" % rand.randrange(10 ** 10),
+            "memory.peak": "%d\n" % rand.randrange(10 ** 10, 2 * 10 ** 10),
+            "io.stat": "8:0 rbytes=%d wbytes=%d rios=%d wios=%d dbytes=0 dios=0\n"
+                       "253:0 rbytes=%d wbytes=%d rios=%d wios=%d dbytes=0 dios=0\n"
+                       % tuple(rand.randrange(10 ** 9) for _ in range(8)),
+            "cgroup.stat": "nr_descendants %d\nnr_dying_descendants 0\n" % (len(paths) if not path else 0),
+        }
+        for resource_name in ("cpu", "memory", "io"):
+            files[resource_name + ".pressure"] = "some avg10=0.00 avg60=0.00 avg300=0.00 total=%d\n" \
+                                                 "full avg10=0.00 avg60=0.00 avg300=0.00 total=%d\n" \
+                                                 % (rand.randrange(10 ** 6), rand.randrange(10 ** 5))
+        for filename, content in files.items():
+            with open(os.path.join(directory, filename), "w") as f:
+                f.write(content)
+
+
+if __name__ == '__main__':
+    # Benchmark: a pass over a synthetic hierarchy, the first walking it and opening its files, later ones reusing them.
+    # Before each later pass every cgroup's cpu and memory use grows, and a quarter of them do io and see stalls.
+    import tempfile
+    import sys
+    from timeit import timeit, repeat
+    from statistics import median
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as root:
+        make_fixture(root, count)
+        directories = [path for path, _, filenames in os.walk(root) if path != root and "cpu.stat" in filenames]
+        passes = [10 ** 6]  # counters start above the fixture's, so every pass has rates
+
+        def churn():
+            passes[0] += 1
+            step = passes[0]
+            for index, directory in enumerate(directories):
+                files = {"cpu.stat": "usage_usec %d\nuser_usec %d\nsystem_usec %d\nnr_periods 0\nnr_throttled 0\n"
+                                     "throttled_usec 0\nnr_bursts 0\nburst_usec 0\n"
+                                     % (step * 3000, step * 2000, step * 1000),
+                         "memory.current": "%d\n" % (10 ** 8 + step * 4096 + index)}
+                if index % 4 == 0:
+                    files["io.stat"] = "8:0 rbytes=%d wbytes=%d rios=%d wios=%d dbytes=0 dios=0\n" % (
+                        step * 10 ** 5, step * 10 ** 4, step * 10 ** 4, step * 10 ** 4)
+                    for resource_name in ("cpu", "memory", "io"):
+                        files[resource_name + ".pressure"] = "some avg10=0.10 avg60=0.05 avg300=0.01 total=%d\n" \
+                                                             "full avg10=0.00 avg60=0.00 avg300=0.00 total=%d\n" \
+                                                             % (step * 1000, step * 100)
+                for filename, content in files.items():
+                    with open(os.path.join(directory, filename), "w") as f:
+                        f.write(content)
+
+        for max_fds in (count * len(FILES), count * 2):
+            hierarchies.clear()
+
+            def run():
+                return sum(1 for _ in cgroups(root, max_depth=4, max_fds=max_fds))
+
+            first = timeit(run, number=1) * 1000
+            steady = [seconds * 1000 for seconds in repeat(run, setup=churn, number=1, repeat=20)]
+            print("%s cgroups, max_fds %5s: first pass %6.1fms, then best %6.1fms, median %6.1fms per pass"
+                  % (run(), max_fds, first, min(steady), median(steady)))
@@ -1,37 +1,68 @@
 from pymonitor import Metric
-from psutil import disk_io_counters
+from pymonitor import procfs
+from pymonitor.rates import RateTracker
+
+
+SECTOR_SIZE = 512  # diskstats always counts 512 byte sectors
+
+# Indexes of /proc/diskstats columns, counted from the first column after the device name
+READS, READS_MERGED, SECTORS_READ, MS_READING, WRITES, WRITES_MERGED, SECTORS_WRITTEN, MS_WRITING, IN_PROGRESS, \
+    MS_IO, MS_WEIGHTED = range(11)
+
+# Columns that are counters, rather than gauges like IN_PROGRESS
+COUNTERS = (READS, SECTORS_READ, MS_READING, WRITES, SECTORS_WRITTEN, MS_WRITING, MS_IO, MS_WEIGHTED)
+# The kernel keeps io and sector counts in 64 bits but prints times in milliseconds as 32 bit values, which wrap
+WIDTHS = tuple(32 if col in (MS_READING, MS_WRITING, MS_IO, MS_WEIGHTED) else 64 for col in COUNTERS)
+
+
+rates = RateTracker("diskio")
 
 
 def diskio(disks=[]):
-    with open("/proc/uptime", "r") as f:
-        uptime = int(float(f.read().split(" ")[0]))
-    diskinfo = disk_io_counters(perdisk=True)
-    for disk, stats in diskinfo.items():
+    """
+    Emit io rates for block devices from /proc/diskstats. Rates cover the time since the previous run, so the first run
+    only reports lifetime totals.
+    :param disks: list of device names to report on. By default, all devices that have completed a read are reported.
+    """
+    for disk, columns in procfs.column_table(procfs.read("/proc/diskstats"), key=2):
+        disk = disk.decode()
         if disks and disk not in disks:
             continue
-        if stats.read_count == 0 and disk not in disks:
+        values = [int(i) for i in columns[3:3 + MS_WEIGHTED + 1]]
+        if values[READS] == 0 and disk not in disks:
             continue
+
         stats = {
-            "disk": disk,
-            "reads_ps": round(stats.read_count / uptime, 2),
-            "writes_ps": round(stats.write_count / uptime, 2),
-            "read_ps": round(stats.read_bytes / uptime, 2),
-            "write_ps": round(stats.write_bytes / uptime, 2),
-            "reads": stats.read_count,
-            "writes": stats.write_count,
-            "read": stats.read_bytes,
-            "written": stats.write_bytes,
-            "read_size": round(stats.read_bytes / stats.read_count, 2) if stats.read_count > 0 else 0.0,
-            "write_size": round(stats.write_bytes / stats.write_count, 2) if stats.write_count > 0 else 0.0
+            "reads": values[READS],
+            "writes": values[WRITES],
+            "read": values[SECTORS_READ] * SECTOR_SIZE,
+            "written": values[SECTORS_WRITTEN] * SECTOR_SIZE,
+            "inflight": values[IN_PROGRESS]
         }
+
+        change = rates.update(disk, [values[col] for col in COUNTERS], WIDTHS)
+        if change:
+            (reads, sectors_read, ms_reading, writes, sectors_written, ms_writing, ms_io, ms_weighted), elapsed = change
+            read_bytes, write_bytes = sectors_read * SECTOR_SIZE, sectors_written * SECTOR_SIZE
+            stats.update({
+                "reads_ps": round(reads / elapsed, 2),
+                "writes_ps": round(writes / elapsed, 2),
+                "read_ps": round(read_bytes / elapsed, 2),
+                "write_ps": round(write_bytes / elapsed, 2),
+                "read_size": round(read_bytes / reads, 2) if reads > 0 else 0.0,
+                "write_size": round(write_bytes / writes, 2) if writes > 0 else 0.0,
+                "util": round(min(ms_io / (elapsed * 1000), 1.0), 5),
+                "queue": round(ms_weighted / (elapsed * 1000), 2),
+                "await": round((ms_reading + ms_writing) / (reads + writes), 2) if reads + writes > 0 else 0.0,
+                "r_await": round(ms_reading / reads, 2) if reads > 0 else 0.0,
+                "w_await": round(ms_writing / writes, 2) if writes > 0 else 0.0
+            })
+
         yield Metric(stats, {"disk": disk})
 
 
 mapping = {
     "disk": {
-        "type": "text"
-    },
-    "disk_raw": {
         "type": "keyword"
     },
     "reads_ps": {
@@ -63,9 +94,30 @@ mapping = {
     },
     "write_size": {
         "type": "double"
+    },
+    "inflight": {
+        "type": "integer"
+    },
+    "util": {
+        "type": "double"
+    },
+    "queue": {
+        "type": "double"
+    },
+    "await": {
+        "type": "double"
+    },
+    "r_await": {
+        "type": "double"
+    },
+    "w_await": {
+        "type": "double"
     }
 }
 
 if __name__ == '__main__':
+    from time import sleep
+    list(diskio())
+    sleep(2)
     for item in diskio():
         print(item)
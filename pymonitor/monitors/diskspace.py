@@ -1,54 +1,226 @@
 from pymonitor import Metric
+from pymonitor import procfs
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from threading import Thread, Lock
+from queue import SimpleQueue
+from time import monotonic
 from os import statvfs
 import logging
+import select
 
 
-def diskspace(filesystems=[], discover=True, omit=[]):
+# Mountpoints under these prefixes are skipped when discovering filesystems
+SKIP_PREFIXES = ("/sys", "/proc", "/dev", "/run")
+
+
+class MountTable(object):
+    """
+    The mountpoints listed in /proc/mounts. The kernel flags an open mounts file as readable with POLLPRI whenever the
+    mount table changes, so the file is only parsed again after poll() reports a change.
+    """
+    def __init__(self, path="/proc/mounts"):
+        self.file = procfs.ProcFile(path)  # not the shared instance, change notifications are per open file
+        self.poller = select.poll()
+        self.poller.register(self.file.fd, select.POLLPRI | select.POLLERR)
+        self.mountpoints = None
+
+    def get(self):
+        if self.mountpoints is None or self.poller.poll(0):
+            mountpoints = []
+            for line in self.file.read().splitlines():
+                device, mountpoint, _ = line.split(b" ", 2)
+                mountpoint = mountpoint.decode()
+                # filter out some mountpoints we probably don't care about space on
+                if not mountpoint.startswith(SKIP_PREFIXES):
+                    mountpoints.append(mountpoint)
+            self.mountpoints = mountpoints
+        return self.mountpoints
+
+
+class StatPool(object):
+    """
+    Threads running statvfs() calls. A call on a dead network filesystem can hang indefinitely, taking its thread with
+    it, so the threads are daemons that won't hold up exit, and a thread given up on is replaced while no more than
+    `max_hung` are stuck. Threads above `workers` retire once the stuck calls return. Each future's `started` is the
+    monotonic time its call began, or None while it waits for a thread.
+    """
+    def __init__(self, workers, max_hung):
+        self.requests = SimpleQueue()
+        self.workers = workers
+        self.max_hung = max_hung
+        self.threads = 0
+        self.hung = 0
+        self.lock = Lock()
+        for _ in range(workers):
+            self.spawn()
+
+    def spawn(self):
+        """
+        Start a thread. Must be called with the lock held, or before the pool is shared.
+        """
+        self.threads += 1
+        Thread(target=self.worker, name="statvfs", daemon=True).start()
+
+    def submit(self, path):
+        future = Future()
+        future.started = None
+        self.requests.put((path, future))
+        return future
+
+    def abandon(self, future):
+        """
+        Called when a caller stops waiting for a call that is still running
+        """
+        with self.lock:
+            self.hung += 1
+            if self.hung <= self.max_hung:
+                self.spawn()
+        future.add_done_callback(self.recovered)
+
+    def live(self):
+        """
+        Return the number of threads not stuck in an abandoned call
+        """
+        with self.lock:
+            return self.threads - self.hung
+
+    def recovered(self, future):
+        with self.lock:
+            self.hung -= 1
+
+    def worker(self):
+        while True:
+            path, future = self.requests.get()
+            if future.set_running_or_notify_cancel():
+                future.started = monotonic()
+                try:
+                    future.set_result(statvfs(path))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.lock:
+                if self.threads - self.hung > self.workers:
+                    self.threads -= 1
+                    return
+
+
+mounts = None
+pool = None
+pending = {}  # mountpoint -> Future of a statvfs call that timed out and has not returned yet
+quarantined = {}  # mountpoint -> monotonic time before which it is not checked
+
+
+def usage(stats):
+    """
+    Return the fields reported for a statvfs result
+    """
+    info = {
+        "available": True,
+        "diskfree": stats.f_bsize * stats.f_bavail,
+        "diskused": (stats.f_blocks - stats.f_bavail) * stats.f_bsize,
+        "disksize": stats.f_bsize * stats.f_blocks,
+        "inodesmax": stats.f_files,
+        "inodesfree": stats.f_favail,
+        "inodesused": stats.f_files - stats.f_favail
+    }
+
+    info["diskpctused"] = round(info["diskused"] / info["disksize"] if info["disksize"] > 0 else 0.0, 5)
+    info["diskpctfree"] = round(info["diskfree"] / info["disksize"] if info["disksize"] > 0 else 0.0, 5)
+
+    info["inodesused_pct"] = round(info["inodesused"] / info["inodesmax"] if info["inodesmax"] > 0 else 0.0, 5)
+    info["inodesfree_pct"] = round(info["inodesfree"] / info["inodesmax"] if info["inodesmax"] > 0 else 0.0, 5)
+    return info
+
+
+def diskspace(filesystems=[], discover=True, omit=[], timeout=5, workers=4, quarantine=300):
     """
     Emit disk space usage statistics for the passed filesystems.
     :param filesystems: list of mountpoints to gather stats for
     :param discover: automatically find non-temporary filesystems to gather statistics for. Duplicates from the
                      filesystems param will be ignored.
     :param omit: list of paths that, if prefix a discovered mountpoint, to not report on
+    :param timeout: seconds to wait for a filesystem's statistics, from when its check starts. Filesystems that don't
+                    answer in time, such as dead network mounts, are reported with `available` false and not checked
+                    again for `quarantine` seconds.
+    :param workers: number of filesystems checked concurrently
+    :param quarantine: seconds to skip a filesystem for after it timed out
     """
+    global mounts, pool
+    if pool is None:
+        pool = StatPool(workers, max_hung=workers)
     filesystems = [f.rstrip("/") if f != "/" else f for f in filesystems]
     if discover:
-        with open("/proc/mounts") as f:
-            for line in f.readlines():
-                device, mountpoint, fstype, options, _, _ = line.split(" ")
-                # filter out some mountpoints we probably don't care about space on
-                if any([mountpoint.startswith(prefix) for prefix in ["/sys", "/proc", "/dev", "/run"]]):
-                    continue
-                filesystems.append(mountpoint)
+        if mounts is None:
+            mounts = MountTable()
+        filesystems.extend(mounts.get())
 
+    now = monotonic()
+    checks = {}
+    unavailable = []
     for fs in set(filesystems):
         if any([fs.startswith(i) for i in omit or []]):
             continue
+        if fs in quarantined:
+            if now < quarantined[fs] or not pending[fs].done():
+                unavailable.append(fs)
+                continue
+            del quarantined[fs]
+            del pending[fs]
+            logging.info("filesystem recovered: %s", repr(fs))
+        checks[fs] = pool.submit(fs)
+
+    waiting = {future: fs for fs, future in checks.items()}
+    while waiting:
+        # A check times out `timeout` seconds after its call starts, not after it was queued behind other checks. One
+        # that hangs is given up on, freeing a thread for the checks queued behind it.
+        now = monotonic()
+        deadline = None
+        for future, fs in list(waiting.items()):
+            if future.done():
+                del waiting[future]
+            elif future.started is not None:
+                expires = future.started + timeout
+                if now < expires:
+                    deadline = min(deadline, expires) if deadline else expires
+                    continue
+                del waiting[future]
+                logging.warning("filesystem did not respond within %ss, skipping it for %ss: %s", timeout, quarantine,
+                                repr(fs))
+                quarantined[fs] = now + quarantine
+                pending[fs] = future
+                pool.abandon(future)
+                unavailable.append(fs)
+        if not waiting:
+            break
+        if deadline is None and not pool.live():
+            # every thread is stuck on a hung filesystem, so the checks still queued can't run this time
+            for future, fs in list(waiting.items()):
+                if future.cancel():
+                    del waiting[future]
+                    logging.warning("no thread free to check filesystem, skipping it this time: %s", repr(fs))
+            continue
+        wait(waiting, deadline - now if deadline else timeout, return_when=FIRST_COMPLETED)
+
+    for fs, future in checks.items():
+        if future.cancelled() or pending.get(fs) is future:
+            continue
         try:
-            stats = statvfs(fs)
+            stats = future.result()
         except FileNotFoundError:
             logging.warning("filesystem not found: %s", repr(fs))
             continue
+        except OSError as e:
+            logging.warning("could not check filesystem %s: %s", repr(fs), e)
+            unavailable.append(fs)
+            continue
+        yield Metric(usage(stats), {"fs": fs})
 
-        info = {
-            "diskfree": stats.f_bsize * stats.f_bavail,
-            "diskused": (stats.f_blocks - stats.f_bavail) * stats.f_bsize,
-            "disksize": stats.f_bsize * stats.f_blocks,
-            "inodesmax": stats.f_files,
-            "inodesfree": stats.f_favail,
-            "inodesused": stats.f_files - stats.f_favail
-        }
-
-        info["diskpctused"] = round(info["diskused"] / info["disksize"] if info["disksize"] > 0 else 0.0, 5)
-        info["diskpctfree"] = round(info["diskfree"] / info["disksize"] if info["disksize"] > 0 else 0.0, 5)
-
-        info["inodesused_pct"] = round(info["inodesused"] / info["inodesmax"] if info["inodesmax"] > 0 else 0.0, 5)
-        info["inodesfree_pct"] = round(info["inodesfree"] / info["inodesmax"] if info["inodesmax"] > 0 else 0.0, 5)
-
-        yield Metric(info, {"fs": fs})
-
+    for fs in unavailable:
+        yield Metric({"available": False}, {"fs": fs})
 
 mapping = {
+    "available": {
+        "type": "boolean"
+    },
     "diskfree": {
         "type": "long"
     },
@@ -65,9 +237,6 @@ mapping = {
         "type": "double"
     },
     "fs": {
-        "type": "text"
-    },
-    "fs_raw": {
         "type": "keyword"
     },
     "inodesmax": {
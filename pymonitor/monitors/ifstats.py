@@ -1,83 +1,68 @@
 from pymonitor import Metric
-from collections import defaultdict
-from time import time
+from pymonitor import procfs
+from pymonitor.rates import RateTracker
 
 
 rx_bytes, rx_packets, rx_errs, rx_drop, rx_fifo, rx_frame, rx_compressed, rx_multicast, \
     tx_bytes, tx_packets, tx_errs, tx_drop, tx_fifo, tx_colls, tx_carrier, tx_compressed = range(16)
 
 
-previous = defaultdict(lambda: [-1 for i in range(17)])
+rates = RateTracker("ifstats")
 
 
 def ifstats(omit=[]):
     """
     :param omit: list of strings that, if prefix a discovered interface, to not skip
     """
-    with open("/proc/net/dev", "r") as f:
-        _, _ = f.readline(), f.readline()
+    for ifname, fields in procfs.colon_table(procfs.read("/proc/net/dev"), skip=2):
+        ifname = ifname.decode()
+        record = {"rx_bytes": int(fields[rx_bytes]),
+                  "tx_bytes": int(fields[tx_bytes]),
+                  "rx_packets": int(fields[rx_packets]),
+                  "tx_packets": int(fields[tx_packets]),
+                  }
 
-        for line in f.readlines():
-            fields = line.split()
-            ifname = fields.pop(0).rstrip(":")
-            for i in range(0, len(fields)):
-                fields[i] = int(fields[i])
+        change = rates.update(ifname, (record["rx_bytes"], record["tx_bytes"],
+                                       record["rx_packets"], record["tx_packets"]))
+        if change:
+            (rx_delta, tx_delta, rx_packets_delta, tx_packets_delta), tdelta = change
+            record["rx_traffic"] = round(rx_delta / tdelta)
+            record["tx_traffic"] = round(tx_delta / tdelta)
+            record["tx_packetcnt"] = round(tx_packets_delta / tdelta)
+            record["rx_packetcnt"] = round(rx_packets_delta / tdelta)
 
-            record = {"rx_bytes": fields[rx_bytes],
-                      "tx_bytes": fields[tx_bytes],
-                      "rx_packets": fields[rx_packets],
-                      "tx_packets": fields[tx_packets],
-                      }
-
-            prev = previous[ifname]
-            if prev[rx_bytes] != -1:
-                tdelta = time() - prev[-1]
-                record["rx_traffic"] = round((fields[rx_bytes] - prev[rx_bytes]) / tdelta)
-                record["tx_traffic"] = round((fields[tx_bytes] - prev[tx_bytes]) / tdelta)
-                record["tx_packetcnt"] = round((fields[tx_packets] - prev[tx_packets]) / tdelta)
-                record["rx_packetcnt"] = round((fields[rx_packets] - prev[rx_packets]) / tdelta)
-
-            previous[ifname] = fields + [time()]
-
-            if any([ifname.startswith(i) for i in omit or []]):
-                continue
-            yield Metric(record, {"iface": ifname})
+        if any([ifname.startswith(i) for i in omit or []]):
+            continue
+        yield Metric(record, {"iface": ifname})
 
 
 mapping = {
-    "ifstats": {
-        "properties": {
-            "iface": {
-                "type": "string"
-            },
-            "iface_raw": {
-                "type": "keyword"
-            },
-            "rx_bytes": {
-                "type": "long"
-            },
-            "tx_bytes": {
-                "type": "long"
-            },
-            "rx_packets": {
-                "type": "long"
-            },
-            "tx_packets": {
-                "type": "long"
-            },
-            "rx_traffic": {
-                "type": "long"
-            },
-            "tx_traffic": {
-                "type": "long"
-            },
-            "tx_packetcnt": {
-                "type": "long"
-            },
-            "rx_packetcnt": {
-                "type": "long"
-            }
-        }
+    "iface": {
+        "type": "keyword"
+    },
+    "rx_bytes": {
+        "type": "long"
+    },
+    "tx_bytes": {
+        "type": "long"
+    },
+    "rx_packets": {
+        "type": "long"
+    },
+    "tx_packets": {
+        "type": "long"
+    },
+    "rx_traffic": {
+        "type": "long"
+    },
+    "tx_traffic": {
+        "type": "long"
+    },
+    "tx_packetcnt": {
+        "type": "long"
+    },
+    "rx_packetcnt": {
+        "type": "long"
     }
 }
 
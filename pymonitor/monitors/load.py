@@ -1,11 +1,11 @@
 from pymonitor import Metric
+from pymonitor import procfs
 
 def load():
-    with open("/proc/loadavg", "r") as f:
-        m1, m5, m15, procs, pid = f.read().strip().split(" ")
-        yield Metric({"load_1m": float(m1),
-                      "load_5m": float(m5),
-                      "load_15m": float(m15)})
+    m1, m5, m15 = procfs.read("/proc/loadavg").split()[0:3]
+    yield Metric({"load_1m": float(m1),
+                  "load_5m": float(m5),
+                  "load_15m": float(m15)})
 
 
 mapping = {
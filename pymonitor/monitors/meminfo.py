@@ -1,7 +1,8 @@
 from pymonitor import Metric
-import re
+from pymonitor import procfs
 
-memline_pattern = re.compile(r'^(?P<key>[^\\:]+)\:\s+(?P<value>[0-9]+)(\s(?P<unit>[a-zA-Z]+))?')
+# /proc/meminfo key -> metric name, such as b"Active(anon)" -> "activeanon"
+field_names = {}
 
 computed_fields = {
     "mempctused": lambda items: round((items["memtotal"] - items["memfree"]) / items["memtotal"], 5),
@@ -24,25 +25,15 @@ def meminfo(whitelist=[]):
                      "active", "inactive", ]
 
     result = {}
-    with open("/proc/meminfo", "r") as f:
-        for line in f.read().strip().split("\n"):
-            matches = memline_pattern.match(line)
-
-            value = int(matches.group("value"))
-            unit = matches.group("unit")
-
-            if unit:
-                if unit == "kB":
-                    value *= 1024
-                else:
-                    raise Exception("Unknown unit")
-
-            name = ''.join(c for c in matches.group("key").lower() if 96 < ord(c) < 123)
-            if name in whitelist:
-                result[name] = value
-
-        for key in computed_fields:
-            result[key] = computed_fields[key](result)
+    for key, value in procfs.keyvalue_table(procfs.read("/proc/meminfo")).items():
+        name = field_names.get(key)
+        if name is None:
+            name = field_names[key] = ''.join(c for c in key.decode().lower() if 96 < ord(c) < 123)
+        if name in whitelist:
+            result[name] = value
+
+    for key in computed_fields:
+        result[key] = computed_fields[key](result)
 
     yield Metric(result)
 
@@ -0,0 +1,97 @@
+from pymonitor import Metric
+from pymonitor import procfs
+from pymonitor import telemetry
+from time import monotonic
+import threading
+import os
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# (name, labels) -> histogram bucket counts at the previous run
+last_counts = {}
+last_cpu = None
+
+
+def selfstats(percentiles=(50, 90, 99)):
+    """
+    Report the daemon's own telemetry: its resource usage, plus every counter, gauge and histogram in the telemetry
+    registry, tagged with `metric` and the metric's labels. Single values are reported as a float `value` field.
+    Histograms are reported for the interval since the previous run, as the number of observations, their sum and
+    estimated percentiles.
+    :param percentiles: percentiles to estimate for histograms
+    """
+    global last_cpu
+    times = os.times()
+    now = monotonic()
+    cpu = times.user + times.system
+    process = {"rss": int(procfs.read("/proc/self/statm").split()[1]) * PAGE_SIZE,
+               "threads": threading.active_count(),
+               "fds": len(os.listdir("/proc/self/fd"))}
+    if last_cpu:
+        process["cpu_pct"] = round((cpu - last_cpu[0]) / (now - last_cpu[1]) * 100, 2)
+    last_cpu = (cpu, now)
+    yield Metric(process, {"metric": "process"})
+
+    for name, labels, series in telemetry.registry.collect():
+        tags = dict(labels, metric=name)
+        if isinstance(series, telemetry.Counter):
+            yield Metric({"value": float(series.value)}, tags)
+        elif isinstance(series, telemetry.Gauge):
+            value = series.func()
+            yield Metric(dict(value) if isinstance(value, dict) else {"value": float(value)}, tags)
+        else:
+            counts, total = series.snapshot()
+            key = (name, tuple(sorted(labels.items())))
+            previous = last_counts.get(key)
+            last_counts[key] = (counts, total)
+            if previous:
+                counts = [count - before for count, before in zip(counts, previous[0])]
+                total -= previous[1]
+            values = {"count": sum(counts), "sum": round(total, 6)}
+            for pct in percentiles:
+                values["p%g" % pct] = telemetry.estimate(series.bounds, counts, pct)
+            yield Metric(values, tags)
+
+
+mapping = {
+    "metric": {
+        "type": "keyword"
+    },
+    "rss": {
+        "type": "long"
+    },
+    "threads": {
+        "type": "integer"
+    },
+    "fds": {
+        "type": "integer"
+    },
+    "cpu_pct": {
+        "type": "double"
+    },
+    "value": {
+        "type": "double"
+    },
+    "count": {
+        "type": "long"
+    },
+    "sum": {
+        "type": "double"
+    },
+    "p50": {
+        "type": "double"
+    },
+    "p90": {
+        "type": "double"
+    },
+    "p99": {
+        "type": "double"
+    }
+}
+
+
+if __name__ == '__main__':
+    telemetry.histogram("example_seconds").observe(0.003)
+    for item in selfstats():
+        print(item)
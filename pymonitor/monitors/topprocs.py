@@ -0,0 +1,180 @@
+from pymonitor import Metric
+from pymonitor import procfs
+from pymonitor.builtins import sysinfo
+from heapq import nlargest
+from time import monotonic
+import os
+
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Indexes into procfs.stat_fields()
+STAT_UTIME = 11
+STAT_STIME = 12
+STAT_STARTTIME = 19
+STAT_RSS = 21
+
+# Longer command lines are truncated
+CMDLINE_MAX = 512
+
+
+class ProcState(object):
+    """
+    What we remember about a process between runs
+    """
+    __slots__ = ("starttime", "cputime", "read_bytes", "write_bytes", "name", "user", "cmdline", "has_io",
+                 "cpu_pct", "rss", "read_ps", "write_ps")
+
+    def __init__(self, starttime, name, user, cmdline):
+        self.starttime = starttime
+        self.name = name
+        self.user = user
+        self.cmdline = cmdline
+        self.cputime = None
+        self.read_bytes = None
+        self.write_bytes = None
+        self.has_io = True
+        self.cpu_pct = 0.0
+        self.rss = 0
+        self.read_ps = 0.0
+        self.write_ps = 0.0
+
+
+# pid -> ProcState
+state = {}
+last_run = None
+
+
+def describe(root, pid):
+    """
+    Return the name, owner and command line of a process. Only called the first time a process is seen.
+    """
+    name = user = ""
+    for line in procfs.read_once("%s/%s/status" % (root, pid)).splitlines():
+        key, _, value = line.partition(b":")
+        if key == b"Name":
+            name = value.strip().decode(errors="replace")
+        elif key == b"Uid":
+            uid = int(value.split()[0])
+            user = sysinfo.users().get(uid, str(uid))
+            break
+    cmdline = procfs.read_once("%s/%s/cmdline" % (root, pid), CMDLINE_MAX).replace(b"\0", b" ").strip()
+    return name, user, cmdline.decode(errors="replace") or "[%s]" % name
+
+
+def read_io(root, pid):
+    """
+    Return (read_bytes, write_bytes) from a process's io file
+    """
+    read_bytes = write_bytes = 0
+    for line in procfs.read_once("%s/%s/io" % (root, pid)).splitlines():
+        if line.startswith(b"read_bytes:"):
+            read_bytes = int(line[11:])
+        elif line.startswith(b"write_bytes:"):
+            write_bytes = int(line[12:])
+    return read_bytes, write_bytes
+
+
+def topprocs(count=5, io=True, root="/proc"):
+    """
+    Report the top processes by cpu usage, resident memory and disk io
+    :param count: number of processes to report for each resource
+    :param io: read /proc/<pid>/io for io rates. Processes owned by other users can only be read as root.
+    :param root: procfs mountpoint
+    """
+    global last_run
+    now = monotonic()
+    elapsed = now - last_run if last_run else None
+    last_run = now
+
+    seen = []
+    for pid, stat in procfs.scan_stats(root, STAT_RSS + 1):
+        starttime = int(stat[STAT_STARTTIME])
+        proc = state.get(pid)
+        if proc is None or proc.starttime != starttime:  # new process, or the pid was reused
+            try:
+                proc = state[pid] = ProcState(starttime, *describe(root, pid))
+            except OSError:
+                continue
+        seen.append(pid)
+
+        proc.rss = int(stat[STAT_RSS]) * PAGE_SIZE
+        cputime = int(stat[STAT_UTIME]) + int(stat[STAT_STIME])
+        if proc.cputime is not None and elapsed:
+            proc.cpu_pct = round((cputime - proc.cputime) / CLK_TCK / elapsed * 100, 2)
+        proc.cputime = cputime
+
+        if io and proc.has_io:
+            try:
+                read_bytes, write_bytes = read_io(root, pid)
+            except PermissionError:
+                proc.has_io = False
+                continue
+            except OSError:
+                continue
+            if proc.read_bytes is not None and elapsed:
+                proc.read_ps = round((read_bytes - proc.read_bytes) / elapsed, 2)
+                proc.write_ps = round((write_bytes - proc.write_bytes) / elapsed, 2)
+            proc.read_bytes = read_bytes
+            proc.write_bytes = write_bytes
+
+    # forget processes that have exited
+    live = set(seen)
+    for pid in [pid for pid in state if pid not in live]:
+        del state[pid]
+
+    rankings = [("rss", lambda pid: state[pid].rss)]
+    if elapsed:
+        rankings.append(("cpu", lambda pid: state[pid].cpu_pct))
+        if io:
+            rankings.append(("io", lambda pid: state[pid].read_ps + state[pid].write_ps))
+
+    for top, key in rankings:
+        for pid in nlargest(count, seen, key=key):
+            proc = state[pid]
+            yield Metric({"cpu_pct": proc.cpu_pct,
+                          "rss": proc.rss,
+                          "read_ps": proc.read_ps,
+                          "write_ps": proc.write_ps,
+                          "cmdline": proc.cmdline},
+                         {"top": top, "pid": pid, "name": proc.name, "user": proc.user})
+
+
+mapping = {
+    "top": {
+        "type": "keyword"
+    },
+    "pid": {
+        "type": "integer"
+    },
+    "name": {
+        "type": "keyword"
+    },
+    "user": {
+        "type": "keyword"
+    },
+    "cmdline": {
+        "type": "text"
+    },
+    "cpu_pct": {
+        "type": "double"
+    },
+    "rss": {
+        "type": "long"
+    },
+    "read_ps": {
+        "type": "double"
+    },
+    "write_ps": {
+        "type": "double"
+    }
+}
+
+
+if __name__ == '__main__':
+    from time import sleep
+    list(topprocs())
+    sleep(2)
+    for item in topprocs():
+        print(item)
@@ -1,9 +1,9 @@
 from pymonitor import Metric
+from pymonitor import procfs
 
 
 def uptime():
-    with open("/proc/uptime", "r") as f:
-        yield Metric({"uptime": int(float(f.read().split(" ")[0]))})
+    yield Metric({"uptime": int(float(procfs.read("/proc/uptime").split()[0]))})
 
 
 mapping = {"uptime": {"type": "integer"}}
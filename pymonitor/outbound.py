@@ -0,0 +1,134 @@
+from threading import Thread, Condition
+from collections import deque
+from time import time_ns
+from pymonitor import telemetry
+import traceback
+import logging
+
+
+class OutboundQueue(object):
+    """
+    Bounded buffer between the monitors and a backend. Monitors put() metrics and return immediately (or block, per the
+    overflow policy); sender threads drain the queue into the backend so a slow backend does not delay collection.
+    """
+    POLICIES = ("block", "drop-oldest", "drop-newest")
+
+    def __init__(self, backend, size=10000, policy="drop-oldest", workers=1, batch=500, block_timeout=None,
+                 name="outbound"):
+        """
+        :param backend: Backend instance metrics are passed to
+        :param size: maximum number of queued metrics
+        :param policy: what to do when the queue is full. `block` waits for space (up to block_timeout seconds, then
+                       drops the new metric), `drop-oldest` discards the oldest queued metric and `drop-newest` discards
+                       the metric being added.
+        :param workers: number of sender threads
+        :param batch: maximum number of metrics a sender takes from the queue at once
+        """
+        if policy not in self.POLICIES:
+            raise Exception("Invalid queue overflow policy: %s" % policy)
+        self.backend = backend
+        self.size = size
+        self.policy = policy
+        self.batch = batch
+        self.block_timeout = block_timeout
+        self.logger = logging.getLogger("monitordaemon.outbound.%s" % name)
+
+        self.lock = Condition()
+        self.items = deque()
+        self.busy = 0
+        self.alive = True
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+        self.workers = [Thread(target=self.worker, name="%s-%s" % (name, i), daemon=True) for i in range(workers)]
+        telemetry.gauge("queue", self.stats, queue=name)
+
+    @classmethod
+    def from_config(cls, backend, conf, name="outbound"):
+        """
+        Create a queue from the `queue` section of a backend's config
+        """
+        return cls(backend,
+                   size=int(conf.get("size", 10000)),
+                   policy=conf.get("policy", "drop-oldest"),
+                   workers=int(conf.get("workers", 1)),
+                   batch=int(conf.get("batch", 500)),
+                   block_timeout=float(conf["block_timeout"]) if "block_timeout" in conf else None,
+                   name=name)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, metric):
+        """
+        Queue a metric for sending
+        :return: False if the metric was dropped
+        """
+        if metric.timestamp is None:
+            metric.timestamp = time_ns()
+        with self.lock:
+            if len(self.items) >= self.size:
+                if self.policy == "drop-oldest":
+                    self.items.popleft()
+                    self.dropped += 1
+                elif self.policy == "drop-newest" or \
+                        not self.lock.wait_for(lambda: len(self.items) < self.size, self.block_timeout):
+                    self.dropped += 1
+                    return False
+            self.items.append(metric)
+            self.enqueued += 1
+            self.lock.notify_all()
+        return True
+
+    def depth(self):
+        return len(self.items)
+
+    def stats(self):
+        """
+        Return counters describing the queue's lifetime activity
+        """
+        with self.lock:
+            return {"enqueued": self.enqueued, "dropped": self.dropped, "sent": self.sent, "failed": self.failed,
+                    "depth": len(self.items)}
+
+    def worker(self):
+        """
+        Take metrics off the queue and pass them to the backend
+        """
+        while True:
+            with self.lock:
+                while not self.items:
+                    if not self.alive:
+                        return
+                    self.lock.wait()
+                batch = [self.items.popleft() for _ in range(min(self.batch, len(self.items)))]
+                self.busy += 1
+                self.lock.notify_all()
+            sent = 0
+            for metric in batch:
+                try:
+                    self.backend.add_data(metric)
+                    sent += 1
+                except Exception:
+                    self.logger.warning("sending %s failed: %s", metric, traceback.format_exc())
+                    self.backend.failed([metric])
+            with self.lock:
+                self.sent += sent
+                self.failed += len(batch) - sent
+                self.busy -= 1
+                self.lock.notify_all()
+
+    def close(self, timeout=None):
+        """
+        Wait for queued metrics to be handed to the backend, then stop the sender threads
+        """
+        with self.lock:
+            self.lock.wait_for(lambda: not self.items and not self.busy, timeout)
+            self.alive = False
+            self.lock.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.logger.info("queue closed: %s", self.stats())
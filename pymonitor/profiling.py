@@ -0,0 +1,225 @@
+from collections import Counter
+from threading import Thread, Lock, Event, get_ident
+from time import monotonic, strftime
+import tracemalloc
+import threading
+import tempfile
+import cProfile
+import logging
+import pstats
+import signal
+import sys
+import os
+import re
+
+
+# The Recorder collecting cProfile data from monitor runs, while one is active. Checked by Monitor.execute().
+recorder = None
+
+
+class Sampler(Thread):
+    """
+    Low overhead statistical profiler. Every `interval` seconds the current stack of every other thread is recorded.
+    Results are written in the folded stack format read by flamegraph.pl and speedscope, with each stack rooted at its
+    thread's name.
+    """
+    def __init__(self, interval, duration, path, logger):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.duration = duration
+        self.path = path
+        self.logger = logger
+        self.stopped = Event()
+        self.samples = 0
+
+    def run(self):
+        me = get_ident()
+        stacks = Counter()
+        end = monotonic() + self.duration
+        while not self.stopped.is_set() and monotonic() < end:
+            names = {thread.ident: re.sub(r"[-_]\d+$", "", thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            self.stopped.wait(self.interval)
+
+        with open(self.path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("%s %d\n" % (stack, count))
+        self.logger.warning("wrote %s cpu samples to %s", self.samples, self.path)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Recorder(Thread):
+    """
+    Deterministic profiler covering monitor runs. cProfile only traces the thread it is enabled in, so each monitor
+    run executed while the recorder is active is profiled separately and the results merged when it finishes.
+    """
+    def __init__(self, duration, path, logger):
+        super().__init__(name="profiler", daemon=True)
+        self.duration = duration
+        self.path = path
+        self.logger = logger
+        self.stopped = Event()
+        self.lock = Lock()
+        self.profiles = []
+
+    def runcall(self, func, *args):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            with self.lock:
+                self.profiles.append(profile)
+
+    def run(self):
+        global recorder
+        self.stopped.wait(self.duration)
+        recorder = None
+        with self.lock:
+            profiles = self.profiles
+            self.profiles = []
+        if not profiles:
+            self.logger.warning("no monitor runs were profiled")
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.path)
+        self.logger.warning("wrote profile of %s monitor runs to %s", len(profiles), self.path)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Profiler(object):
+    """
+    Signal triggered profiling. Nothing is measured, and there is no overhead, until a signal arrives:
+
+    - SIGUSR1 profiles CPU use for `duration` seconds, or stops a profile in progress early. In `sample` mode the stacks
+      of all threads are sampled every `interval` seconds; in `cprofile` mode monitor runs are traced with cProfile.
+    - SIGUSR2 starts tracing memory allocations with tracemalloc. The next SIGUSR2 takes a snapshot, writes the top
+      allocation sites and the growth since tracing started, and stops tracing.
+
+    Results are written to `directory`.
+    """
+    MODES = ("sample", "cprofile")
+
+    def __init__(self, directory=None, mode="sample", duration=30, interval=0.01, frames=10, top=50):
+        """
+        :param directory: where to write results, by default the system temp directory
+        :param mode: `sample` or `cprofile`
+        :param duration: seconds a cpu profile runs for
+        :param interval: seconds between stack samples in `sample` mode
+        :param frames: stack frames recorded for each allocation while tracing memory
+        :param top: number of allocation sites listed in memory reports
+        """
+        if mode not in self.MODES:
+            raise Exception("Invalid profiling mode: %s" % mode)
+        self.directory = directory or tempfile.gettempdir()
+        self.mode = mode
+        self.duration = duration
+        self.interval = interval
+        self.frames = frames
+        self.top = top
+        self.logger = logging.getLogger("monitordaemon.profiling")
+        self.lock = Lock()
+        self.cpu = None
+        self.baseline = None
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        Create a profiler from the top level `profiling` section of the config
+        """
+        return cls(directory=conf.get("dir"),
+                   mode=conf.get("mode", "sample"),
+                   duration=float(conf.get("duration", 30)),
+                   interval=float(conf.get("interval", 0.01)),
+                   frames=int(conf.get("frames", 10)),
+                   top=int(conf.get("top", 50)))
+
+    def install(self):
+        """
+        Register the signal handlers. Must be called from the main thread.
+        """
+        signal.signal(signal.SIGUSR1, self.on_signal)
+        signal.signal(signal.SIGUSR2, self.on_signal)
+        self.logger.debug("profiling on SIGUSR1 (cpu) and SIGUSR2 (memory), writing to %s", self.directory)
+
+    def on_signal(self, signum, frame):
+        # Handlers run between bytecodes of the main thread, so hand the work to a thread of its own
+        target = self.toggle_cpu if signum == signal.SIGUSR1 else self.toggle_memory
+        Thread(target=target, name="profiler-signal", daemon=True).start()
+
+    def filename(self, kind, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, "pymonitor-%s-%s-%s.%s" % (kind, os.getpid(), strftime("%Y%m%d-%H%M%S"),
+                                                                         extension))
+
+    def toggle_cpu(self):
+        """
+        Start a cpu profile, or stop the one in progress
+        """
+        global recorder
+        with self.lock:
+            if self.cpu and self.cpu.is_alive():
+                self.logger.warning("stopping cpu profile early")
+                self.cpu.stop()
+                return
+            if self.mode == "sample":
+                self.cpu = Sampler(self.interval, self.duration, self.filename("cpu", "folded"), self.logger)
+            else:
+                self.cpu = recorder = Recorder(self.duration, self.filename("cpu", "pstats"), self.logger)
+            self.logger.warning("profiling cpu (%s) for %ss", self.mode, self.duration)
+            self.cpu.start()
+
+    def toggle_memory(self):
+        """
+        Start tracing allocations, or report on them and stop
+        """
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.baseline = tracemalloc.take_snapshot()
+                self.logger.warning("tracing memory allocations, send SIGUSR2 again to write a report")
+                return
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            baseline, self.baseline = self.baseline, None
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        snapshot = snapshot.filter_traces(filters)
+        path = self.filename("memory", "txt")
+        with open(path, "w") as f:
+            f.write("Top %s allocation sites:\n" % self.top)
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                f.write("%s\n" % stat)
+            f.write("\nTop %s changes since tracing started:\n" % self.top)
+            for stat in snapshot.compare_to(baseline.filter_traces(filters), "lineno")[:self.top]:
+                f.write("%s\n" % stat)
+            f.write("\nLargest allocation tracebacks:\n")
+            for stat in snapshot.statistics("traceback")[:min(self.top, 10)]:
+                f.write("%s\n" % stat)
+                for line in stat.traceback.format():
+                    f.write("%s\n" % line)
+        snapshot.dump(self.filename("memory", "tracemalloc"))
+        self.logger.warning("wrote memory report to %s", path)
+
+    def stop(self):
+        """
+        Finish any profile in progress, for use at shutdown
+        """
+        with self.lock:
+            if self.cpu and self.cpu.is_alive():
+                self.cpu.stop()
+                self.cpu.join(10)
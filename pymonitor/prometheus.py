@@ -0,0 +1,277 @@
+from pymonitor import Backend
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from array import array
+from time import time_ns
+import math
+import gzip
+import json
+import re
+
+
+NAME_INVALID = re.compile(r"[^a-zA-Z0-9_]")
+LABEL_ESCAPES = str.maketrans({"\\": r"\\", '"': r'\"', "\n": r"\n"})
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metric_name(*parts):
+    """
+    Join parts into a valid prometheus metric or label name
+    """
+    name = NAME_INVALID.sub("_", "_".join(parts))
+    return "_" + name if name[0].isdigit() else name
+
+
+def format_value(value):
+    if math.isfinite(value):
+        return repr(value)
+    if math.isnan(value):
+        return "NaN"
+    return "+Inf" if value > 0 else "-Inf"
+
+
+class ExpositionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        backend = self.server.backend
+        path = self.path.partition("?")[0]
+        if path == "/metrics":
+            body, compressed = backend.exposition("gzip" in self.headers.get("Accept-Encoding", ""))
+            content_type = CONTENT_TYPE
+        elif path == "/recent":
+            body, compressed = json.dumps(backend.recent()).encode(), False
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PrometheusBackend(Backend):
+    """
+    Serves the latest value of every series for prometheus to scrape, instead of pushing data anywhere. Each numeric
+    field of a metric is a series named `<prefix>_<type>_<field>`, labelled with the metric's tags.
+
+    Series live in preallocated arrays indexed by a slot number: the latest value and its timestamp, plus a ring of the
+    last `history` samples, which /recent returns as json. The text exposition is rendered on the first scrape after new
+    data arrives and served from cache until the next, so scrapes from several prometheus servers cost little.
+    """
+    def __init__(self, master, conf):
+        super().__init__(master, conf)
+        self.server = None
+        self.prefix = self.conf.get("prefix", "pymonitor")
+        self.capacity = int(self.conf.get("max_series", 10000))
+        self.history = int(self.conf.get("history", 10))
+        self.ttl = int(float(self.conf.get("ttl", 600)) * 10 ** 9)
+        self.timestamps = bool(self.conf.get("timestamps", False))
+        self.labels = {metric_name(k): str(v) for k, v in self.conf.get("labels", {}).items()}
+
+        self.lock = Lock()
+        self.groups = {}  # sorted metric tags -> {field: slot}
+        self.keys = [None] * self.capacity  # slot -> (sorted metric tags, field, name)
+        self.prefixes = [None] * self.capacity  # slot -> 'name{label="value",...} ' as bytes
+        self.families = {}  # name -> {slot: None}, ordered by registration
+        self.free = list(range(self.capacity - 1, -1, -1))
+        self.latest = array("d", [math.nan]) * self.capacity
+        self.updated = array("q", [0]) * self.capacity  # timestamps of the latest samples, in nanoseconds
+        self.ring = array("d", [math.nan]) * (self.capacity * self.history)
+        self.ring_times = array("q", [0]) * (self.capacity * self.history)
+        self.ring_next = array("l", [0]) * self.capacity
+        self.version = 0
+        self.rejected = 0
+        self.cache = (-1, None, None)  # (version, exposition, gzipped exposition)
+
+    def connect(self):
+        """
+        Start the http server
+        """
+        address = (self.conf.get("listen", "0.0.0.0"), int(self.conf.get("port", 9150)))
+        self.server = ThreadingHTTPServer(address, ExpositionHandler)
+        self.server.daemon_threads = True
+        self.server.backend = self
+        Thread(target=self.server.serve_forever, name="prometheus", daemon=True).start()
+        self.logger.info("serving metrics on %s:%s", *self.server.server_address[:2])
+
+    def register(self, tags, field):
+        """
+        Allocate a slot for a new series. Must be called with the lock held.
+        :param tags: the metric's tags, as sorted (key, value) pairs
+        :return: the slot, or None if every slot is in use
+        """
+        if not self.free:
+            self.expire()
+            if not self.free:
+                return None
+        slot = self.free.pop()
+        labels = dict(self.labels)
+        name = None
+        for key, value in tags:
+            if key == "type":
+                name = metric_name(self.prefix, str(value), field)
+            else:
+                labels[metric_name(key)] = str(value)
+        label_text = ",".join('%s="%s"' % (key, value.translate(LABEL_ESCAPES)) for key, value in sorted(labels.items()))
+        self.prefixes[slot] = ("%s{%s} " % (name, label_text) if label_text else "%s " % name).encode("utf-8")
+        self.keys[slot] = (tags, field, name)
+        self.groups.setdefault(tags, {})[field] = slot
+        self.families.setdefault(name, {})[slot] = None
+        self.ring_next[slot] = 0
+        base = slot * self.history
+        for index in range(base, base + self.history):
+            self.ring_times[index] = 0
+        return slot
+
+    def expire(self, now=None):
+        """
+        Free the slots of series not updated within the ttl. Must be called with the lock held.
+        """
+        cutoff = (now or time_ns()) - self.ttl
+        for slot, key in enumerate(self.keys):
+            if key is not None and self.updated[slot] < cutoff:
+                tags, field, name = key
+                del self.groups[tags][field]
+                if not self.groups[tags]:
+                    del self.groups[tags]
+                del self.families[name][slot]
+                if not self.families[name]:
+                    del self.families[name]
+                self.keys[slot] = self.prefixes[slot] = None
+                self.free.append(slot)
+                self.version += 1
+
+    def add_data(self, metric):
+        """
+        Record a Metric() object's numeric fields as the latest values of their series. A metric counts as delivered
+        if any of its fields were recorded, and as dropped if every new series it needed was refused past max_series.
+        """
+        tags = tuple(sorted(metric.tags.items()))
+        timestamp = metric.timestamp
+        history = self.history
+        stored = refused = 0
+        with self.lock:
+            slots = self.groups.get(tags, {})
+            for field, value in metric.values.items():
+                slot = slots.get(field)
+                if slot is None:
+                    if isinstance(value, bool):
+                        value = float(value)
+                    if not isinstance(value, (int, float)):
+                        continue
+                    slot = self.register(tags, field)
+                    if slot is None:
+                        refused += 1
+                        continue
+                    slots = self.groups[tags]
+                try:
+                    self.latest[slot] = value
+                except TypeError:
+                    continue  # the field is no longer a number
+                self.updated[slot] = timestamp
+                position = self.ring_next[slot]
+                index = slot * history + position
+                self.ring[index] = value
+                self.ring_times[index] = timestamp
+                self.ring_next[slot] = position + 1 if position + 1 < history else 0
+                stored += 1
+            self.version += 1
+            self.rejected += refused
+        if stored:
+            self.succeeded(1)
+        elif refused:
+            self.dropped.inc()
+        if refused:
+            self.logger.debug("%s samples rejected, max_series reached", self.rejected)
+
+    def exposition(self, compressed=False):
+        """
+        Return (body, compressed) for a scrape, rendering only if data arrived since the last one
+        """
+        with self.lock:
+            version, text, gzipped = self.cache
+            if version != self.version:
+                self.expire()
+                text = self.render()
+                gzipped = None
+                self.cache = (self.version, text, gzipped)
+            if not compressed:
+                return text, False
+            if gzipped is None:
+                gzipped = gzip.compress(text, 6)
+                self.cache = (self.version, text, gzipped)
+            return gzipped, True
+
+    def render(self):
+        """
+        Return the text exposition of every series. Must be called with the lock held.
+        """
+        lines = []
+        for name, slots in self.families.items():
+            lines.append(b"# TYPE %s gauge\n" % name.encode())
+            for slot in slots:
+                line = self.prefixes[slot] + format_value(self.latest[slot]).encode()
+                if self.timestamps:
+                    line += b" %d" % (self.updated[slot] // 10 ** 6)
+                lines.append(line + b"\n")
+        return b"".join(lines)
+
+    def recent(self):
+        """
+        Return the samples in every series' ring, oldest first, as {series: [[timestamp ms, value], ...]}
+        """
+        result = {}
+        with self.lock:
+            for slot, key in enumerate(self.keys):
+                if key is None:
+                    continue
+                base = slot * self.history
+                start = self.ring_next[slot]
+                samples = []
+                for offset in range(self.history):
+                    index = base + (start + offset) % self.history
+                    if self.ring_times[index]:
+                        samples.append([self.ring_times[index] // 10 ** 6, self.ring[index]])
+                result[self.prefixes[slot].decode().strip()] = samples
+        return result
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        super().close()
+
+
+if __name__ == '__main__':
+    # Benchmark: scrape cost for a cached exposition versus rendering it for every scrape
+    from pymonitor import Metric
+    from types import SimpleNamespace
+    from timeit import timeit
+    import sys
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    backend = PrometheusBackend(SimpleNamespace(monitors=[]), {"max_series": count * 4})
+    now = time_ns()
+    metrics = [Metric({"rx_bytes": 1000 + i, "tx_bytes": 2000 + i, "rx_ps": 1.5, "tx_ps": 2.5},
+                      {"type": "ifstats", "iface": "veth%05d" % i}, now) for i in range(count)]
+    print("add %s metrics: %.1fms" % (count, timeit(lambda: [backend.add_data(m) for m in metrics], number=1) * 1e3))
+    print("add again (existing series): %.1fms" % (timeit(lambda: [backend.add_data(m) for m in metrics], number=1) * 1e3))
+    body, _ = backend.exposition()
+    print("%s series, exposition %s bytes, %s gzipped" % (len(backend.keys) - len(backend.free), len(body),
+                                                         len(backend.exposition(True)[0])))
+
+    def render():
+        with backend.lock:
+            backend.render()
+
+    print("render:        %8.2fms per scrape" % (timeit(render, number=20) / 20 * 1e3))
+    print("cached:        %8.2fus per scrape" % (timeit(backend.exposition, number=10000) / 10000 * 1e6))
+    print("cached gzip:   %8.2fus per scrape" % (timeit(lambda: backend.exposition(True), number=10000) / 10000 * 1e6))
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from threading import RLock
+from time import time, monotonic
+import traceback
+import logging
+import json
+import os
+
+
+# Directory trackers snapshot their state to, if set by configure()
+state_dir = None
+save_interval = 60.0
+trackers = []
+
+
+def configure(directory, interval=60.0):
+    """
+    Enable snapshotting of all trackers' state to files in a directory, so rates resume immediately after a restart
+    :param directory: directory to hold one state file per tracker
+    :param interval: minimum seconds between snapshots
+    """
+    global state_dir, save_interval
+    state_dir = directory
+    save_interval = interval
+    os.makedirs(directory, exist_ok=True)
+
+
+def save_all():
+    """
+    Snapshot every tracker, for use at shutdown
+    """
+    for tracker in trackers:
+        tracker.save()
+
+
+def counter_delta(current, last, bits=64):
+    """
+    Return the increase of a counter between two samples. A counter in the top half of its range that goes backwards is
+    assumed to have wrapped. Any other decrease means the counter was reset and None is returned.
+    :param bits: width of the counter, which wraps at 2 ** bits
+    """
+    if current >= last:
+        return current - last
+    if 2 ** (bits - 1) <= last < 2 ** bits:
+        return current + 2 ** bits - last
+    return None
+
+
+class RateTracker(object):
+    """
+    Remembers the last sample of counters for many series, such as one per network interface, and returns the change
+    since that sample each time a new one is recorded. Series not updated within `ttl` seconds are forgotten, as are the
+    least recently updated series once there are more than `max_series`.
+    """
+    def __init__(self, name, ttl=3600, max_series=10000):
+        """
+        :param name: name of the tracker's state file
+        """
+        self.name = name
+        self.ttl = ttl
+        self.max_series = max_series
+        self.logger = logging.getLogger("monitordaemon.rates.%s" % name)
+        self.lock = RLock()
+        self.series = OrderedDict()  # key -> (counters, monotonic time), least recently updated first
+        self.loaded = False
+        self.last_save = monotonic()
+        trackers.append(self)
+
+    def update(self, key, counters, widths=None):
+        """
+        Record a sample for a series
+        :param key: string identifying the series
+        :param counters: sequence of integer counters. Must be the same length and order on every call for a key.
+        :param widths: sequence of the bit width of each counter, for those that wrap before 64 bits
+        :return: (deltas, elapsed seconds) since the series' previous sample, or None if there is no previous sample
+                 or any counter was reset
+        """
+        now = monotonic()
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            last = self.series.pop(key, None)
+            self.series[key] = (counters, now)
+            self.evict(now)
+            if state_dir and now - self.last_save >= save_interval:
+                self.save()
+        if last is None or now <= last[1]:
+            return None
+        if widths is None:
+            deltas = [counter_delta(current, previous) for current, previous in zip(counters, last[0])]
+        else:
+            deltas = [counter_delta(current, previous, bits)
+                      for current, previous, bits in zip(counters, last[0], widths)]
+        if None in deltas:
+            self.logger.debug("counters for %s were reset", key)
+            return None
+        return deltas, now - last[1]
+
+    def evict(self, now):
+        """
+        Drop expired series and any over the size limit. Must be called with the lock held.
+        """
+        while self.series:
+            key, (_, updated) = next(iter(self.series.items()))
+            if now - updated < self.ttl and len(self.series) <= self.max_series:
+                break
+            del self.series[key]
+
+    def load(self):
+        """
+        Restore series from the state file, if any. Sample times are carried across the restart as wall clock times.
+        """
+        self.loaded = True
+        if not state_dir:
+            return
+        path = os.path.join(state_dir, "%s.json" % self.name)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except Exception:
+            self.logger.warning("could not load %s: %s", path, traceback.format_exc())
+            return
+        offset = monotonic() - time()
+        for key, counters, wall_time in saved:
+            self.series[key] = (counters, wall_time + offset)
+        self.evict(monotonic())
+        self.logger.debug("restored %s series", len(self.series))
+
+    def save(self):
+        """
+        Write all series to the state file
+        """
+        if not state_dir:
+            return
+        offset = time() - monotonic()
+        path = os.path.join(state_dir, "%s.json" % self.name)
+        with self.lock:
+            with open(path + ".tmp", "w") as f:
+                json.dump([[key, list(counters), updated + offset]
+                           for key, (counters, updated) in self.series.items()], f)
+            os.replace(path + ".tmp", path)
+            self.last_save = monotonic()
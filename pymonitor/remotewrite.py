@@ -0,0 +1,385 @@
+from pymonitor import Backend
+from pymonitor.batching import Batcher, backoff
+from pymonitor.prometheus import metric_name
+from time import sleep, monotonic
+import struct
+import sys
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+
+HEADERS = {"Content-Type": "application/x-protobuf",
+           "Content-Encoding": "snappy",
+           "X-Prometheus-Remote-Write-Version": "0.1.0"}
+DOUBLE = struct.Struct("<d")
+
+
+def varint(value):
+    """
+    Encode a non-negative integer as a protobuf varint
+    """
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_varint(data, pos):
+    """
+    Decode the varint at data[pos:]
+    :return: (value, position after it)
+    """
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def delimited(number, payload):
+    """
+    Encode a length delimited protobuf field
+    """
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def encode_sample(value, timestamp):
+    """
+    Encode a Sample message: double value = 1, int64 timestamp (milliseconds) = 2
+    """
+    return b"\x09" + DOUBLE.pack(value) + b"\x10" + varint(timestamp & 0xffffffffffffffff)
+
+
+def snappy_compress(data):
+    """
+    Compress data in the snappy block format. This pure python version finds the matches a label heavy WriteRequest is
+    full of, but is far slower than the C implementation in python-snappy, which is used when installed.
+    """
+    length = len(data)
+    out = bytearray(varint(length))
+    table = {}
+    literal = 0  # start of the pending literal run
+    pos = 0
+    misses = 0
+    limit = length - 4
+    while pos <= limit:
+        key = data[pos:pos + 4]
+        candidate = table.get(key)
+        table[key] = pos
+        if candidate is None or pos - candidate > 0xffff:
+            misses += 1
+            pos += 1 + (misses >> 5)  # skip ahead faster through incompressible data, as snappy does
+            continue
+        misses = 0
+        # extend the match, 16 bytes at a time and then byte by byte
+        end = pos + 4
+        source = candidate + 4
+        while end + 16 <= length and data[end:end + 16] == data[source:source + 16]:
+            end += 16
+            source += 16
+        while end < length and data[end] == data[source]:
+            end += 1
+            source += 1
+        if literal < pos:
+            emit_literal(out, data[literal:pos])
+        emit_copy(out, pos - candidate, end - pos)
+        pos = literal = end
+    if literal < length:
+        emit_literal(out, data[literal:])
+    return bytes(out)
+
+
+def emit_literal(out, chunk):
+    n = len(chunk) - 1
+    if n < 60:
+        out.append(n << 2)
+    elif n < 0x100:
+        out += bytes((60 << 2, n))
+    elif n < 0x10000:
+        out.append(61 << 2)
+        out += n.to_bytes(2, "little")
+    elif n < 0x1000000:
+        out.append(62 << 2)
+        out += n.to_bytes(3, "little")
+    else:
+        out.append(63 << 2)
+        out += n.to_bytes(4, "little")
+    out += chunk
+
+
+def emit_copy(out, offset, length):
+    while length >= 68:
+        out += bytes((63 << 2 | 2, offset & 0xff, offset >> 8))
+        length -= 64
+    if length > 64:
+        out += bytes((59 << 2 | 2, offset & 0xff, offset >> 8))
+        length -= 60
+    if length < 12 and offset < 2048:
+        out += bytes(((offset >> 8) << 5 | (length - 4) << 2 | 1, offset & 0xff))
+    else:
+        out += bytes(((length - 1) << 2 | 2, offset & 0xff, offset >> 8))
+
+
+def snappy_decompress(data):
+    """
+    Decompress snappy block format data
+    """
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    end = len(data)
+    while pos < end:
+        tag = data[pos]
+        kind = tag & 3
+        if kind == 0:
+            n = tag >> 2
+            if n < 60:
+                pos += 1
+            else:
+                width = n - 59
+                n = int.from_bytes(data[pos + 1:pos + 1 + width], "little")
+                pos += 1 + width
+            out += data[pos:pos + n + 1]
+            pos += n + 1
+            continue
+        if kind == 1:
+            size = (tag >> 2 & 7) + 4
+            offset = (tag >> 5) << 8 | data[pos + 1]
+            pos += 2
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos + 1:pos + 3], "little")
+            pos += 3
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[pos + 1:pos + 5], "little")
+            pos += 5
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            for index in range(start, start + size):
+                out.append(out[index])
+    if len(out) != length:
+        raise ValueError("snappy data decompressed to %s bytes, expected %s" % (len(out), length))
+    return bytes(out)
+
+
+def decode_write_request(data):
+    """
+    Decode an uncompressed WriteRequest, for the stub receiver and tests
+    :return: list of (labels dict, [(value, timestamp ms), ...]) per series
+    """
+    def messages(data):
+        pos = 0
+        while pos < len(data):
+            key, pos = read_varint(data, pos)
+            if key & 7 == 2:
+                size, pos = read_varint(data, pos)
+                yield key >> 3, data[pos:pos + size]
+                pos += size
+            elif key & 7 == 1:
+                yield key >> 3, data[pos:pos + 8]
+                pos += 8
+            else:
+                value, pos = read_varint(data, pos)
+                yield key >> 3, value
+
+    series = []
+    for _, timeseries in messages(data):
+        labels = {}
+        samples = []
+        for number, payload in messages(timeseries):
+            if number == 1:
+                label = dict(messages(payload))
+                labels[label.get(1, b"").decode()] = label.get(2, b"").decode()
+            else:
+                sample = dict(messages(payload))
+                timestamp = sample.get(2, 0)
+                samples.append((DOUBLE.unpack(sample.get(1, bytes(8)))[0],
+                                timestamp - (1 << 64) if timestamp >= 1 << 63 else timestamp))
+        series.append((labels, samples))
+    return series
+
+
+class LabelCache(object):
+    """
+    Encoded label sets of recently seen series. When the cache reaches `size` entries it becomes the previous
+    generation and a new one starts; entries found in the previous generation move to the current one. Series seen
+    within the last two generations are never re-encoded, and no per-lookup bookkeeping is needed to evict the rest.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+
+    def get(self, key):
+        value = self.current.get(key)
+        if value is None:
+            value = self.previous.pop(key, None)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
+class RemoteWriteBackend(Backend):
+    """
+    Pushes samples to a prometheus remote write endpoint, such as prometheus itself, Mimir, Cortex, Thanos receive or
+    VictoriaMetrics. Each numeric field of a metric is a series named `<prefix>_<type>_<field>`, labelled with the
+    metric's tags and the host's sysinfo.
+
+    Series are spread over `shards` by their labels, each shard batching its samples into snappy compressed protobuf
+    WriteRequests and sending one at a time, so a series' samples are always sent in order and at most `shards` requests
+    are in flight. The encoded labels of each series are cached, so a batch of known series only encodes samples.
+    """
+    def __init__(self, master, conf):
+        super().__init__(master, conf)
+        self.url = self.conf["url"]
+        self.prefix = self.conf.get("prefix", "pymonitor")
+        self.retries = int(self.conf.get("retries", 3))
+        self.retry_backoff = float(self.conf.get("retry_backoff", 0.5))
+        self.timeout = float(self.conf.get("timeout", 10))
+        self.headers = dict(HEADERS, **self.conf.get("headers", {}))
+        self.auth = tuple(self.conf["basic_auth"]) if "basic_auth" in self.conf else None
+        self.labels = {metric_name(k): str(v) for k, v in self.sysinfo.items()}
+        self.labels.update({metric_name(k): str(v) for k, v in self.conf.get("labels", {}).items()})
+        self.series = LabelCache(int(self.conf.get("max_series", 100000)))
+        self.strings = {}  # label (name, value) -> encoded Label field, shared by every series using it
+        self.session = None
+        self.shards = []
+        if snappy is None:
+            self.logger.warning("python-snappy is not installed, compressing remote write requests in pure python")
+
+    def connect(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        shards = int(self.conf.get("shards", 2))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(shards, int(self.conf.get("pool_size", 10))))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.shards = [Batcher(self.send,
+                               max_items=int(self.conf.get("batch_size", 2000)),
+                               max_bytes=int(self.conf.get("batch_bytes", 4 * 1024 * 1024)),
+                               max_age=float(self.conf.get("batch_age", 5)),
+                               workers=1,
+                               max_pending=int(self.conf.get("max_pending", 2)),
+                               name="remotewrite-%s" % i) for i in range(shards)]
+        self.logger.debug("writing to %s with %s shards", self.url, shards)
+
+    def encode_labels(self, tags, field):
+        """
+        Return the encoded Label fields of a series, sorted by label name as remote write requires
+        """
+        labels = dict(self.labels)
+        for key, value in tags:
+            if key == "type":
+                labels["__name__"] = metric_name(self.prefix, str(value), field)
+            else:
+                labels[metric_name(key)] = str(value)
+        encoded = []
+        for pair in sorted(labels.items()):
+            label = self.strings.get(pair)
+            if label is None:
+                if len(self.strings) >= self.series.size:
+                    self.strings.clear()
+                name, value = (sys.intern(s) for s in pair)
+                label = delimited(1, delimited(1, name.encode()) + delimited(2, value.encode()))
+                self.strings[(name, value)] = label
+            encoded.append(label)
+        return b"".join(encoded)
+
+    def add_data(self, metric):
+        """
+        Accept a Metric() object and queue its samples on the shard owning its series
+        """
+        tags = tuple(sorted(metric.tags.items()))
+        timestamp = metric.timestamp // 10 ** 6
+        samples = []
+        for name, value in metric.values.items():
+            if isinstance(value, bool):
+                value = float(value)
+            elif not isinstance(value, (int, float)):
+                continue
+            key = (tags, name)
+            labels = self.series.get(key)
+            if labels is None:
+                labels = self.encode_labels(tags, name)
+                self.series.set(key, labels)
+            samples.append((labels, encode_sample(value, timestamp)))
+        if samples:
+            self.shards[hash(tags) % len(self.shards)].add((metric, samples), 32 * len(samples))
+
+    def encode(self, batch):
+        """
+        Build a WriteRequest from a batch of (metric, [(labels, sample), ...]), with one TimeSeries per series
+        """
+        series = {}
+        for _, samples in batch:
+            for labels, sample in samples:
+                encoded = b"\x12" + varint(len(sample)) + sample
+                if labels in series:
+                    series[labels].append(encoded)
+                else:
+                    series[labels] = [labels, encoded]
+        return b"".join(delimited(1, b"".join(parts)) for parts in series.values())
+
+    def send(self, batch):
+        """
+        Write a batch of samples. Requests failing with a connection error, 429 or 5xx are retried with backoff and
+        passed to failed() once retries run out; other rejections would fail again on retry, so are logged and dropped.
+        """
+        body = self.encode(batch)
+        body = snappy.compress(body) if snappy else snappy_compress(body)
+        count = sum(len(samples) for _, samples in batch)
+
+        self.batch_size.observe(count)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                sleep(backoff(attempt, self.retry_backoff))
+            start = monotonic()
+            try:
+                response = self.session.post(self.url, data=body, headers=self.headers, auth=self.auth,
+                                             timeout=self.timeout)
+            except Exception as e:
+                self.send_seconds.observe(monotonic() - start)
+                self.logger.warning("remote write failed (attempt %s): %s", attempt + 1, e)
+                continue
+            self.send_seconds.observe(monotonic() - start)
+            if response.status_code < 300:
+                self.succeeded(len(batch))
+                self.logger.debug("wrote %s samples", count)
+                return
+            if response.status_code != 429 and response.status_code < 500:
+                self.logger.warning("remote write of %s samples rejected: %s %s", count, response.status_code,
+                                    response.text[:500])
+                self.refused(len(batch))
+                return
+            self.logger.warning("remote write failed (attempt %s): %s %s", attempt + 1, response.status_code,
+                                response.text[:500])
+        self.failed([metric for metric, _ in batch])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        if self.session:
+            self.session.close()
+        super().close()
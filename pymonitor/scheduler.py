@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from heapq import heappush, heappop
+from itertools import count
+from time import time, monotonic
+from math import floor
+from zlib import crc32
+import traceback
+import logging
+import socket
+
+
+def host_offset(name, interval, jitter, host=None):
+    """
+    Return a stable offset in [0, min(jitter, interval)) seconds for the named job on this host. Hosts running the same
+    config get different offsets, so a fleet does not report at the same instant, but a host's offset never changes.
+    """
+    spread = min(jitter, interval)
+    if spread <= 0:
+        return 0.0
+    key = "%s/%s" % (host or socket.gethostname(), name)
+    return crc32(key.encode("utf-8")) / 2 ** 32 * spread
+
+
+class Job(object):
+    """
+    Schedule state for a callable run every `interval` seconds
+    """
+    def __init__(self, name, func, interval, offset=0.0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.offset = offset % interval
+        self.running = False
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_duration = 0.0
+
+
+class Scheduler(object):
+    """
+    Runs jobs on a single timer thread backed by a heap of due times on the monotonic clock. Due jobs are dispatched to
+    a small pool of worker threads. Runs are aligned so they start at wall clock multiples of the job's interval, plus
+    the job's offset.
+    """
+    def __init__(self, workers=4):
+        self.logger = logging.getLogger("monitordaemon.scheduler")
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="monitor")
+        self.lock = Condition()
+        self.heap = []
+        self.seq = count()
+        self.alive = True
+
+    def add(self, job):
+        """
+        Schedule a job, first running at the next interval boundary
+        """
+        now_wall = time()
+        boundary = (floor((now_wall - job.offset) / job.interval) + 1) * job.interval + job.offset
+        with self.lock:
+            heappush(self.heap, (monotonic() + boundary - now_wall, next(self.seq), job))
+            self.lock.notify()
+
+    def run(self):
+        """
+        Dispatch jobs as they become due until shutdown() is called
+        """
+        self.logger.debug("starting scheduler")
+        with self.lock:
+            while self.alive:
+                if not self.heap:
+                    self.lock.wait()
+                    continue
+                due, _, job = self.heap[0]
+                now = monotonic()
+                if due > now:
+                    self.lock.wait(due - now)
+                    continue
+                heappop(self.heap)
+
+                if job.running:
+                    job.skipped += 1
+                    self.logger.warning("%s is still running from a previous interval, skipping this run", job.name)
+                else:
+                    job.running = True
+                    self.pool.submit(self.execute, job)
+
+                # If the timer thread fell behind, don't replay every missed slot; resume at the next boundary
+                missed = floor((now - due) / job.interval)
+                if missed:
+                    job.skipped += missed
+                    self.logger.warning("%s missed %s intervals", job.name, missed)
+                heappush(self.heap, (due + (missed + 1) * job.interval, next(self.seq), job))
+        self.pool.shutdown(wait=True)
+        self.logger.debug("scheduler exited")
+
+    def execute(self, job):
+        """
+        Run a job on a worker thread and record how long it took
+        """
+        before = monotonic()
+        try:
+            job.func()
+        except Exception:
+            self.logger.warning("%s failed: %s", job.name, traceback.format_exc())
+        finally:
+            job.last_duration = monotonic() - before
+            job.runs += 1
+            job.running = False
+        if job.last_duration > job.interval:
+            job.overruns += 1
+            self.logger.warning("%s overran its %ss interval: took %.3fs", job.name, job.interval, job.last_duration)
+
+    def shutdown(self):
+        """
+        Stop dispatching jobs. run() returns once running jobs have finished.
+        """
+        with self.lock:
+            self.alive = False
+            self.lock.notify()
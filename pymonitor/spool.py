@@ -0,0 +1,216 @@
+from pymonitor import Metric
+from threading import Thread, Event, Lock
+from time import monotonic
+import traceback
+import logging
+import json
+import os
+
+
+class Spool(object):
+    """
+    Append-only local store for metrics a backend failed to deliver. Records are newline-delimited json written to
+    numbered segment files. When the spool grows past its size cap the oldest segments are deleted. A cursor file tracks
+    how far replay has progressed so a restart doesn't replay the same records twice.
+    """
+    FSYNC_POLICIES = ("always", "interval", "never")
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024, max_size=1024 * 1024 * 1024, fsync="interval",
+                 fsync_interval=1.0):
+        """
+        :param path: directory holding the spool's segments
+        :param segment_size: size in bytes after which a new segment is started
+        :param max_size: total size in bytes after which the oldest segments are deleted
+        :param fsync: `always` to fsync after every write, `interval` to fsync at most every fsync_interval seconds or
+                      `never` to leave flushing to the OS
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise Exception("Invalid spool fsync policy: %s" % fsync)
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.logger = logging.getLogger("monitordaemon.spool")
+        self.lock = Lock()
+        self.last_sync = monotonic()
+        self.evicted = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.segments = sorted(int(name[:-6]) for name in os.listdir(self.path) if name.endswith(".spool"))
+        self.sizes = {num: os.path.getsize(self.segment_path(num)) for num in self.segments}
+        if not self.segments:
+            self.segments.append(0)
+            self.sizes[0] = 0
+        self.writer = open(self.segment_path(self.segments[-1]), "ab")
+
+        self.cursor_path = os.path.join(self.path, "cursor")
+        self.read_segment, self.read_offset = self.segments[0], 0
+        if os.path.exists(self.cursor_path):
+            with open(self.cursor_path) as f:
+                segment, offset = json.load(f)
+            if segment in self.sizes:
+                self.read_segment, self.read_offset = segment, offset
+        self.reader = None
+
+    @classmethod
+    def from_config(cls, conf):
+        """
+        Create a spool from the `spool` section of a backend's config
+        """
+        return cls(conf["path"],
+                   segment_size=int(conf.get("segment_size", 16 * 1024 * 1024)),
+                   max_size=int(conf.get("max_size", 1024 * 1024 * 1024)),
+                   fsync=conf.get("fsync", "interval"),
+                   fsync_interval=float(conf.get("fsync_interval", 1)))
+
+    def segment_path(self, num):
+        return os.path.join(self.path, "%016d.spool" % num)
+
+    def pending(self):
+        """
+        Return the number of spooled bytes not yet replayed
+        """
+        with self.lock:
+            return sum(size for num, size in self.sizes.items() if num >= self.read_segment) - self.read_offset
+
+    def write(self, metrics):
+        """
+        Append metrics to the spool
+        """
+        data = b"".join(json.dumps([metric.timestamp, metric.values, metric.tags]).encode("utf-8") + b"\n"
+                        for metric in metrics)
+        with self.lock:
+            if self.sizes[self.segments[-1]] >= self.segment_size:
+                self._rotate()
+            self.writer.write(data)
+            self.sizes[self.segments[-1]] += len(data)
+            self.writer.flush()
+            if self.fsync == "always" or \
+                    (self.fsync == "interval" and monotonic() - self.last_sync >= self.fsync_interval):
+                os.fsync(self.writer.fileno())
+                self.last_sync = monotonic()
+            self._evict()
+
+    def _rotate(self):
+        """
+        Start a new segment. Must be called with the lock held.
+        """
+        if self.fsync != "never":
+            os.fsync(self.writer.fileno())
+        self.writer.close()
+        num = self.segments[-1] + 1
+        self.segments.append(num)
+        self.sizes[num] = 0
+        self.writer = open(self.segment_path(num), "ab")
+
+    def _evict(self):
+        """
+        Delete the oldest segments while the spool is over its size cap. Must be called with the lock held.
+        """
+        while len(self.segments) > 1 and sum(self.sizes.values()) > self.max_size:
+            self.logger.warning("spool is over %s bytes, evicting oldest segment", self.max_size)
+            self._delete(self.segments[0])
+            self.evicted += 1
+
+    def _delete(self, num):
+        """
+        Remove a segment, moving the read position past it if needed. Must be called with the lock held.
+        """
+        self.segments.remove(num)
+        del self.sizes[num]
+        os.unlink(self.segment_path(num))
+        if self.read_segment <= num:
+            if self.reader:
+                self.reader.close()
+                self.reader = None
+            self.read_segment, self.read_offset = self.segments[0], 0
+
+    def read(self, count):
+        """
+        Remove up to `count` of the oldest records from the spool and return them as Metric objects
+        """
+        metrics = []
+        with self.lock:
+            while len(metrics) < count:
+                if self.reader is None:
+                    self.reader = open(self.segment_path(self.read_segment), "rb")
+                    self.reader.seek(self.read_offset)
+                line = self.reader.readline()
+                if not line:
+                    if self.read_segment == self.segments[-1]:
+                        break
+                    # fully replayed a finished segment
+                    self._delete(self.read_segment)
+                    continue
+                self.read_offset += len(line)
+                try:
+                    timestamp, values, tags = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    self.logger.warning("skipping corrupt spool record in segment %s", self.read_segment)
+                    continue
+                metrics.append(Metric(values, tags, timestamp))
+            if metrics:
+                with open(self.cursor_path + ".tmp", "w") as f:
+                    json.dump([self.read_segment, self.read_offset], f)
+                os.replace(self.cursor_path + ".tmp", self.cursor_path)
+        return metrics
+
+    def close(self):
+        with self.lock:
+            if self.fsync != "never":
+                os.fsync(self.writer.fileno())
+            self.writer.close()
+            if self.reader:
+                self.reader.close()
+
+
+class Replayer(Thread):
+    """
+    Feeds spooled metrics back into a backend once it is accepting data again. Replay is capped at `rate` metrics per
+    second and pauses while the live outbound queue is more than half full, so it never crowds out live data.
+    """
+    def __init__(self, backend, queue, rate=1000, batch=500, name="replayer"):
+        """
+        :param backend: Backend whose spool is drained
+        :param queue: the backend's live OutboundQueue
+        :param rate: maximum metrics replayed per second
+        :param batch: maximum metrics read from the spool at once
+        """
+        Thread.__init__(self, name=name, daemon=True)
+        self.backend = backend
+        self.spool = backend.spool
+        self.queue = queue
+        self.rate = rate
+        self.batch = batch
+        self.logger = logging.getLogger("monitordaemon.%s" % name)
+        self.stopped = Event()
+        self.replayed = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.backend.healthy or self.queue.depth() > self.queue.size / 2:
+                self.stopped.wait(1)
+                continue
+            before = monotonic()
+            metrics = self.spool.read(min(self.batch, self.rate))
+            if not metrics:
+                self.stopped.wait(1)
+                continue
+            try:
+                for metric in metrics:
+                    self.backend.add_data(metric)
+            except Exception:
+                self.logger.warning("replay failed: %s", traceback.format_exc())
+                self.backend.failed(metrics)
+                continue
+            self.replayed += len(metrics)
+            self.logger.debug("replayed %s metrics", len(metrics))
+            # sleep off the remainder of this batch's share of the rate cap
+            remaining = len(metrics) / self.rate - (monotonic() - before)
+            if remaining > 0:
+                self.stopped.wait(remaining)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,131 @@
+from threading import Lock
+from bisect import bisect_left
+
+
+# Default histogram bucket upper bounds, for durations in seconds and for counts of items
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Counter(object):
+    """
+    A count that only goes up
+    """
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """
+    A value read from a callback when telemetry is collected, so the code being measured does no extra work. The
+    callback returns a number, or a dict of name->number for several related values.
+    """
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+
+class Histogram(object):
+    """
+    Counts of observed values in fixed buckets, plus their sum. `bounds` are the buckets' inclusive upper bounds; values
+    above the last bound land in an extra overflow bucket. Observing a value is a binary search and two additions.
+    """
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """
+        Return (bucket counts, sum) as of now
+        """
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+def estimate(bounds, counts, pct):
+    """
+    Estimate a percentile from histogram bucket counts by interpolating within the bucket it falls in. Values in the
+    overflow bucket are reported as the last bound.
+    :return: the estimate, or None if the counts are all zero
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = pct / 100 * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index == len(bounds):
+                return float(bounds[-1])
+            lower = bounds[index - 1] if index else 0.0
+            return lower + (bounds[index] - lower) * (rank - seen) / count
+        seen += count
+    return float(bounds[-1])
+
+
+class Registry(object):
+    """
+    The daemon's own metrics, each identified by a name and a set of labels
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.series = {}  # (name, sorted label items) -> Counter, Gauge or Histogram
+
+    def get(self, name, labels, factory):
+        """
+        Return the metric with the given name and labels, creating it with factory() if it doesn't exist yet
+        """
+        key = (name, tuple(sorted(labels.items())))
+        try:
+            return self.series[key]
+        except KeyError:
+            with self.lock:
+                if key not in self.series:
+                    self.series[key] = factory()
+                return self.series[key]
+
+    def collect(self):
+        """
+        Return a list of (name, labels dict, metric) for every registered metric
+        """
+        with self.lock:
+            items = list(self.series.items())
+        return [(name, dict(labels), metric) for (name, labels), metric in items]
+
+
+registry = Registry()
+
+
+def counter(name, **labels):
+    return registry.get(name, labels, Counter)
+
+
+def histogram(name, buckets=LATENCY_BUCKETS, **labels):
+    return registry.get(name, labels, lambda: Histogram(buckets))
+
+
+def gauge(name, func, **labels):
+    """
+    Register a callback gauge. A later registration under the same name and labels replaces the callback.
+    """
+    metric = registry.get(name, labels, lambda: Gauge(func))
+    metric.func = func
+    return metric
@@ -0,0 +1,142 @@
+from pymonitor import Metric
+from pymonitor import rates
+import multiprocessing
+import traceback
+import logging
+import marshal
+import signal
+import sys
+
+
+# forkserver children are forked from a clean single threaded server process, rather than from the daemon and its
+# many threads, some of which may hold locks at the time of the fork
+context = multiprocessing.get_context("forkserver")
+
+
+class WorkerError(Exception):
+    """
+    A checker function raised an exception in a worker process
+    """
+    pass
+
+
+def serve(conn, module, paths, state_dir):
+    """
+    Worker process main loop: run the checker function with each set of args received and send back the metrics it
+    yields. Requests and replies are marshal encoded; a reply is (True, [(values, tags, timestamp), ...]) or
+    (False, traceback).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the daemon handles ^C and stops us by closing the pipe
+    sys.path.extend(paths)
+    if state_dir:
+        rates.configure(state_dir)
+    checker_func = getattr(__import__(module), module)
+    conn.send_bytes(b"")  # ready
+    while True:
+        try:
+            args = marshal.loads(conn.recv_bytes())
+        except EOFError:
+            break
+        try:
+            reply = (True, [(metric.values, metric.tags, metric.timestamp) for metric in checker_func(**args)])
+            data = marshal.dumps(reply)
+        except Exception:
+            data = marshal.dumps((False, traceback.format_exc()))
+        conn.send_bytes(data)
+    rates.save_all()
+
+
+class ProcessWorker(object):
+    """
+    Runs a monitor's checker function in a child process. Its CPU time doesn't contend with the daemon's threads for the
+    GIL, and a call that doesn't return in time is stopped by killing the process, which is restarted on the next call.
+    Any state the monitor keeps between runs, such as counters for rates, lives in the child and is lost if it is
+    killed.
+    """
+    def __init__(self, module, paths=(), state_dir=None, name="worker"):
+        """
+        :param module: name of the monitor module, which holds a checker function of the same name
+        :param paths: directories to add to the child's sys.path, to find the module
+        :param state_dir: directory for the child's rate tracker snapshots, see rates.configure()
+        """
+        self.module = module
+        self.paths = list(paths)
+        self.state_dir = state_dir
+        self.name = name
+        self.logger = logging.getLogger("monitordaemon.worker.%s" % name)
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+
+    def start(self, timeout=60):
+        """
+        Start the worker process and wait until it has imported the monitor
+        """
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=serve, args=(child_conn, self.module, self.paths, self.state_dir),
+                                       name="pymonitor-%s" % self.name, daemon=True)
+        self.process.start()
+        child_conn.close()
+        try:
+            if not self.conn.poll(timeout):
+                raise WorkerError("worker process did not start within %ss" % timeout)
+            self.conn.recv_bytes()
+        except (EOFError, OSError) as e:
+            self.kill()
+            raise WorkerError("worker process failed to start: %s" % e)
+        except WorkerError:
+            self.kill()
+            raise
+        self.logger.debug("started worker process %s", self.process.pid)
+
+    def call(self, args, timeout):
+        """
+        Run the checker function in the worker process
+        :param args: keyword args for the checker function
+        :param timeout: seconds to wait for the result before killing the worker
+        :return: list of Metric objects
+        :raises TimeoutError: if the call took too long
+        :raises WorkerError: if the checker raised an exception or the worker died
+        """
+        if self.process is None:
+            self.start()
+        try:
+            self.conn.send_bytes(marshal.dumps(args))
+            ready = self.conn.poll(timeout)
+            if ready:
+                ok, payload = marshal.loads(self.conn.recv_bytes())
+        except (EOFError, OSError) as e:
+            self.kill()
+            raise WorkerError("worker process died: %s" % e)
+        if not ready:
+            self.kill()
+            raise TimeoutError("no result within %ss" % timeout)
+        if not ok:
+            raise WorkerError(payload)
+        return [Metric(values, tags, timestamp) for values, tags, timestamp in payload]
+
+    def kill(self):
+        """
+        Stop the worker process immediately. A new one is started by the next call.
+        """
+        if self.process is None:
+            return
+        self.logger.warning("killing worker process %s", self.process.pid)
+        self.process.kill()
+        self.process.join(5)
+        self.conn.close()
+        self.process = self.conn = None
+        self.restarts += 1
+
+    def stop(self, timeout=5):
+        """
+        Ask the worker process to exit after any call in progress, killing it if it doesn't
+        """
+        if self.process is None:
+            return
+        self.conn.close()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout)
+        self.process = self.conn = None
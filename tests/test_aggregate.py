@@ -0,0 +1,69 @@
+from pymonitor import Metric
+from pymonitor.aggregate import Aggregator, percentile
+import unittest
+
+
+SECOND = 10 ** 9
+
+
+def load(t, value, host="a", **values):
+    return Metric(dict(values, load=value), {"type": "load", "host": host}, t * SECOND)
+
+
+class AggregatorTest(unittest.TestCase):
+    def test_window(self):
+        aggregator = Aggregator(window=60, stats=("min", "max", "mean", "last", "count"))
+        for t, value in ((60, 4), (70, 1), (100, 7), (119, 2)):
+            self.assertEqual(aggregator.process(load(t, value)), [])
+        metric, = aggregator.process(load(120, 5))
+        self.assertEqual(metric.values, {"load": 2, "load_min": 1, "load_max": 7, "load_mean": 3.5, "load_count": 4})
+        self.assertIsInstance(metric.values["load_min"], int)
+        self.assertEqual(metric.timestamp, 60 * SECOND)  # the window's start
+        self.assertEqual(metric.tags, {"type": "load", "host": "a"})
+
+    def test_series(self):
+        aggregator = Aggregator(window=10, stats=("max",))
+        for t in range(10):
+            aggregator.process(load(t, t, host="a"))
+            aggregator.process(load(t, -t, host="b"))
+        result = {metric.tags["host"]: metric.values for metric in aggregator.flush()}
+        self.assertEqual(result, {"a": {"load_max": 9}, "b": {"load_max": 0}})
+        self.assertEqual(aggregator.flush(), [])
+
+    def test_percentiles(self):
+        aggregator = Aggregator(window=100, stats=(), percentiles=(50, 95))
+        for t in range(100):
+            aggregator.process(load(t, float(99 - t)))
+        metric, = aggregator.flush()
+        self.assertEqual(metric.values, {"load_p50": 49.0, "load_p95": 94.0})
+        self.assertEqual(percentile([1, 2, 3], 0), 1)
+        self.assertEqual(percentile([1, 2, 3], 100), 3)
+
+    def test_other_fields(self):
+        aggregator = Aggregator(window=60, stats=("max",))
+        aggregator.process(load(0, 1, state="up", ok=True))
+        aggregator.process(load(1, 2, state="down", ok=False))
+        metric, = aggregator.flush()
+        self.assertEqual(metric.values, {"load_max": 2, "state": "down", "ok": False})
+
+    def test_changed_fields_close_the_window(self):
+        aggregator = Aggregator(window=60, stats=("last",))
+        aggregator.process(load(0, 1))
+        metric, = aggregator.process(load(1, 2, procs=3))
+        self.assertEqual(metric.values, {"load": 1})
+        metric, = aggregator.flush()
+        self.assertEqual(metric.values, {"load": 2, "procs": 3})
+
+    def test_mapping(self):
+        aggregator = Aggregator(stats=("min", "mean", "last", "count"), percentiles=(99.9,))
+        mapping = aggregator.extend_mapping({"load": {"type": "float"}, "host": {"type": "keyword"}})
+        self.assertEqual(mapping, {"load": {"type": "float"}, "host": {"type": "keyword"},
+                                   "load_min": {"type": "float"}, "load_mean": {"type": "double"},
+                                   "load_count": {"type": "long"}, "load_p99.9": {"type": "double"}})
+
+    def test_invalid_stat(self):
+        self.assertRaises(Exception, Aggregator.from_config, {"stats": ["median"]})
+
+
+if __name__ == '__main__':
+    unittest.main()
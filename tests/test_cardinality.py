@@ -0,0 +1,64 @@
+from pymonitor import Metric
+from pymonitor.cardinality import Limiter, Tracker
+import unittest
+
+
+SECOND = 10 ** 9
+
+
+def iface(t, name, rx=1, **tags):
+    return Metric({"rx": rx, "up": True}, dict(tags, type="ifstats", iface=name), t * SECOND)
+
+
+class TrackerTest(unittest.TestCase):
+    def test_limit_and_expiry(self):
+        tracker = Tracker(2, 10)
+        self.assertTrue(tracker.admit("a", 0))
+        self.assertTrue(tracker.admit("b", 5))
+        self.assertFalse(tracker.admit("c", 6))
+        self.assertTrue(tracker.admit("a", 8))  # known keys are always let through, and refreshed
+        self.assertTrue(tracker.admit("c", 16))  # b expired
+        self.assertFalse(tracker.admit("b", 17))
+        self.assertEqual(list(tracker.seen), ["a", "c"])
+
+
+class LimiterTest(unittest.TestCase):
+    def run_limiter(self, limiter, metrics):
+        return [metric for metric in metrics for metric in limiter.process(metric)] + limiter.flush()
+
+    def test_drop(self):
+        limiter = Limiter(max_series=3, overflow="drop", name="test-drop")
+        dropped = limiter.dropped.value
+        result = self.run_limiter(limiter, [iface(t, "eth%s" % i) for t in range(2) for i in range(5)])
+        self.assertEqual([metric.tags["iface"] for metric in result], ["eth0", "eth1", "eth2"] * 2)
+        self.assertEqual(limiter.dropped.value - dropped, 4)
+
+    def test_other(self):
+        limiter = Limiter(max_series=3, name="test-other")
+        result = self.run_limiter(limiter, [iface(t, "eth%s" % i, rx=i) for t in range(2) for i in range(5)])
+        self.assertEqual([(metric.tags["iface"], metric.values, metric.timestamp // SECOND) for metric in result],
+                         [("eth0", {"rx": 0, "up": True}, 0), ("eth1", {"rx": 1, "up": True}, 0),
+                          ("eth2", {"rx": 2, "up": True}, 0),
+                          ("other", {"rx": 7}, 0),  # the first run's rollup is sent when the second run starts
+                          ("eth0", {"rx": 0, "up": True}, 1), ("eth1", {"rx": 1, "up": True}, 1),
+                          ("eth2", {"rx": 2, "up": True}, 1), ("other", {"rx": 7}, 1)])
+
+    def test_tag_key_limit(self):
+        limiter = Limiter(max_series=0, keys={"iface": 2}, name="test-keys")
+        metrics = [iface(0, "eth%s" % i, host=host) for i in range(3) for host in ("a", "b")]
+        result = self.run_limiter(limiter, metrics)
+        # only the limited tag is rolled up, so the rollups are per host
+        self.assertEqual([(metric.tags["iface"], metric.tags["host"]) for metric in result],
+                         [("eth0", "a"), ("eth0", "b"), ("eth1", "a"), ("eth1", "b"), ("other", "a"), ("other", "b")])
+
+    def test_ttl(self):
+        limiter = Limiter(max_series=1, ttl=10, overflow="drop", name="test-ttl")
+        result = self.run_limiter(limiter, [iface(0, "eth0"), iface(5, "eth1"), iface(11, "eth1")])
+        self.assertEqual([metric.tags["iface"] for metric in result], ["eth0", "eth1"])
+
+    def test_invalid_overflow(self):
+        self.assertRaises(Exception, Limiter, overflow="sample")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+from pymonitor.monitors import cgroups
+from time import sleep
+from unittest import mock
+import tempfile
+import unittest
+import shutil
+import errno
+import os
+
+
+SERVICE = "/system.slice/service-0.service"
+
+
+class CgroupsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        cgroups.make_fixture(self.root, 40, seed=1)
+        cgroups.hierarchies.clear()
+
+    def tearDown(self):
+        for hierarchy in cgroups.hierarchies.values():
+            for cgroup in hierarchy.cgroups.values():
+                hierarchy.close(cgroup)
+        cgroups.hierarchies.clear()
+        shutil.rmtree(self.root)
+
+    def run_monitor(self, **args):
+        return {metric.tags["cgroup"]: metric.values for metric in cgroups.cgroups(self.root, max_depth=4, **args)}
+
+    def write(self, name, filename, content):
+        with open(os.path.join(self.root + name, filename), "w") as f:
+            f.write(content)
+
+    def test_recreated_cgroup_is_reopened(self):
+        self.assertNotEqual(self.run_monitor(rescan=0)[SERVICE]["memory_current"], 12345)
+        # Kernfs never reuses a directory's inode number, which ext4 and tmpfs may do for a directory removed and
+        # created again; building the new one before removing the old one gets the same effect here
+        path = self.root + SERVICE
+        shutil.copytree(path, path + ".new")
+        self.write(SERVICE + ".new", "memory.current", "12345\n")
+        shutil.rmtree(path)
+        os.rename(path + ".new", path)
+        values = self.run_monitor(rescan=0)[SERVICE]
+        self.assertEqual(values["memory_current"], 12345)
+        self.assertNotIn("cpu_usage", values)  # counters of the old cgroup aren't used for rates
+
+    def test_unreadable_cgroup_is_reopened(self):
+        self.run_monitor()
+        hierarchy, = cgroups.hierarchies.values()
+        cgroup = hierarchy.cgroups[SERVICE]
+        # swap in an fd that fails to read, as an open file of a removed cgroup does
+        os.close(cgroup.files[cgroups.CPU])
+        cgroup.files[cgroups.CPU] = os.open(self.root, os.O_RDONLY)
+        self.assertNotIn(SERVICE, self.run_monitor())
+        self.write(SERVICE, "memory.current", "12345\n")
+        self.assertEqual(self.run_monitor()[SERVICE]["memory_current"], 12345)
+
+    def test_unsupported_pressure_file(self):
+        self.run_monitor()
+        hierarchy, = cgroups.hierarchies.values()
+        cgroup = hierarchy.cgroups[SERVICE]
+        pressure = cgroup.files[cgroups.CPU_PRESSURE]
+        pread = os.pread
+
+        def failing_pread(fd, size, offset, code=errno.EOPNOTSUPP):
+            if fd == pressure:  # as with cgroup.pressure set to 0
+                raise OSError(code, os.strerror(code))
+            return pread(fd, size, offset)
+        with mock.patch("os.pread", failing_pread):
+            values = self.run_monitor()[SERVICE]
+        self.assertIn("memory_current", values)
+        self.assertIn("memory_peak", values)
+        self.assertFalse(hierarchy.stale)
+        self.assertIsNone(cgroup.files[cgroups.CPU_PRESSURE])
+        self.assertIn(SERVICE, self.run_monitor())
+
+        # a removed cgroup fails with ENODEV, and is dropped whichever file fails
+        pressure = cgroup.files[cgroups.IO_PRESSURE]
+        with mock.patch("os.pread", lambda *args: failing_pread(*args, code=errno.ENODEV)):
+            self.assertNotIn(SERVICE, self.run_monitor())
+        self.assertIn(SERVICE, self.run_monitor())
+
+    def test_cpu_stat_fields_by_name(self):
+        self.write(SERVICE, "cpu.stat", "usage_usec 1000\nuser_usec 600\nsystem_usec 400\n"
+                                        "core_sched.force_idle_usec 0\nnr_periods 10\nnr_throttled 2\n"
+                                        "throttled_usec 100\nnr_bursts 0\nburst_usec 0\n")
+        self.run_monitor()
+        sleep(0.05)
+        self.write(SERVICE, "cpu.stat", "usage_usec 51000\nuser_usec 30600\nsystem_usec 20400\n"
+                                        "core_sched.force_idle_usec 0\nnr_periods 20\nnr_throttled 4\n"
+                                        "throttled_usec 10100\nnr_bursts 0\nburst_usec 0\n")
+        values = self.run_monitor()[SERVICE]
+        self.assertGreater(values["cpu_throttled"], 0)
+        self.assertAlmostEqual(values["cpu_throttled"] / values["cpu_usage"], 0.2)
+        self.assertAlmostEqual(values["cpu_user"] / values["cpu_usage"], 0.6)
+
+    def test_added_cgroup_is_found(self):
+        self.assertNotIn("/new.slice", self.run_monitor())
+        shutil.copytree(self.root + SERVICE, self.root + "/new.slice")
+        with open(os.path.join(self.root, "cgroup.stat")) as f:
+            descendants = int(f.readline().split()[1])
+        self.write("", "cgroup.stat", "nr_descendants %d\nnr_dying_descendants 0\n" % (descendants + 1))
+        self.assertIn("/new.slice", self.run_monitor())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+from pymonitor import Metric
+from pymonitor.dedup import Deduplicator
+import unittest
+
+
+SECOND = 10 ** 9
+
+
+def disk(t, free, fs="/", **values):
+    return Metric(dict(values, free=free), {"type": "diskspace", "fs": fs}, t * SECOND)
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def sent(self, dedup, metrics):
+        return [metric.values["free"] for metric in metrics for metric in dedup.process(metric)]
+
+    def test_changes_are_sent(self):
+        dedup = Deduplicator(10, heartbeat=100)
+        self.assertEqual(self.sent(dedup, [disk(t, free) for t, free in enumerate((5, 5, 5, 6, 6, 5))]), [5, 6, 5])
+        self.assertEqual((dedup.sent, dedup.suppressed), (3, 3))
+
+    def test_heartbeat(self):
+        dedup = Deduplicator(10, heartbeat=3)
+        self.assertEqual(self.sent(dedup, [disk(t, 5) for t in range(7)]), [5] * 3)
+        self.assertEqual(self.sent(Deduplicator(10, heartbeat=1), [disk(t, 5) for t in range(3)]), [5] * 3)
+
+    def test_tolerance(self):
+        dedup = Deduplicator(10, heartbeat=100, abs_tolerance=2)
+        self.assertEqual(self.sent(dedup, [disk(t, free) for t, free in enumerate((10, 12, 8, 13, 11))]), [10, 13])
+        # compared with the last sent value, so a slow drift is still reported
+        dedup = Deduplicator(10, heartbeat=100, rel_tolerance=0.1)
+        self.assertEqual(self.sent(dedup, [disk(t, free) for t, free in enumerate((100, 105, 109, 111, 120))]),
+                         [100, 111])
+
+    def test_other_fields(self):
+        dedup = Deduplicator(10, heartbeat=100, abs_tolerance=5)
+        metrics = [disk(0, 1, state="ok"), disk(1, 1, state="ok"), disk(2, 1, state="full"), disk(3, 1, ok=True),
+                   disk(4, 1, ok=1), disk(5, 1, ok=2)]
+        # bools aren't compared as numbers, and a field appearing or vanishing is a change
+        self.assertEqual(self.sent(dedup, metrics), [1, 1, 1, 1])
+
+    def test_series(self):
+        dedup = Deduplicator(10, heartbeat=100)
+        metrics = [disk(t, 5, fs=fs) for t in range(3) for fs in ("/", "/home")]
+        self.assertEqual(len(self.sent(dedup, metrics)), 2)
+
+    def test_expiry(self):
+        dedup = Deduplicator(1, heartbeat=5)  # forgotten after 10 seconds
+        dedup.process(disk(0, 5, fs="/gone"))
+        for t in range(30):
+            dedup.process(disk(t, 5))
+        self.assertEqual([dict(key)["fs"] for key in dedup.series], ["/"])
+
+
+if __name__ == '__main__':
+    unittest.main()
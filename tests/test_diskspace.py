@@ -0,0 +1,61 @@
+from pymonitor.monitors import diskspace
+from threading import Event
+from unittest import mock
+from time import monotonic
+import unittest
+import os
+
+
+class HungMountTest(unittest.TestCase):
+    def setUp(self):
+        self.release = Event()
+        diskspace.pool = None
+        diskspace.pending.clear()
+        diskspace.quarantined.clear()
+        patcher = mock.patch.object(diskspace, "statvfs", self.statvfs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.release.set()  # lets the abandoned threads finish
+        diskspace.pool = None
+        diskspace.pending.clear()
+        diskspace.quarantined.clear()
+
+    def statvfs(self, path):
+        if path.startswith("/hung"):
+            self.release.wait(10)
+        return os.statvfs("/")
+
+    def run_monitor(self, filesystems, **args):
+        return {metric.tags["fs"]: metric.values["available"]
+                for metric in diskspace.diskspace(filesystems, discover=False, **args)}
+
+    def test_queued_checks_are_not_timed_out(self):
+        # more hung mounts than threads: the healthy ones queued behind them still get checked
+        filesystems = ["/hung%s" % i for i in range(3)] + ["/local1", "/local2"]
+        start = monotonic()
+        result = self.run_monitor(filesystems, timeout=0.2, workers=2)
+        self.assertLess(monotonic() - start, 1)
+        self.assertEqual(result, {"/hung0": False, "/hung1": False, "/hung2": False, "/local1": True, "/local2": True})
+        self.assertEqual(sorted(diskspace.quarantined), ["/hung0", "/hung1", "/hung2"])
+
+    def test_checks_without_a_thread_are_skipped(self):
+        # with every thread stuck, mounts that could not be checked are left out of this run, not quarantined
+        filesystems = ["/hung%s" % i for i in range(4)] + ["/local"]
+        result = self.run_monitor(filesystems, timeout=0.2, workers=1)
+        self.assertNotIn(False, [result.get(fs, True) for fs in filesystems if not fs.startswith("/hung")])
+        self.assertEqual(sorted(diskspace.quarantined), sorted(fs for fs in result if fs.startswith("/hung")))
+        self.assertGreaterEqual(len(diskspace.quarantined), 2)
+
+    def test_recovered(self):
+        self.run_monitor(["/hung0", "/local"], timeout=0.1, workers=1, quarantine=0)
+        self.assertEqual(list(diskspace.quarantined), ["/hung0"])
+        self.release.set()
+        diskspace.pending["/hung0"].result(5)
+        self.assertEqual(self.run_monitor(["/hung0", "/local"], timeout=0.1), {"/hung0": True, "/local": True})
+        self.assertEqual(diskspace.quarantined, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
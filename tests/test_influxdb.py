@@ -0,0 +1,55 @@
+from pymonitor import Metric
+from pymonitor.influxdb import InfluxBackend, make_line, format_value
+from types import SimpleNamespace
+import unittest
+import socket
+
+
+class LineProtocolTest(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(format_value(5), "5i")
+        self.assertEqual(format_value(-5), "-5i")
+        self.assertEqual(format_value(0.1), "0.1")
+        self.assertEqual(format_value(1e20), "1e+20")
+        self.assertEqual(format_value(True), "true")
+        self.assertEqual(format_value(False), "false")
+        self.assertEqual(format_value('say "hi" \\ bye'), r'"say \"hi\" \\ bye"')
+
+    def test_escaping(self):
+        line = make_line("disk io,x", {"mount point": "/mnt/a b", "k=v": "a,b=c", "empty": "", "none": None},
+                         {"free space": 1, "a,b=c": 2.5}, 1000)
+        self.assertEqual(line, r'disk\ io\,x,k\=v=a\,b\=c,mount\ point=/mnt/a\ b free\ space=1i,a\,b\=c=2.5 1000')
+
+    def test_skipped_fields(self):
+        line = make_line("load", {}, {"a": 1, "b": None, "c": float("nan"), "d": float("inf"), "e": float("-inf")}, 5)
+        self.assertEqual(line, "load a=1i 5")
+        self.assertIsNone(make_line("load", {"host": "x"}, {"a": float("nan"), "b": None}, 5))
+
+
+class UdpTest(unittest.TestCase):
+    def test_send(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        backend = InfluxBackend(SimpleNamespace(monitors=[]), {"host": "127.0.0.1", "udp": True,
+                                                                "udp_port": receiver.getsockname()[1],
+                                                                "precision": "s", "udp_payload": 100})
+        backend.sysinfo = {"hostname": "web 1"}
+        dropped = backend.dropped.value  # telemetry counters are shared by backends of the same name
+        backend.connect()
+        backend.add_data(Metric({"load_1m": 0.5, "procs": 3}, {"type": "load"}, 1700000000 * 10 ** 9))
+        backend.add_data(Metric({"load_1m": float("nan")}, {"type": "load"}, 1700000001 * 10 ** 9))
+        backend.add_data(Metric({"free": 10, "fs": "/"}, {"type": "diskspace", "fs": "/"}, 1700000002 * 10 ** 9))
+        backend.close()
+
+        lines = []
+        while len(lines) < 2:
+            lines.extend(receiver.recv(65536).decode().splitlines())
+        self.assertEqual(lines, [r"load,hostname=web\ 1,type=load load_1m=0.5,procs=3i 1700000000",
+                                 r'diskspace,fs=/,hostname=web\ 1,type=diskspace free=10i,fs="/" 1700000002'])
+        self.assertEqual(backend.dropped.value - dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
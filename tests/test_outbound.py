@@ -0,0 +1,103 @@
+from pymonitor import Metric
+from pymonitor.outbound import OutboundQueue
+from threading import Event
+from time import monotonic
+import unittest
+
+
+class Backend(object):
+    """
+    Records the metrics it is given, failing on those with a `fail` field, and waiting for `gate` if set
+    """
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.received = []
+        self.failures = []
+
+    def add_data(self, metric):
+        if self.gate:
+            self.gate.wait(5)
+        if "fail" in metric.values:
+            raise Exception("rejected")
+        self.received.append(metric.values["n"])
+
+    def failed(self, metrics):
+        self.failures.extend(metrics)
+
+
+def metric(n, **values):
+    return Metric(dict(values, n=n), {"type": "test"}, n)
+
+
+class OverflowTest(unittest.TestCase):
+    # The sender threads aren't started, so nothing leaves the queue
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(Backend(), size=3, policy="drop-oldest", name="test-drop-oldest")
+        self.assertTrue(all(queue.put(metric(n)) for n in range(5)))
+        self.assertEqual([m.values["n"] for m in queue.items], [2, 3, 4])
+        self.assertEqual(queue.stats(), {"enqueued": 5, "dropped": 2, "sent": 0, "failed": 0, "depth": 3})
+
+    def test_drop_newest(self):
+        queue = OutboundQueue(Backend(), size=3, policy="drop-newest", name="test-drop-newest")
+        self.assertEqual([queue.put(metric(n)) for n in range(5)], [True, True, True, False, False])
+        self.assertEqual([m.values["n"] for m in queue.items], [0, 1, 2])
+        self.assertEqual(queue.stats(), {"enqueued": 3, "dropped": 2, "sent": 0, "failed": 0, "depth": 3})
+
+    def test_block_timeout(self):
+        queue = OutboundQueue(Backend(), size=2, policy="block", block_timeout=0.1, name="test-block-timeout")
+        queue.put(metric(0))
+        queue.put(metric(1))
+        start = monotonic()
+        self.assertFalse(queue.put(metric(2)))
+        self.assertGreaterEqual(monotonic() - start, 0.09)
+        self.assertEqual(queue.stats(), {"enqueued": 2, "dropped": 1, "sent": 0, "failed": 0, "depth": 2})
+
+    def test_timestamp(self):
+        queue = OutboundQueue(Backend(), name="test-timestamp")
+        queue.put(Metric({"n": 0}))
+        self.assertIsNotNone(queue.items[0].timestamp)
+
+    def test_invalid_policy(self):
+        self.assertRaises(Exception, OutboundQueue, Backend(), policy="drop-random")
+
+
+class SendTest(unittest.TestCase):
+    def test_block_waits_for_space(self):
+        gate = Event()
+        backend = Backend(gate)
+        queue = OutboundQueue(backend, size=2, policy="block", batch=1, name="test-block")
+        queue.start()
+        gate.set()
+        for n in range(50):
+            self.assertTrue(queue.put(metric(n)))
+        queue.close(5)
+        self.assertEqual(backend.received, list(range(50)))
+        self.assertEqual(queue.stats(), {"enqueued": 50, "dropped": 0, "sent": 50, "failed": 0, "depth": 0})
+
+    def test_failures(self):
+        backend = Backend()
+        queue = OutboundQueue(backend, workers=2, batch=7, name="test-failures")
+        queue.start()
+        for n in range(100):
+            queue.put(metric(n, fail=True) if n % 10 == 0 else metric(n))
+        queue.close(5)
+        self.assertEqual(sorted(backend.received), [n for n in range(100) if n % 10])
+        self.assertEqual(sorted(m.values["n"] for m in backend.failures), list(range(0, 100, 10)))
+        self.assertEqual(queue.stats(), {"enqueued": 100, "dropped": 0, "sent": 90, "failed": 10, "depth": 0})
+
+    def test_close_drains(self):
+        gate = Event()
+        backend = Backend(gate)
+        queue = OutboundQueue(backend, batch=3, name="test-close")
+        queue.start()
+        for n in range(10):
+            queue.put(metric(n))
+        self.assertEqual(backend.received, [])
+        gate.set()
+        queue.close(5)
+        self.assertEqual(backend.received, list(range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
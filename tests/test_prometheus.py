@@ -0,0 +1,38 @@
+from pymonitor import Metric
+from pymonitor.prometheus import PrometheusBackend
+from types import SimpleNamespace
+from time import time_ns
+import unittest
+
+
+class AddDataTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = PrometheusBackend(SimpleNamespace(monitors=[]), {"name": "test-prometheus", "max_series": 3})
+        self.before = self.backend.stats()  # telemetry counters are shared by backends of the same name
+
+    def counts(self):
+        after = self.backend.stats()
+        return {key: after[key] - self.before[key] for key in ("delivered", "dropped")}
+
+    def test_series(self):
+        now = time_ns()
+        self.backend.add_data(Metric({"load_1m": 0.5, "procs": 3, "state": "ok"}, {"type": "load"}, now))
+        self.backend.add_data(Metric({"load_1m": 1.5, "procs": 4}, {"type": "load"}, now))
+        text, _ = self.backend.exposition()
+        self.assertEqual(text, b"# TYPE pymonitor_load_load_1m gauge\npymonitor_load_load_1m 1.5\n"
+                               b"# TYPE pymonitor_load_procs gauge\npymonitor_load_procs 4.0\n")
+        self.assertEqual(self.counts(), {"delivered": 2, "dropped": 0})
+
+    def test_max_series(self):
+        now = time_ns()
+        for i in range(5):
+            self.backend.add_data(Metric({"rx": i}, {"type": "ifstats", "iface": "eth%s" % i}, now))
+        # a metric with a known series still counts as delivered when its new fields are refused
+        self.backend.add_data(Metric({"rx": 10, "tx": 10}, {"type": "ifstats", "iface": "eth0"}, now))
+        self.assertEqual(self.counts(), {"delivered": 4, "dropped": 2})
+        self.assertEqual(self.backend.rejected, 3)
+        self.assertEqual(self.backend.exposition()[0].count(b"\npymonitor_ifstats_rx{"), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+from pymonitor.rates import RateTracker, counter_delta
+import unittest
+
+
+class CounterDeltaTest(unittest.TestCase):
+    def test_increase(self):
+        self.assertEqual(counter_delta(150, 100), 50)
+
+    def test_64_bit_reset(self):
+        # a recreated interface starting again at 0 isn't a 32 bit wrap
+        self.assertIsNone(counter_delta(1000, 3000000000))
+        self.assertIsNone(counter_delta(1000, 2 ** 40))
+
+    def test_wraps(self):
+        self.assertEqual(counter_delta(1000, 3000000000, 32), 1000 + 2 ** 32 - 3000000000)
+        self.assertEqual(counter_delta(5, 2 ** 64 - 10), 15)
+
+    def test_32_bit_reset(self):
+        self.assertIsNone(counter_delta(1000, 2000000000, 32))
+
+
+class RateTrackerTest(unittest.TestCase):
+    def test_widths(self):
+        rates = RateTracker("test")
+        rates.update("sda", (3000000000, 3000000000), (64, 32))
+        self.assertIsNone(rates.update("sda", (1000, 1000), (64, 32)))
+        rates.update("sdb", (3000000000, 3000000000), (64, 32))
+        deltas, _ = rates.update("sdb", (3000001000, 1000), (64, 32))
+        self.assertEqual(deltas, [1000, 1000 + 2 ** 32 - 3000000000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+from pymonitor import Metric
+from pymonitor import remotewrite
+from pymonitor.remotewrite import RemoteWriteBackend, varint, read_varint, delimited, encode_sample, \
+    snappy_compress, snappy_decompress, decode_write_request
+from pymonitor.builtins.stubserver import StubServer
+from types import SimpleNamespace
+import unittest
+import random
+import struct
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+
+NOW = 1700000000123456789  # nanoseconds
+
+
+def random_bytes(rand, count):
+    return bytes(rand.getrandbits(8) for _ in range(count))
+
+
+def compression_cases():
+    """
+    Inputs covering each literal and copy encoding of the snappy block format, and matches at the 64KiB offset limit
+    """
+    rand = random.Random(1)
+    cases = {"empty": b"", "short": b"abc", "run": b"a" * 1000}
+    # literals with a length in the tag byte, or in 1, 2 or 3 following bytes
+    for length in (1, 59, 60, 61, 255, 256, 257, 65535, 65536, 65537, 70000):
+        cases["literal %s" % length] = random_bytes(rand, length)
+    # copies with 1 byte offsets (4 to 11 bytes, offset under 2048) and 2 byte offsets, including ones over 64 bytes
+    # that are split into several
+    for offset in (1, 100, 2047, 2048, 40000):
+        for length in (4, 11, 12, 60, 64, 65, 67, 68, 69, 128, 1000):
+            chunk = random_bytes(rand, max(offset, length))
+            cases["copy %s at %s" % (length, offset)] = random_bytes(rand, 20) + chunk[:offset] + \
+                chunk[:min(length, offset)] * (length // offset + 1)
+    # a repeated block at the largest offset a copy can reach, and one just past it
+    block = random_bytes(rand, 64)
+    for offset in (65535, 65536):
+        cases["offset %s" % offset] = block + random_bytes(rand, offset - len(block)) + block
+    return cases
+
+
+class Shard(object):
+    """
+    Stands in for a Batcher, handing batches straight to a list
+    """
+    def __init__(self):
+        self.items = []
+
+    def add(self, item, size):
+        self.items.append(item)
+
+
+class ProtobufTest(unittest.TestCase):
+    def test_varint(self):
+        self.assertEqual(varint(1), b"\x01")
+        self.assertEqual(varint(300), b"\xac\x02")
+        for value in (0, 127, 128, 16383, 16384, 2 ** 63, 2 ** 64 - 1):
+            self.assertEqual(read_varint(b"\xff" + varint(value), 1), (value, 1 + len(varint(value))))
+
+    def test_sample(self):
+        self.assertEqual(encode_sample(1.5, 1000), b"\x09" + struct.pack("<d", 1.5) + b"\x10\xe8\x07")
+        # int64 timestamps are sign extended to 10 bytes
+        self.assertEqual(len(encode_sample(0.0, -1)), 1 + 8 + 1 + 10)
+        request = delimited(1, delimited(1, delimited(1, b"__name__") + delimited(2, b"x")) +
+                            delimited(2, encode_sample(2.0, 5)) + delimited(2, encode_sample(-3.0, -5)))
+        self.assertEqual(decode_write_request(request), [({"__name__": "x"}, [(2.0, 5), (-3.0, -5)])])
+
+
+class WriteRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = RemoteWriteBackend(SimpleNamespace(monitors=[]), {"url": "http://127.0.0.1:1/api/v1/write",
+                                                                        "labels": {"zone": "b", "env": "test"}})
+        self.backend.shards = [Shard()]
+
+    def test_encode(self):
+        metrics = [Metric({"reads": 10 + i, "util": 0.5, "model": "ssd", "ok": True},
+                          {"type": "diskio", "device": "sda", "a-b": "c"}, NOW + i * 10 ** 9) for i in range(3)]
+        for metric in metrics:
+            self.backend.add_data(metric)
+        series = decode_write_request(self.backend.encode(self.backend.shards[0].items))
+        self.assertEqual(len(series), 3)  # the string field is left out
+        for labels, samples in series:
+            self.assertEqual(list(labels), sorted(labels))  # in wire order
+            self.assertEqual({key: labels[key] for key in ("device", "a_b", "zone", "env")},
+                             {"device": "sda", "a_b": "c", "zone": "b", "env": "test"})
+            self.assertNotIn("type", labels)
+            self.assertEqual([timestamp for _, timestamp in samples], [NOW // 10 ** 6 + i * 1000 for i in range(3)])
+        by_name = {labels["__name__"]: samples for labels, samples in series}
+        self.assertEqual([value for value, _ in by_name["pymonitor_diskio_reads"]], [10.0, 11.0, 12.0])
+        self.assertEqual([value for value, _ in by_name["pymonitor_diskio_util"]], [0.5] * 3)
+        self.assertEqual([value for value, _ in by_name["pymonitor_diskio_ok"]], [1.0] * 3)
+
+    def test_stub_server(self):
+        server = StubServer()
+        server.start()
+        try:
+            backend = RemoteWriteBackend(SimpleNamespace(monitors=[]),
+                                         {"url": "http://127.0.0.1:%s/api/v1/write" % server.port, "shards": 3})
+            backend.connect()
+            for i in range(100):
+                backend.add_data(Metric({"rx": i, "tx": -i}, {"type": "ifstats", "iface": "eth%s" % (i % 7)},
+                                        NOW + i * 10 ** 6))
+            backend.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(server.samples, 200)
+        self.assertEqual(len(server.series), 14)
+        for labels, samples in server.series.items():
+            labels = dict(labels)
+            self.assertIn(labels["__name__"], ("pymonitor_ifstats_rx", "pymonitor_ifstats_tx"))
+            timestamps = [timestamp for _, timestamp in samples]
+            self.assertEqual(timestamps, sorted(timestamps))  # a series' samples are sent in order
+            for value, timestamp in samples:
+                i = (timestamp - NOW // 10 ** 6)
+                self.assertEqual(int(labels["iface"][3:]), i % 7)
+                self.assertEqual(abs(value), i)
+
+
+class SnappyTest(unittest.TestCase):
+    def test_round_trip(self):
+        for name, data in compression_cases().items():
+            with self.subTest(name):
+                self.assertEqual(snappy_decompress(snappy_compress(data)), data)
+
+    def test_compresses(self):
+        cases = compression_cases()
+        self.assertLess(len(snappy_compress(cases["run"])), 60)  # 64 byte copies of 3 bytes each
+        self.assertLess(len(snappy_compress(cases["offset 65535"])), 65535 + 16)
+
+    def test_decompress_encodings(self):
+        # each element type written out by hand, as the compressor doesn't produce all of them
+        literal_4 = varint(3) + bytes((63 << 2,)) + (2).to_bytes(4, "little") + b"xyz"
+        self.assertEqual(snappy_decompress(literal_4), b"xyz")
+        copy_1 = varint(9) + bytes((2 << 2,)) + b"abc" + bytes((2 << 2 | 1, 3))  # 6 bytes from 3 back, overlapping
+        self.assertEqual(snappy_decompress(copy_1), b"abcabcabc")
+        copy_2 = varint(10) + bytes((1 << 2,)) + b"ab" + bytes((7 << 2 | 2,)) + (2).to_bytes(2, "little")
+        self.assertEqual(snappy_decompress(copy_2), b"ababababab")
+        copy_4 = varint(6) + bytes((2 << 2,)) + b"abc" + bytes((2 << 2 | 3,)) + (3).to_bytes(4, "little")
+        self.assertEqual(snappy_decompress(copy_4), b"abcabc")
+
+    def test_length_mismatch(self):
+        self.assertRaises(ValueError, snappy_decompress, varint(4) + bytes((2 << 2,)) + b"abc")
+
+    @unittest.skipUnless(snappy, "python-snappy is not installed")
+    def test_python_snappy(self):
+        for name, data in compression_cases().items():
+            with self.subTest(name):
+                self.assertEqual(snappy.decompress(snappy_compress(data)), data)
+                self.assertEqual(snappy_decompress(snappy.compress(data)), data)
+
+    @unittest.skipUnless(snappy, "python-snappy is not installed")
+    def test_pure_python_request(self):
+        # a request compressed without python-snappy is readable by a receiver using it
+        backend = RemoteWriteBackend(SimpleNamespace(monitors=[]), {"url": "http://127.0.0.1:1/api/v1/write"})
+        backend.shards = [Shard()]
+        for i in range(500):
+            backend.add_data(Metric({"value": i}, {"type": "load", "cpu": str(i % 50)}, NOW))
+        body = backend.encode(backend.shards[0].items)
+        self.assertIs(remotewrite.snappy, snappy)
+        series = decode_write_request(snappy.decompress(snappy_compress(body)))
+        self.assertEqual(sum(len(samples) for _, samples in series), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+from pymonitor import scheduler
+from pymonitor.scheduler import Scheduler, Job, host_offset
+from threading import Thread, Event
+from unittest import mock
+import time
+import unittest
+
+
+class HostOffsetTest(unittest.TestCase):
+    def test_stable(self):
+        self.assertEqual(host_offset("load-0", 60, 30, host="web1"), host_offset("load-0", 60, 30, host="web1"))
+
+    def test_range(self):
+        offsets = [host_offset("load-0", 60, 30, host="web%s" % i) for i in range(200)]
+        self.assertTrue(all(0 <= offset < 30 for offset in offsets))
+        self.assertGreater(len(set(offsets)), 190)  # hosts are spread out
+        self.assertTrue(all(0 <= host_offset("load-0", 10, 30, host="web%s" % i) < 10 for i in range(200)))
+
+    def test_no_jitter(self):
+        self.assertEqual(host_offset("load-0", 60, 0, host="web1"), 0.0)
+
+
+class AlignmentTest(unittest.TestCase):
+    def due(self, job, wall, mono=500.0):
+        sched = Scheduler(workers=1)
+        self.addCleanup(sched.pool.shutdown)
+        with mock.patch.object(scheduler, "time", return_value=wall), \
+                mock.patch.object(scheduler, "monotonic", return_value=mono):
+            sched.add(job)
+        (due, _, _), = sched.heap
+        return due - mono
+
+    def test_next_boundary(self):
+        self.assertAlmostEqual(self.due(Job("a", None, 10), 1000.3), 9.7)
+        self.assertAlmostEqual(self.due(Job("a", None, 10), 1000.0), 10)
+        self.assertAlmostEqual(self.due(Job("a", None, 60), 1019.5), 0.5)
+
+    def test_offset(self):
+        self.assertAlmostEqual(self.due(Job("a", None, 10, offset=2), 1000.3), 1.7)
+        self.assertAlmostEqual(self.due(Job("a", None, 10, offset=2), 1002.5), 9.5)
+        # offsets past the interval wrap around
+        self.assertAlmostEqual(self.due(Job("a", None, 10, offset=12), 1000.3), 1.7)
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = Scheduler(workers=2)
+        self.thread = Thread(target=self.sched.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.sched.shutdown()
+        self.thread.join(5)
+
+    def test_runs_on_boundaries(self):
+        starts = []
+        done = Event()
+
+        def func():
+            starts.append(time.time())
+            if len(starts) == 4:
+                done.set()
+        job = Job("aligned", func, 0.2, offset=0.05)
+        self.sched.add(job)
+        self.assertTrue(done.wait(5))
+        for start in starts:
+            self.assertLess((start - 0.05) % 0.2, 0.1)
+        self.assertEqual(job.skipped, 0)
+
+    def test_overlapping_run_is_skipped(self):
+        release = Event()
+        job = Job("slow", lambda: release.wait(5), 0.05)
+        self.sched.add(job)
+        time.sleep(0.4)
+        release.set()
+        self.sched.shutdown()
+        self.thread.join(5)
+        self.assertEqual(job.runs, 1)
+        self.assertGreater(job.skipped, 0)
+        self.assertEqual(job.overruns, 1)
+
+    def test_failing_job_keeps_running(self):
+        done = Event()
+
+        def func():
+            if job.runs >= 2:
+                done.set()
+            raise Exception("broken")
+        job = Job("failing", func, 0.05)
+        self.sched.add(job)
+        self.assertTrue(done.wait(5))
+
+
+if __name__ == '__main__':
+    unittest.main()